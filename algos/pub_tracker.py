@@ -1,7 +1,5 @@
 import numpy as np
-from algos.track_utils import greedy_assignment
-import copy
-from scipy.optimize import linear_sum_assignment as linear_assignment
+from algos.track import associate
 from collections import OrderedDict
 
 NUSCENES_TRACKING_NAMES = [
@@ -26,6 +24,7 @@ NUSCENE_CLS_VELOCITY_ERROR = {
     'motorcycle': 13,
     'bicycle': 3,
 }
+NUSCENE_CLS_MAX_DIFF = np.array([NUSCENE_CLS_VELOCITY_ERROR[name] for name in NUSCENES_TRACKING_NAMES], np.float32)
 
 
 class ObjectIdManager:
@@ -37,6 +36,11 @@ class ObjectIdManager:
         self.maxId[self.scene] += 1
         return self.maxId[self.scene]
 
+    def generateNewUniqueIds(self, n):
+        ids = np.arange(self.maxId[self.scene] + 1, self.maxId[self.scene] + 1 + n, dtype=np.int64)
+        self.maxId[self.scene] += n
+        return ids
+
     def setCurrentScene(self, scene):
         self.scene = scene
 
@@ -44,12 +48,60 @@ class ObjectIdManager:
         self.maxId[self.scene] = max(ids+[self.maxId[self.scene]])
 
 
+class TrackArrays(object):
+    """Tracks of one scene as parallel arrays, row i of every array (and boxes[i]) is one track."""
+
+    def __init__(self, capacity=256):
+        self.n = 0
+        self.ct = np.zeros((capacity, 2), np.float32)
+        self.tracking = np.zeros((capacity, 2), np.float32)
+        self.label = np.zeros(capacity, np.int32)
+        self.age = np.zeros(capacity, np.int32)
+        self.active = np.zeros(capacity, np.int32)
+        # ids are kept as given (an obj_id may be any value), generated ones are ints
+        self.tracking_id = np.zeros(capacity, object)
+        self.matched = np.zeros(capacity, bool)
+        self.boxes = []
+
+    def reserve(self, n):
+        if n <= len(self.label):
+            return
+        capacity = max(n, 2 * len(self.label))
+        for key in ["ct", "tracking", "label", "age", "active", "tracking_id", "matched"]:
+            old = getattr(self, key)
+            new = np.zeros((capacity,) + old.shape[1:], old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, key, new)
+
+    def copy(self):
+        res = TrackArrays(max(self.n, 1))
+        res.n = self.n
+        for key in ["ct", "tracking", "label", "age", "active", "tracking_id", "matched"]:
+            getattr(res, key)[:self.n] = getattr(self, key)[:self.n]
+        res.boxes = list(self.boxes)
+        return res
+
+    def as_dicts(self):
+        """The tracks in the format step_centertrack used to return, the source box plus tracking fields."""
+        res = []
+        for i in range(self.n):
+            track = dict(self.boxes[i])
+            track['tracking_id'] = self.tracking_id[i]
+            track['age'] = int(self.age[i])
+            track['active'] = int(self.active[i])
+            track['matched'] = bool(self.matched[i])
+            res.append(track)
+        return res
+
+
 class PubTracker(object):
     def __init__(self, hungarian=False, max_age=3, num_scene=10, thresh = 0.2):
         self.hungarian = hungarian
         self.max_age = max_age
         self.num_scene = num_scene
-        self.tracks = [[] for _ in range(num_scene)]
+        # current and spare state per scene, a step writes into the spare one and swaps
+        self.tracks = [TrackArrays() for _ in range(num_scene)]
+        self._spare = [TrackArrays() for _ in range(num_scene)]
         self.has_tracked_list = [OrderedDict() for _ in range(num_scene)]
         self.id_manager = ObjectIdManager(num_scene)
         self.NUSCENE_CLS_VELOCITY_ERROR = NUSCENE_CLS_VELOCITY_ERROR
@@ -62,104 +114,99 @@ class PubTracker(object):
         self.id_manager.setCurrentScene(scene_index)
 
     def reset(self):
-        self.tracks[self.scene_index] = []
+        self.tracks[self.scene_index].n = 0
+        self.tracks[self.scene_index].boxes = []
+
+    def get_state(self):
+        """Snapshot of the current scene, restored with set_state to resume tracking from here."""
+        return self.tracks[self.scene_index].copy(), self.id_manager.maxId[self.scene_index]
+
+    def set_state(self, state):
+        tracks, max_id = state
+        self.tracks[self.scene_index] = tracks.copy()
+        self.id_manager.maxId[self.scene_index] = max(max_id, self.id_manager.maxId[self.scene_index])
 
     def step_centertrack(self, results, time_lag):
+        """
+        :param results: nuScenes detection boxes of one frame.
+        :return: the tracks after this frame as dicts, tracks with active == 0 were not seen in it.
+        """
         if len(results) == 0:
-            self.tracks[self.scene_index] = []
+            self.reset()
             return []
-        else:
-            temp = []
-            for det in results:
-                # filter out classes not evaluated for tracking
-                if det['detection_name'] not in NUSCENES_TRACKING_NAMES or det["detection_score"] < self.thresh:
-                    continue
-                det['ct'] = np.array(det['translation'][:2])
-                det['tracking'] = np.array(det['velocity'][:2]) * -1 * time_lag
-                det['label_preds'] = NUSCENES_TRACKING_NAMES.index(det['detection_name'])
-                temp.append(det)
-            results = temp
-
-        N = len(results)
-        M = len(self.tracks[self.scene_index])
-
-        # N X 2
-        dets = np.array([det['ct'] + det['tracking'].astype(np.float32)
-                         if det['velocity'][0] != 999 else det['ct'] for det in results], np.float32)
-
-        item_cat = np.array([item['label_preds'] for item in results], np.int32)  # N
-        track_cat = np.array([track['label_preds'] for track in self.tracks[self.scene_index]], np.int32)  # M
-
-        max_diff = np.array([self.NUSCENE_CLS_VELOCITY_ERROR[box['detection_name']] for box in results], np.float32)
-
-        tracks = np.array([pre_det['ct'] for pre_det in self.tracks[self.scene_index]], np.float32)  # M x 2
-
-        if len(tracks) > 0:  # NOT FIRST FRAME
-            dist = (((tracks.reshape(1, -1, 2) - \
-                      dets.reshape(-1, 1, 2)) ** 2).sum(axis=2))  # N x M
-            dist = np.sqrt(dist)  # absolute distance in meter
-
-            invalid = ((dist > max_diff.reshape(N, 1)) +
-                       (item_cat.reshape(N, 1) != track_cat.reshape(1, M))) > 0
-
-            dist = dist + invalid * 1e18
-            if self.hungarian:
-                dist[dist > 1e18] = 1e18
-                matched_indices = linear_assignment(copy.deepcopy(dist))
-            else:
-                matched_indices = greedy_assignment(copy.deepcopy(dist))
-        else:  # first few frame
-            assert M == 0
-            matched_indices = np.array([], np.int32).reshape(-1, 2)
-
-        unmatched_dets = [d for d in range(dets.shape[0]) \
-                          if not (d in matched_indices[:, 0])]
-
-        unmatched_tracks = [d for d in range(tracks.shape[0]) \
-                            if not (d in matched_indices[:, 1])]
-
-        if self.hungarian:
-            matches = []
-            for m in matched_indices:
-                if dist[m[0], m[1]] > 1e16:
-                    unmatched_dets.append(m[0])
-                else:
-                    matches.append(m)
-            matches = np.array(matches).reshape(-1, 2)
-        else:
-            matches = matched_indices
-
-        ret = []
-        for m in matches:
-            track = results[m[0]]
-            track['tracking_id'] = self.tracks[self.scene_index][m[1]]['tracking_id']
-            track['age'] = 1
-            track['active'] = self.tracks[self.scene_index][m[1]]['active'] + 1
-            track["matched"] = True
-            ret.append(track)
-
-        for i in unmatched_dets:
-            track = results[i]
-            track['tracking_id'] = track["obj_id"] if "obj_id" in track.keys() else self.id_manager.generateNewUniqueId()
-            track['age'] = 1
-            track['active'] = 1
-            track["matched"] = False
-            ret.append(track)
-
+        # a frame whose boxes are all filtered out still ages the tracks
+        boxes = [det for det in results
+                 if det['detection_name'] in NUSCENES_TRACKING_NAMES and det["detection_score"] >= self.thresh]
+
+        ct = np.array([det['translation'][:2] for det in boxes], np.float64).reshape(-1, 2)
+        velocity = np.array([det['velocity'][:2] for det in boxes], np.float64).reshape(-1, 2)
+        label = np.array([NUSCENES_TRACKING_NAMES.index(det['detection_name']) for det in boxes], np.int32)
+        has_id = np.array(['obj_id' in det for det in boxes], bool)
+        obj_id = np.empty(len(boxes), object)
+        obj_id[:] = [det.get('obj_id') for det in boxes]
+        self.step_arrays(boxes, ct, velocity, label, obj_id, has_id, time_lag)
+        return self.tracks[self.scene_index].as_dicts()
+
+    def step_arrays(self, boxes, ct, velocity, label, obj_id, has_id, time_lag):
+        """
+        Array form of step_centertrack, boxes only ride along.
+        :param ct: <N, 2> box centers.
+        :param velocity: <N, 2>, 999 in x if unknown.
+        :param label: <N> index into NUSCENES_TRACKING_NAMES.
+        :param obj_id: <N> id to keep for unmatched boxes, as given.
+        :param has_id: <N> False where obj_id is unset and an id is generated.
+        :return: TrackArrays of the scene after this frame.
+        """
+        state = self.tracks[self.scene_index]
+        N = len(boxes)
+        M = state.n
+
+        tracking = (velocity * -1 * time_lag).astype(np.float32)
+        has_velocity = velocity[:, 0] != 999
+        dets = np.where(has_velocity[:, None], ct + tracking, ct).astype(np.float32)  # N x 2
+
+        # only same-class pairs within the velocity error are scored
+        matches = associate(dets, label, state.ct[:M], state.label[:M], NUSCENE_CLS_MAX_DIFF, self.hungarian)
+
+        det_matched = np.zeros(N, bool)
+        det_matched[matches[:, 0]] = True
+        track_matched = np.zeros(M, bool)
+        track_matched[matches[:, 1]] = True
+        unmatched_dets = np.flatnonzero(~det_matched)
         # still store unmatched tracks if its age doesn't exceed max_age, however, we shouldn't output
         # the object in current frame
-        for i in unmatched_tracks:
-            track = self.tracks[self.scene_index][i]
-            if track['age'] < self.max_age:
-                track['age'] += 1
-                track['active'] = 0
-                ct = track['ct']
-
-                # movement in the last second
-                if 'tracking' in track:
-                    offset = track['tracking'] * -1  # move forward
-                    track['ct'] = ct + offset
-                ret.append(track)
-
-        self.tracks[self.scene_index] = ret
-        return ret
+        kept_tracks = np.flatnonzero(~track_matched & (state.age[:M] < self.max_age))
+
+        new_ids = obj_id[unmatched_dets].astype(object)
+        need_id = ~has_id[unmatched_dets]
+        new_ids[need_id] = self.id_manager.generateNewUniqueIds(int(need_id.sum())).tolist()
+
+        # rows: matched dets, unmatched dets, kept tracks
+        d = np.concatenate([matches[:, 0], unmatched_dets])
+        n_det = len(d)
+        n = n_det + len(kept_tracks)
+        nxt = self._spare[self.scene_index]
+        nxt.reserve(n)
+        nxt.n = n
+        nxt.ct[:n_det] = ct[d]
+        nxt.tracking[:n_det] = tracking[d]
+        nxt.label[:n_det] = label[d]
+        nxt.age[:n_det] = 1
+        nxt.active[:len(matches)] = state.active[matches[:, 1]] + 1
+        nxt.active[len(matches):n_det] = 1
+        nxt.tracking_id[:len(matches)] = state.tracking_id[matches[:, 1]]
+        nxt.tracking_id[len(matches):n_det] = new_ids
+        nxt.matched[:len(matches)] = True
+        nxt.matched[len(matches):n_det] = False
+
+        nxt.ct[n_det:n] = state.ct[kept_tracks] - state.tracking[kept_tracks]  # move forward
+        nxt.tracking[n_det:n] = state.tracking[kept_tracks]
+        nxt.label[n_det:n] = state.label[kept_tracks]
+        nxt.age[n_det:n] = state.age[kept_tracks] + 1
+        nxt.active[n_det:n] = 0
+        nxt.tracking_id[n_det:n] = state.tracking_id[kept_tracks]
+        nxt.matched[n_det:n] = state.matched[kept_tracks]
+        nxt.boxes = [boxes[i] for i in d] + [state.boxes[i] for i in kept_tracks]
+
+        self.tracks[self.scene_index], self._spare[self.scene_index] = nxt, state
+        return nxt
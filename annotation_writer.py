@@ -0,0 +1,134 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Atomic, batched persistence for label files. A save request writes all its frames compactly
+# to temp files, fsyncs them together on a small pool of worker threads, renames them into place
+# and fsyncs each directory once, so a crash never leaves a half-written label and a save request
+# only succeeds once its frames are on disk. Finishing the writes in the request keeps every uwsgi
+# worker reading the same files. At most max_pending fsyncs are queued over all requests, a burst
+# of saves waits for room instead of piling up. Repeated saves of a frame within one request are
+# coalesced.
+
+max_workers = 8
+max_pending = 256
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _fsync_file(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AnnotationWriter(object):
+    def __init__(self, max_workers=max_workers, max_pending=max_pending):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def _fsync_all(self, paths, fsync):
+        """Runs fsync on every path on the pool, returns [(path, exception)] of the failed ones."""
+        futures = []
+        for path in paths:
+            self._pending.acquire()
+            try:
+                future = self._pool.submit(fsync, path)
+            except Exception:
+                self._pending.release()
+                raise
+            future.add_done_callback(lambda _: self._pending.release())
+            futures.append((path, future))
+        failed = []
+        for path, future in futures:
+            e = future.exception()
+            if e is not None:
+                failed.append((path, e))
+        return failed
+
+    def write(self, items):
+        """
+        Writes a batch of json files, each one is either replaced as a whole or left as it was.
+        :param items: [(path, data, on_written)], on_written (or None) is called once the file is on disk.
+            A later item for the same path replaces the data of an earlier one.
+        :return: [(path, exception)] of the files that were not written, every other file is on disk.
+        """
+        batch = OrderedDict()  # path -> [data, callbacks]
+        for path, data, on_written in items:
+            entry = batch.setdefault(os.path.abspath(path), [None, []])
+            entry[0] = data
+            if on_written is not None:
+                entry[1].append(on_written)
+
+        failed = []
+        staged = OrderedDict()  # path -> tmp_path
+        for path, (data, _) in batch.items():
+            tmp_path = "{}.tmp{}.{}".format(path, os.getpid(), threading.get_ident())
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                staged[path] = tmp_path
+            except Exception as e:
+                _remove(tmp_path)
+                failed.append((path, e))
+
+        # the temp files are synced together, only synced ones replace a label
+        tmp_paths = dict((tmp_path, path) for path, tmp_path in staged.items())
+        for tmp_path, e in self._fsync_all(list(tmp_paths), _fsync_file):
+            path = tmp_paths[tmp_path]
+            del staged[path]
+            _remove(tmp_path)
+            failed.append((path, e))
+
+        written = []
+        for path, tmp_path in staged.items():
+            try:
+                os.replace(tmp_path, path)
+                written.append(path)
+            except Exception as e:
+                _remove(tmp_path)
+                failed.append((path, e))
+
+        # the renames are only durable once their directories are
+        dirs = list(OrderedDict.fromkeys(os.path.dirname(path) for path in written))
+        failed_dirs = dict(self._fsync_all(dirs, _fsync_dir))
+        durable = []
+        for path in written:
+            e = failed_dirs.get(os.path.dirname(path))
+            if e is None:
+                durable.append(path)
+            else:
+                failed.append((path, e))
+
+        for path in durable:
+            for callback in batch[path][1]:
+                try:
+                    callback()
+                except Exception as e:
+                    print("annotation write callback failed:", e)
+        return failed
+
+    def read_json(self, path):
+        """Returns the data of the json file at path, or None if there is none."""
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+
+writer = AnnotationWriter()
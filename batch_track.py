@@ -0,0 +1,130 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from blob_store import BlobStore, write_blob_store, iter_json_items
+from track_store import TrackStore
+from algos.pub_tracker import PubTracker
+from tools.my_nuscenes_converter import tracking_frame_to_SUSTECH
+import scene_reader2 as scene_reader
+import detection
+
+# Offline tracking of whole scenes, the batch counterpart of detection.track (and using its
+# settings).
+#   python batch_track.py [--workers 8] [--scenes nusc1 nusc2 ...]
+# Scenes are sharded over a process pool, each with its own tracker and ids. Detections
+# are read per frame from the blob store detection.py builds from the detection file, and
+# the tracked frames (SUSTech boxes) are merged into the store read_annotations(mode="pre_track")
+# reads, the server picks it up on the next request.
+
+
+def track_scene(scene_name, det_store_path, shard_path, save_dir=detection.annotation_save_dir):
+    """Tracks every frame of the scene into shard_path (frame_token -> SUSTech boxes)."""
+    start = time.time()
+    dets = BlobStore(det_store_path)
+    info = scene_reader.nusc_info[scene_name]
+    frames = info["frames"]
+    timestamps = info["timestamp"]
+
+    tracker = PubTracker(max_age=detection.max_age, hungarian=detection.hungarian, num_scene=1,
+                         thresh=detection.thresh)
+    tracker.set_scene(0)
+    anchors = detection.scene_annotations(scene_name, save_dir)
+    sizemap = {}
+    for boxes in anchors.values():
+        IDs = [int(obj["obj_id"]) for obj in boxes]
+        tracker.id_manager.addObjectID(IDs)
+        sizemap.update(dict(zip(IDs, [obj["size"] for obj in boxes])))
+
+    res = {}
+    last_time_stamp = timestamps[0]
+    for frame_index, token in enumerate(frames):
+        if token in anchors:
+            tracker.reset()
+            last_time_stamp = timestamps[frame_index]
+            boxes = anchors[token]
+        else:
+            boxes = dets.get(token, [])
+        outputs = tracker.step_centertrack(boxes, timestamps[frame_index] - last_time_stamp)
+        last_time_stamp = timestamps[frame_index]
+
+        annos = []
+        for item in outputs:
+            if item['active'] == 0:
+                continue
+            # anchor ids saved by the UI may be strings, as in detection.track
+            tracking_id = int(item['tracking_id'])
+            annos.append({
+                "sample_token": token,
+                "translation": item['translation'],
+                "size": sizemap.get(tracking_id, item['size']),
+                "rotation": item['rotation'],
+                "velocity": item['velocity'],
+                "obj_id": tracking_id,
+                "detection_name": item['detection_name'],
+                "detection_score": item['detection_score'],
+            })
+        res[token] = tracking_frame_to_SUSTECH(scene_reader.nusc_info, annos, scene_name, frame_index)
+
+    with open(shard_path, "w") as f:
+        f.write(json.dumps(res, separators=(",", ":")))
+    return scene_name, len(frames), time.time() - start, os.getpid()
+
+
+def run(scenes, det_file=None, out_path=None, workers=os.cpu_count(), save_dir=detection.annotation_save_dir):
+    if det_file is None:
+        det_store = detection.detections
+    else:
+        det_store = TrackStore(det_file, os.path.splitext(det_file)[0] + ".blob", results_key="results")
+    out_path = out_path if out_path is not None else scene_reader.track_res.store_path
+    shard_dir = out_path + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+
+    per_worker = {}
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(track_scene, scene, det_store.store_path, os.path.join(shard_dir, scene + ".json"),
+                               save_dir) for scene in scenes]
+        for i, future in enumerate(as_completed(futures)):
+            scene, num_frames, seconds, pid = future.result()
+            frames, busy = per_worker.get(pid, (0, 0.0))
+            per_worker[pid] = (frames + num_frames, busy + seconds)
+            print("[{}/{}] {}: {} frames, {:.1f} frames/s".format(i + 1, len(scenes), scene, num_frames,
+                                                                  num_frames / max(seconds, 1e-6)))
+
+    for pid, (frames, busy) in sorted(per_worker.items()):
+        print("worker {}: {} frames, {:.1f} frames/s".format(pid, frames, frames / max(busy, 1e-6)))
+    total = sum(frames for frames, _ in per_worker.values())
+    print("total: {} frames in {:.1f}s, {:.1f} frames/s".format(total, time.time() - start,
+                                                               total / max(time.time() - start, 1e-6)))
+
+    shards = [os.path.join(shard_dir, scene + ".json") for scene in scenes]
+    items = chain.from_iterable(iter_json_items(shard) for shard in shards)
+    if os.path.isfile(out_path):
+        # merged, the frames of every other scene keep their results
+        tracked = set(token for scene in scenes for token in scene_reader.nusc_info[scene]["frames"])
+        old = BlobStore(out_path)
+        items = chain(items, ((token, boxes) for token, boxes in old.items() if token not in tracked))
+    write_blob_store(out_path, items)
+    shutil.rmtree(shard_dir)
+    print("wrote", out_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="track all scenes offline")
+    parser.add_argument("--scenes", nargs="*", help="scene names, all by default")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--detection-file", default=None, help="detection.detection_file by default")
+    parser.add_argument("--annotation-dir", default=detection.annotation_save_dir)
+    parser.add_argument("--out", default=None, help="track store, the one the server reads by default")
+    args = parser.parse_args()
+    scenes = args.scenes if args.scenes else list(scene_reader.nusc_info.keys())
+    unknown = [s for s in scenes if s not in scene_reader.nusc_info]
+    if unknown:
+        sys.exit("unknown scenes: {}".format(unknown))
+    run(scenes, args.detection_file, args.out, args.workers, args.annotation_dir)
@@ -0,0 +1,195 @@
+import os
+import json
+import mmap
+
+import numpy as np
+
+# Read-only key -> JSON value store in a single file, meant to be memory-mapped by
+# every server process so the pages are shared through the OS page cache.
+# Layout:
+#   magic | value blobs (compact JSON) | sorted keys | starts | lengths | footer json | footer length
+# Keys are looked up with a binary search over the mmapped key array, so opening a
+# store costs nothing but the mmap itself.
+
+magic = b"PCLBLOB1"
+
+
+def write_blob_store(path, items):
+    """Writes (key, value) pairs to path. items may be any iterable, values are
+    serialized one at a time so the whole collection never has to be in memory."""
+    keys = []
+    starts = []
+    lengths = []
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(magic)
+        offset = len(magic)
+        for key, value in items:
+            blob = json.dumps(value, separators=(",", ":"), default=lambda o: o.tolist()).encode("utf-8")
+            keys.append(str(key).encode("utf-8"))
+            starts.append(offset)
+            lengths.append(len(blob))
+            f.write(blob)
+            offset += len(blob)
+
+        key_len = max([len(k) for k in keys] + [1])
+        key_arr = np.array(keys, dtype="S%d" % key_len)
+        order = np.argsort(key_arr, kind="stable")
+        key_arr = key_arr[order]
+        start_arr = np.array(starts, dtype=np.int64)[order]
+        length_arr = np.array(lengths, dtype=np.int64)[order]
+
+        footer = {"count": len(keys), "key_dtype": key_arr.dtype.str}
+        for name, arr in [("keys", key_arr), ("starts", start_arr), ("lengths", length_arr)]:
+            # keep the arrays 8-byte aligned for np.frombuffer
+            pad = (-offset) % 8
+            f.write(b"\0" * pad)
+            offset += pad
+            footer[name] = offset
+            f.write(arr.tobytes())
+            offset += arr.nbytes
+
+        footer = json.dumps(footer).encode("utf-8")
+        f.write(footer)
+        f.write(len(footer).to_bytes(8, "little"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class _JsonReader(object):
+    """Pulls JSON values off a text file chunk by chunk."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        # at least double what is pending, a value larger than a chunk is re-parsed only log(n) times
+        chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of json")
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise ValueError("expected {!r} at {!r}".format(ch, self.buf[self.pos:self.pos + 40]))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_items(path, key=None, chunk_size=1 << 20):
+    """
+    Yields the (key, value) pairs of the top level json object in path, or of the object
+    under key (e.g. "results" of a nuScenes result file), parsing one value at a time.
+    Feeds write_blob_store without loading the whole file.
+    """
+    with open(path, "r") as f:
+        reader = _JsonReader(f, chunk_size)
+        reader.expect("{")
+        if key is not None:
+            while True:
+                if reader.peek() == "}":
+                    raise KeyError(key)
+                name = reader.value()
+                reader.expect(":")
+                if name == key:
+                    reader.expect("{")
+                    break
+                reader.value()
+                if reader.peek() == ",":
+                    reader.pos += 1
+
+        if reader.peek() == "}":
+            return
+        while True:
+            name = reader.value()
+            reader.expect(":")
+            yield name, reader.value()
+            if reader.peek() == "}":
+                return
+            reader.expect(",")
+
+
+class BlobStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._mm[:len(magic)] == magic, "not a blob store: {}".format(path)
+
+        footer_len = int.from_bytes(self._mm[-8:], "little")
+        footer = json.loads(self._mm[-8 - footer_len:-8])
+        count = footer["count"]
+        self._keys = np.frombuffer(self._mm, dtype=footer["key_dtype"], count=count, offset=footer["keys"])
+        self._starts = np.frombuffer(self._mm, dtype=np.int64, count=count, offset=footer["starts"])
+        self._lengths = np.frombuffer(self._mm, dtype=np.int64, count=count, offset=footer["lengths"])
+
+    def _find(self, key):
+        key = str(key).encode("utf-8")
+        i = int(np.searchsorted(self._keys, key))
+        if i < len(self._keys) and self._keys[i] == key:
+            return i
+        return -1
+
+    def get_raw(self, key):
+        i = self._find(key)
+        if i < 0:
+            return None
+        start = int(self._starts[i])
+        return self._mm[start:start + int(self._lengths[i])]
+
+    def get(self, key, default=None):
+        raw = self.get_raw(key)
+        if raw is None:
+            return default
+        return json.loads(raw)
+
+    def __getitem__(self, key):
+        raw = self.get_raw(key)
+        if raw is None:
+            raise KeyError(key)
+        return json.loads(raw)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return [k.decode("utf-8") for k in self._keys]
+
+    def items(self):
+        """Yields the (key, value) pairs in key order, one value parsed at a time."""
+        for key, start, length in zip(self._keys, self._starts.tolist(), self._lengths.tolist()):
+            yield key.decode("utf-8"), json.loads(self._mm[start:start + length])
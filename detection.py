@@ -3,106 +3,135 @@ max_age = 3
 annotation_save_dir = "/home/yaozh/WebstormProjects/my_pcl_annotate/data/nusc/"
 detection_file = "/home/yaozh/WebstormProjects/my_pcl_annotate/infos_trainval_10sweeps_withvelo_filter_True.json"
 thresh = 0.2
+# tracker state is kept every checkpoint_interval frames (and at the last tracked frame) to resume from
+checkpoint_interval = 10
 
 from algos.pub_tracker import PubTracker as Tracker
 import os
 import json
 from scene_reader2 import nusc_info
-import copy
+from track_store import TrackStore
 
 scene_names = list(nusc_info.keys())
 tracker = Tracker(max_age=max_age, hungarian=hungarian, num_scene=len(scene_names),thresh = thresh)
-with open(detection_file, 'r') as f:
-    detection_result = json.load(f)
-detection_result = detection_result["results"]
-has_ann = []
-sizemap=[]
-for i,scene in enumerate(scene_names):
-    tracker.id_manager.setCurrentScene(i)
-    scene_ann = []
-    scene_dir = annotation_save_dir + scene + "/nusc_format/"
+# sample_token -> detections, converted once into a memory-mapped store, frames are read as they are tracked
+detections = TrackStore(detection_file, os.path.splitext(detection_file)[0] + ".blob", results_key="results")
+# frames replaced by saved annotations, sample_token -> boxes
+detection_result = {}
+# per scene, filled on first use by _load_scene. has_ann holds the indices of the annotated frames
+has_ann = [None for _ in scene_names]
+sizemap = [None for _ in scene_names]
+
+
+def scene_annotations(scene_name, save_dir=annotation_save_dir):
+    """Frames saved in nusc_format, frame_token -> boxes. Tracking restarts at each of them."""
+    scene_dir = os.path.join(save_dir, scene_name, "nusc_format")
+    res = {}
+    if os.path.isdir(scene_dir):
+        for file in os.listdir(scene_dir):
+            with open(os.path.join(scene_dir, file), 'r') as f:
+                res.update(json.load(f)["results"])
+    return res
+
+
+def _load_scene(scene_index):
+    if has_ann[scene_index] is not None:
+        return
+    tracker.id_manager.setCurrentScene(scene_index)
+    scene_ann = set()
     scene_size = {}
-    if os.path.exists(scene_dir):
-        exist_files = os.listdir(scene_dir)
-        for file in exist_files:
-            with open(scene_dir + file, 'r') as f:
-                temp_res = json.load(f)
-            token = list(temp_res["results"].keys())[0]
-            scene_ann.append(token)
-            detection_result[token] = temp_res["results"][token]
-            IDs = [int(obj["obj_id"]) for obj in detection_result[token]]
-            tracker.id_manager.addObjectID(IDs)
-            sizelist = [obj["size"] for obj in detection_result[token]]
-            scene_size.update(dict(zip(IDs,sizelist)))
-    has_ann.append(scene_ann)
-    sizemap.append(scene_size)
+    anns = scene_annotations(scene_names[scene_index])
+    _, frame_indices = nusc_info.tokens.locate_many(list(anns.keys()))
+    for (token, boxes), frame in zip(anns.items(), frame_indices.tolist()):
+        if frame < 0:
+            continue
+        scene_ann.add(frame)
+        detection_result[token] = boxes
+        IDs = [int(obj["obj_id"]) for obj in boxes]
+        tracker.id_manager.addObjectID(IDs)
+        sizelist = [obj["size"] for obj in boxes]
+        scene_size.update(dict(zip(IDs,sizelist)))
+    sizemap[scene_index] = scene_size
+    has_ann[scene_index] = scene_ann
+
+
+def get_detections(frame_token):
+    if frame_token in detection_result:
+        return detection_result[frame_token]
+    return detections.get(frame_token, [])
+
+
+# per scene, frame -> tracker.get_state() after tracking that frame
+checkpoints = [{} for _ in scene_names]
+# (scene_index, frame) -> mtime of the nusc_format file last read
+modified_mtime = {}
+
+
+def _load_modified_frame(scene_index, frame):
+    """Reads a frame saved in nusc_format as a new anchor, returns False if it did not change since the last read."""
+    scene_name = "nusc" + str(scene_index + 1)
+    file_name = annotation_save_dir + scene_name + "/nusc_format/" + str(frame) + ".json"
+    mtime = os.path.getmtime(file_name)
+    if modified_mtime.get((scene_index, frame)) == mtime:
+        return False
+    modified_mtime[(scene_index, frame)] = mtime
+
+    frame_token = nusc_info.tokens.frame_token(scene_name, frame)
+    with open(file_name, 'r') as f1:
+        detection_result[frame_token] = json.load(f1)["results"][frame_token]
+    has_ann[scene_index].add(frame)
+    IDs = [int(obj["obj_id"]) for obj in detection_result[frame_token]]
+    tracker.id_manager.addObjectID(IDs)
+    sizelist = [obj["size"] for obj in detection_result[frame_token]]
+    sizemap[scene_index].update(dict(zip(IDs, sizelist)))
+    return True
+
+
+def invalidate(scene_index, frame):
+    """Drops the tracking results and checkpoints at or after frame, everything before stays valid."""
+    for frames in (tracker.has_tracked_list[scene_index], checkpoints[scene_index]):
+        for f in [f for f in frames.keys() if f >= frame]:
+            del frames[f]
 
 
 def track(scene_index, frame_index, has_modified_frames: list):
     tracker.set_scene(scene_index)
+    _load_scene(scene_index)
     scene_name = "nusc" + str(scene_index + 1)
+    timestamps = nusc_info[scene_name]["timestamp"]
+
+    # saved frames become anchors, only the frames after them have to be tracked again
+    for frame in has_modified_frames:
+        if _load_modified_frame(scene_index, frame):
+            invalidate(scene_index, frame)
+
+    if frame_index in tracker.has_tracked_list[scene_index]:
+        return tracker.has_tracked_list[scene_index][frame_index]
+
     # Begin Tracking
-    # First, get the first frame to start tracking
-    # 从以往最近的一次有真实标注数据帧的下一帧开始跟踪
-    start_frame = 0
-    for prev_frame in range(frame_index, -1, -1):
-        frame_token = nusc_info[scene_name]["frames"][prev_frame]
-        if prev_frame in has_modified_frames:
-            file_name = annotation_save_dir + scene_name + "/nusc_format/" + str(prev_frame) + ".json"
-            with open(file_name, 'r') as f1:
-                detection_result[frame_token] = json.load(f1)["results"][frame_token]
-            has_ann[scene_index].append(frame_token)
-            IDs = [int(obj["obj_id"]) for obj in detection_result[frame_token]]
-            tracker.id_manager.addObjectID(IDs)
-            sizelist = [obj["size"] for obj in detection_result[frame_token]]
-            sizemap[scene_index].update(dict(zip(IDs,sizelist)))
-            start_frame = prev_frame
-            tracker.reset()
-            break
-
-        if frame_token in has_ann[scene_index]:
-            start_frame = prev_frame
-            tracker.reset()
-            break
-
-    if start_frame == 0:
-        if len(tracker.has_tracked_list[scene_index]):
-            has_tracked_frameIndex = list(tracker.has_tracked_list[scene_index].keys())
-            start_frame = has_tracked_frameIndex[-1]
-            if start_frame >= frame_index:
-                if frame_index in has_tracked_frameIndex:
-                    return tracker.has_tracked_list[scene_index][frame_index]
-                else:
-                    tracker.reset()
-                    # if this frame has not been tracked, we find the last frame has been tracked before this frame
-                    i = -1
-                    for frame in has_tracked_frameIndex:
-                        if frame > frame_index:
-                            break
-                        i += 1
-                    if i > -1:
-                        start_frame = has_tracked_frameIndex[i]
-                        detection_result[nusc_info[scene_name]["frames"][start_frame]] = tracker.has_tracked_list[scene_index][start_frame]
-                    else:
-                        start_frame = 0
-            else:
-                detection_result[nusc_info[scene_name]["frames"][start_frame]] = tracker.has_tracked_list[scene_index][
-                    start_frame]
-        else:
-            start_frame = 0
-
-    if start_frame == 0:
-        tracker.reset()
+    # 从以往最近的一次有真实标注数据帧开始跟踪, 有更近的检查点则从检查点继续
+    anchor = max([f for f in has_ann[scene_index] if f <= frame_index], default=0)
 
-    last_time_stamp = nusc_info[scene_name]['timestamp'][start_frame]
+    resume = max([f for f in checkpoints[scene_index].keys() if anchor <= f < frame_index], default=None)
+    if resume is None:
+        tracker.reset()
+        start_frame = anchor
+        last_time_stamp = timestamps[anchor]
+    else:
+        tracker.set_state(checkpoints[scene_index][resume])
+        start_frame = resume + 1
+        last_time_stamp = timestamps[resume]
+        if resume % checkpoint_interval != 0:
+            # an old head checkpoint, the new head replaces it
+            del checkpoints[scene_index][resume]
 
     for track_frame in range(start_frame, frame_index + 1):
-        timestamp = nusc_info[scene_name]["timestamp"][track_frame]
-        track_token = nusc_info[scene_name]["frames"][track_frame]
-        det = copy.deepcopy(detection_result[track_token])
+        timestamp = timestamps[track_frame]
+        track_token = nusc_info.tokens.frame_token(scene_name, track_frame)
         time_lag = (timestamp - last_time_stamp)
         last_time_stamp = timestamp
-        outputs = tracker.step_centertrack(det, time_lag)
+        # the tracker copies what it keeps, the detections are not modified
+        outputs = tracker.step_centertrack(get_detections(track_token), time_lag)
         annos = []
         for item in outputs:
             if item['active'] == 0:
@@ -121,5 +150,7 @@ def track(scene_index, frame_index, has_modified_frames: list):
             }
             annos.append(nusc_anno)
         tracker.has_tracked_list[scene_index][track_frame] = annos
+        if track_frame % checkpoint_interval == 0 or track_frame == frame_index:
+            checkpoints[scene_index][track_frame] = tracker.get_state()
 
-    return tracker.has_tracked_list[scene_index][frame_index]
\ No newline at end of file
+    return tracker.has_tracked_list[scene_index][frame_index]
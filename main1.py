@@ -3,19 +3,43 @@ import string
 import cherrypy
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from jinja2 import Environment, FileSystemLoader
 
 env = Environment(loader=FileSystemLoader('./'))
-import algos.track
 import os
 import sys
 import scene_reader2 as scene_reader
-from tools.my_nuscenes_converter import SUSTECH_det_to_nusc_box, nusc_det_to_nusc_box, nusc_box_to_SUSTECH
+from obj_stats import ObjStatsCache
+from annotation_writer import writer
+from track_session import TrackSessionManager
+import pointcloud_service
+from tools.my_nuscenes_converter import SUSTECH_det_to_box_array, nusc_det_to_nusc_box, nusc_box_to_SUSTECH
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(BASE_DIR)
 sys.path.append(os.path.join(BASE_DIR, './algos'))
 
+# shared by all request threads, reads label/track files for batch loading
+read_pool = ThreadPoolExecutor(max_workers=8)
+
+obj_stats = ObjStatsCache()
+
+# /iter_centertrack state per (session, scene), spilled to disk so all workers share it
+track_sessions = TrackSessionManager(os.path.join(os.getcwd(), "tmp/track_sessions"))
+os.makedirs(os.path.join(os.getcwd(), "tmp/sessions"), exist_ok=True)
+
+
+def _mtime(path):
+    return os.path.getmtime(path) if os.path.exists(path) else 0
+
+
+def _write_labels(items):
+    # the frames of a request are on disk once it returns, a failed frame fails the request
+    failed = writer.write(items)
+    if failed:
+        raise cherrypy.HTTPError(500, "saving failed: " + ", ".join(
+            "{} ({})".format(os.path.basename(path), e) for path, e in failed))
 
 
 class Root(object):
@@ -51,7 +75,7 @@ class Root(object):
         scene = d["scene"]
         frame = d["frame"]
         ann = d["annotation"]
-        boxes = SUSTECH_det_to_nusc_box(ann)
+        boxes = SUSTECH_det_to_box_array(ann)
         annos, token = scene_reader._lidar_nusc_box_to_global(boxes, scene, frame)
         nusc_path = os.path.join(os.getcwd(), "data/nusc/" + scene + "/nusc_format/")
         os.makedirs(nusc_path, exist_ok=True)
@@ -66,18 +90,19 @@ class Root(object):
         rawbody = cherrypy.request.body.readline().decode('UTF-8')
         text = json.loads(rawbody)
         data = text["ann"]
+        items = []
         for d in data:
             scene = d["scene"]
             frame = d["frame"]
-            ann =  [{"frame_token":scene_reader.nusc_info[scene]["frames"][frame]}]
+            ann =  [{"frame_token":scene_reader.nusc_info.tokens.frame_token(scene, frame)}]
             ann += d["annotation"]
             if scene[:4] == "nusc":
                 path = os.path.join(os.getcwd(), "data/final/nusc/" + scene + "/label/")
             else:
                 path = os.path.join(os.getcwd(), "data/final/" + scene + "/label/")
-            os.makedirs(path, exist_ok=True)
-            with open(path + str(frame) + ".json", 'w') as f:
-                json.dump(ann, f)
+            # the final labels are not read back by read_annotations, the object counts stay valid
+            items.append((path + str(frame) + ".json", ann, None))
+        _write_labels(items)
 
     @cherrypy.expose
     def saveworldlist(self):
@@ -86,6 +111,7 @@ class Root(object):
         text = json.loads(rawbody)
         data = text["ann"]
         save_nusc = text["save_nusc"]
+        items = []
         for d in data:
             scene = d["scene"]
             frame = d["frame"]
@@ -96,9 +122,9 @@ class Root(object):
                 path = os.path.join(os.getcwd(), "data/" + scene + "/label/")
             else:
                 path = os.path.join(os.getcwd(), "tmp/nusc/" + scene + "/label/")
-            os.makedirs(path, exist_ok=True)
-            with open(path + str(frame) + ".json", 'w') as f:
-                json.dump(ann, f, indent=2)
+            items.append((path + str(frame) + ".json", ann,
+                          lambda scene=scene, frame=frame: obj_stats.update_frame(scene, str(frame))))
+        _write_labels(items)
         #                 boxes = SUSTECH_det_to_nusc_box(ann)
         #                 annos,token = scene_reader._lidar_nusc_box_to_global(boxes, scene, frame)
         #                 nusc_path = os.path.join(os.getcwd(),"data/nusc/"+scene+"/nusc_format/")
@@ -129,6 +155,62 @@ class Root(object):
                         worldlist))
         return anns
 
+    @cherrypy.expose
+    @cherrypy.config(**{'response.stream': True})
+    def loadworldlist_stream(self, mode):
+        rawbody = cherrypy.request.body.readline().decode('UTF-8')
+        worldlist = json.loads(rawbody)
+
+        def read_one(w):
+            return {
+                "scene": w["scene"],
+                "frame": w["frame"],
+                "annotation": scene_reader.read_annotations(w["scene"], w["frame"], mode)}
+
+        futures = dict((read_pool.submit(read_one, w), w) for w in worldlist)
+
+        # one json object per line, written as soon as each frame is read. The status is sent before the
+        # frames are read, a frame that fails to load is sent as {"scene", "frame", "error"} instead.
+        def stream():
+            for future in as_completed(futures):
+                w = futures[future]
+                try:
+                    res = future.result()
+                except Exception as e:
+                    res = {"scene": w["scene"], "frame": w["frame"], "error": "{}: {}".format(type(e).__name__, e)}
+                yield (json.dumps(res) + "\n").encode('utf-8')
+
+        cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+        return stream()
+
+    @cherrypy.expose
+    def load_points(self, scene, frame, lod="0", max_z=None):
+        # binary, quantized points, see pointcloud_service.py for the layout
+        path = scene_reader.get_lidar_path(scene, frame)
+        if path is None or not os.path.isfile(path):
+            raise cherrypy.NotFound()
+        encoding = pointcloud_service.pick_encoding(cherrypy.request.headers.get('Accept-Encoding'))
+        buf = pointcloud_service.get_points_buffer(path, int(lod), float(max_z) if max_z else None, encoding)
+        cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+        if encoding is not None:
+            cherrypy.response.headers['Content-Encoding'] = encoding
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        return buf
+
+    @cherrypy.expose
+    def load_sweeps(self, scene, frame, nsweeps="5", lod="0", max_z=None):
+        # the frame and nsweeps - 1 frames before it in its lidar coordinates, same layout as load_points
+        sweeps = scene_reader.get_sweeps(scene, frame, max(int(nsweeps), 1))
+        if any(path is None or not os.path.isfile(path) for path, _, _ in sweeps):
+            raise cherrypy.NotFound()
+        encoding = pointcloud_service.pick_encoding(cherrypy.request.headers.get('Accept-Encoding'))
+        buf = pointcloud_service.get_sweeps_buffer(sweeps, int(lod), float(max_z) if max_z else None, encoding)
+        cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+        if encoding is not None:
+            cherrypy.response.headers['Content-Encoding'] = encoding
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        return buf
+
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def scenemeta(self, scene):
@@ -144,40 +226,41 @@ class Root(object):
             for file in os.listdir(file_dir):
                 with open(os.path.join(file_dir, file), 'r') as f:
                     res = json.load(f)
-                res_list.update({scene_reader.nusc_info[scene_name]["frames"][int(file[:file.rfind('.')])]: res})
+                res_list.update({scene_reader.nusc_info.tokens.frame_token(scene_name, file[:file.rfind('.')]): res})
             return res_list
         else:
             return []
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
-    def iter_centertrack(self, change, batch_mode):
-        algos.track.unknown_num = 0
+    def iter_centertrack(self, change, batch_mode, scene=""):
         rawbody = cherrypy.request.body.readline().decode('UTF-8')
         json_dict = json.loads(rawbody)
-        last_time_stamp = json_dict[0]["dets"][0]["timestamp"]
-        if change=="true":
-            algos.track.has_tracked_tracks = {}
         batch_mode = True if batch_mode == "true" else False
 
-        if json_dict[-1]["frame_index"] in algos.track.has_tracked_tracks.keys() and not batch_mode:
-            return [{'obj_id':item['obj_id'],'det_index':item["det_index"]} for item in algos.track.has_tracked_tracks[json_dict[-1]["frame_index"]] if item["active"] != 0]
-
-        annos = []
-        for det in json_dict:
-            timestamp = det["dets"][0]["timestamp"]
-            time_lag = timestamp - last_time_stamp
-            last_time_stamp = timestamp
-            if det["frame_index"] in algos.track.has_tracked_tracks.keys():
-                outputs = algos.track.has_tracked_tracks[det["frame_index"]]
-            elif len(json_dict) ==1:
-                return [{'obj_id':item['obj_id'],'det_index':det_index} for det_index,item in enumerate(det["dets"])]
-            else:
-                outputs = algos.track.step_centertrack(det["dets"], time_lag,det["frame_index"])
-            if batch_mode:
-                annos.append(outputs)
-        if not batch_mode:
+        # file sessions, so every worker sees the same id; storing a key makes sure it is saved
+        cherrypy.session["track_scene"] = scene
+        session = track_sessions.get(cherrypy.session.id, scene)
+        if change == "true":
+            # the client asks for a fresh track of the scene
+            with session.lock:
+                session.reset()
+            track_sessions.put(cherrypy.session.id, scene, session)
+        if len(json_dict) == 1 and not batch_mode:
+            # a single frame is answered from the session if it was tracked with these dets, else as posted
+            with session.lock:
+                outputs = session.cached(json_dict[0]["frame_index"], json_dict[0]["dets"])
+            if outputs is None:
+                return [{'obj_id':item['obj_id'],'det_index':det_index} for det_index,item in enumerate(json_dict[0]["dets"])]
             return [{'obj_id':item['obj_id'],'det_index':item["det_index"]} for item in outputs if item["active"] != 0]
+
+        with session.lock:
+            # edited frames are found by their input digests and re-run with the frames after them
+            annos = session.run(json_dict)
+        track_sessions.put(cherrypy.session.id, scene, session)
+
+        if not batch_mode:
+            return [{'obj_id':item['obj_id'],'det_index':item["det_index"]} for item in annos[-1] if item["active"] != 0]
         else:
             return [[{'obj_id':item['obj_id'],'det_index':item["det_index"]} for item in outputs if item["active"] != 0] for outputs in annos]
 
@@ -190,24 +273,18 @@ class Root(object):
     @cherrypy.tools.json_out()
     def objs_of_scene(self, scene,mode):
         if scene[:4] == "nusc":
-            num_frame = len(scene_reader.nusc_info[scene]["frames"])
-            all_objs = {}
-            for frame in range(num_frame):
-                anns = scene_reader.read_annotations(scene, str(frame),mode)["anns"]
-                for ann in anns:
-                    if "obj_type" not in ann.keys():
-                        continue
-                    k = ann["obj_type"] + "-" + str(ann["obj_id"])
-                    if all_objs.get(k):
-                        all_objs[k]["count"] +=1
-                    else:
-                        all_objs[k] = {
-                            "category": ann["obj_type"],
-                            "id": ann["obj_id"],
-                            "count": 1
-                        }
-
-            return [x for x in all_objs.values()]
+            num_frame = scene_reader.nusc_info.tokens.num_frames(scene)
+
+            # saves through this server update the cache directly, files added by anything else
+            # change the label directory mtimes and rebuild the entry
+            def stamp():
+                return (_mtime(os.path.join(os.getcwd(), "data/nusc/" + scene + "/label/")),
+                        _mtime(os.path.join(os.getcwd(), "tmp/nusc/" + scene + "/label/")),
+                        _mtime(scene_reader.track_res.store_path))
+
+            return obj_stats.get((scene, mode), [str(frame) for frame in range(num_frame)],
+                                 lambda frame: scene_reader.read_annotations(scene, frame, mode)["anns"],
+                                 stamp)
         else:
             return self.get_all_objs(os.path.join("./data", scene))
 
@@ -217,32 +294,14 @@ class Root(object):
             return []
 
         files = os.listdir(label_folder)
+        frames = [os.path.splitext(f)[0] for f in files if f.split(".")[-1] == "json"]
+
+        def read_frame(frame):
+            boxes = writer.read_json(os.path.join(label_folder, frame + ".json"))
+            return boxes if boxes is not None else []
 
-        files = filter(lambda x: x.split(".")[-1] == "json", files)
-
-        def file_2_objs(f):
-            with open(f) as fd:
-                boxes = json.load(fd)
-                objs = [x for x in map(lambda b: {"category": b["obj_type"], "id": b["obj_id"]}, boxes)]
-                return objs
-
-        boxes = map(lambda f: file_2_objs(os.path.join(path, "label", f)), files)
-
-        # the following map makes the category-id pairs unique in scene
-        all_objs = {}
-        for x in boxes:
-            for o in x:
-                k = str(o["category"]) + "-" + str(o["id"])
-                if all_objs.get(k):
-                    all_objs[k]['count'] = all_objs[k]['count'] + 1
-                else:
-                    all_objs[k] = {
-                        "category": o["category"],
-                        "id": o["id"],
-                        "count": 1
-                    }
-
-        return [x for x in all_objs.values()]
+        return obj_stats.get((os.path.basename(os.path.normpath(path)), "normal"), frames, read_frame,
+                             lambda: _mtime(label_folder))
 
 
 if __name__ == '__main__':
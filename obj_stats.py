@@ -0,0 +1,77 @@
+import threading
+
+# Category-id counts shown in the object list, cached per scene. Counts are kept per
+# frame so a saved frame only re-counts itself, and each entry carries a stamp (label
+# directory / track store mtimes) that invalidates it when files change behind our back.
+
+
+def frame_objs(anns):
+    objs = {}
+    for ann in anns:
+        if "obj_type" not in ann.keys():
+            continue
+        k = str(ann["obj_type"]) + "-" + str(ann["obj_id"])
+        if objs.get(k):
+            objs[k]["count"] += 1
+        else:
+            objs[k] = {
+                "category": ann["obj_type"],
+                "id": ann["obj_id"],
+                "count": 1
+            }
+    return objs
+
+
+class ObjStatsCache(object):
+    def __init__(self):
+        self._scenes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, frames, read_frame, stamp_fn):
+        """
+        :param key: (scene, mode)
+        :param frames: frame names of the scene, only used when the entry is (re)built.
+        :param read_frame: frame -> list of boxes.
+        :param stamp_fn: () -> anything comparable, the entry is rebuilt when it changes.
+        """
+        stamp = stamp_fn()
+        with self._lock:
+            entry = self._scenes.get(key)
+            if entry is not None and entry["stamp"] == stamp:
+                return [dict(o) for o in entry["total"].values()]
+
+        entry = {"stamp": stamp, "read_frame": read_frame, "stamp_fn": stamp_fn, "frames": {}, "total": {}}
+        for frame in frames:
+            self._set_frame(entry, frame, frame_objs(read_frame(frame)))
+        with self._lock:
+            self._scenes[key] = entry
+            return [dict(o) for o in entry["total"].values()]
+
+    def update_frame(self, scene, frame):
+        """Re-counts one frame of every cached entry of the scene, called after the frame was written."""
+        with self._lock:
+            entries = [entry for key, entry in self._scenes.items() if key[0] == scene]
+        for entry in entries:
+            objs = frame_objs(entry["read_frame"](frame))
+            with self._lock:
+                self._set_frame(entry, frame, objs)
+                entry["stamp"] = entry["stamp_fn"]()
+
+    def invalidate(self, scene):
+        with self._lock:
+            for key in [key for key in self._scenes.keys() if key[0] == scene]:
+                del self._scenes[key]
+
+    @staticmethod
+    def _set_frame(entry, frame, objs):
+        total = entry["total"]
+        for k, o in entry["frames"].get(frame, {}).items():
+            total[k]["count"] -= o["count"]
+            if total[k]["count"] == 0:
+                del total[k]
+        for k, o in objs.items():
+            if k in total:
+                total[k]["count"] += o["count"]
+            else:
+                total[k] = dict(o)
+        entry["frames"][frame] = objs
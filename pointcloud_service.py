@@ -0,0 +1,194 @@
+import os
+import gzip
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from tools.my_nuscenes.utils.data_io import read_pcd
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Server-side point loading for the /load_points endpoint. Clouds are read with numpy,
+# optionally voxel-downsampled and z-filtered, and sent as a compact binary buffer:
+#   header  <4s I 3f 3f f>  magic b"PCLT", point count, xyz offset, xyz scale, intensity scale
+#   xyz     uint16 * 3 * count, position = offset + value * scale
+#   intens  uint8 * count, intensity = value * intensity scale
+
+# voxel edge length (m) per level of detail, 0 keeps every point
+lod_voxel_size = [0, 0.05, 0.1, 0.2, 0.4]
+cache_bytes = 256 * 1024 * 1024
+sweeps_cache_bytes = 512 * 1024 * 1024
+
+header_format = "<4sI3f3ff"
+
+
+def load_points(file_name):
+    """Returns <np.float32: n, 4> x, y, z, intensity."""
+    if file_name.endswith(".pcd.bin"):
+        # nuScenes, x y z intensity ring
+        return np.fromfile(file_name, dtype=np.float32).reshape(-1, 5)[:, :4]
+    if file_name.endswith(".bin"):
+        # kitti style, x y z intensity
+        return np.fromfile(file_name, dtype=np.float32).reshape(-1, 4)
+
+    pcd = read_pcd(file_name)
+    points = np.zeros((len(pcd), 4), dtype=np.float32)
+    for i, name in enumerate(["x", "y", "z"]):
+        points[:, i] = pcd[name]
+    if "intensity" in pcd.dtype.names:
+        points[:, 3] = pcd["intensity"]
+    return points[np.isfinite(points[:, :3]).all(axis=1)]
+
+
+def voxel_downsample(points, voxel_size):
+    """Keeps the first point of every occupied voxel."""
+    if voxel_size <= 0 or len(points) == 0:
+        return points
+    q = np.floor(points[:, :3] / voxel_size).astype(np.int64)
+    q -= q.min(axis=0)
+    keys = np.ravel_multi_index(q.T, q.max(axis=0) + 1)
+    _, first = np.unique(keys, return_index=True)
+    return points[np.sort(first)]
+
+
+def encode_points(points):
+    count = len(points)
+    if count:
+        lo = points[:, :3].min(axis=0)
+        hi = points[:, :3].max(axis=0)
+    else:
+        lo = hi = np.zeros(3, np.float32)
+    scale = np.maximum(hi - lo, 1e-6) / 65535.0
+    xyz = np.round((points[:, :3] - lo) / scale).astype(np.uint16)
+
+    # nuScenes intensity is 0..255, some pcd exports are normalized to 0..1
+    max_intensity = float(points[:, 3].max()) if count else 0.0
+    intensity_scale = 1.0 / 255 if 0 < max_intensity <= 1.0 else 1.0
+    intensity = np.clip(np.round(points[:, 3] / intensity_scale), 0, 255).astype(np.uint8)
+
+    header = struct.pack(header_format, b"PCLT", count, *lo.tolist(), *scale.tolist(), intensity_scale)
+    return header + xyz.tobytes() + intensity.tobytes()
+
+
+def _sizeof(value):
+    return value.nbytes if isinstance(value, np.ndarray) else len(value)
+
+
+class PointsCache(object):
+    """LRU of encoded buffers (or arrays) bounded by total size."""
+
+    def __init__(self, max_bytes=cache_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        return None
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= _sizeof(self._items.pop(key))
+            self._items[key] = value
+            self.nbytes += _sizeof(value)
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self.nbytes -= _sizeof(old)
+
+
+cache = PointsCache()
+# decoded sweeps, reused by every key frame that aggregates them
+sweeps_cache = PointsCache(sweeps_cache_bytes)
+
+
+def load_sweep(file_name, min_distance=1.0):
+    """load_points without the returns within min_distance of the sensor (the ego vehicle), cached."""
+    key = (file_name, os.path.getmtime(file_name), min_distance)
+    points = sweeps_cache.get(key)
+    if points is None:
+        points = load_points(file_name)
+        if min_distance > 0:
+            near = (np.abs(points[:, 0]) < min_distance) & (np.abs(points[:, 1]) < min_distance)
+            points = points[~near]
+        sweeps_cache.put(key, points)
+    return points
+
+
+def aggregate_sweeps(sweeps, min_distance=1.0):
+    """
+    Fuses several sweeps into one reference frame.
+    :param sweeps: [(file_name, <4x4> ref_from_sweep, time_lag)], key frame first.
+    :param min_distance: Distance below which points are discarded.
+    :return: <np.float32: n, 5> x, y, z, intensity, time lag.
+    """
+    clouds = [(load_sweep(file_name, min_distance), np.asarray(trans), time_lag)
+              for file_name, trans, time_lag in sweeps]
+    res = np.empty((sum(len(points) for points, _, _ in clouds), 5), dtype=np.float32)
+    start = 0
+    for points, trans, time_lag in clouds:
+        end = start + len(points)
+        res[start:end, :3] = points[:, :3] @ trans[:3, :3].T + trans[:3, 3]
+        res[start:end, 3] = points[:, 3]
+        res[start:end, 4] = time_lag
+        start = end
+    return res
+
+
+def _get_buffer(key, make_points, lod, max_z, encoding):
+    lod = min(max(int(lod), 0), len(lod_voxel_size) - 1)
+    key = key + (lod, max_z)
+    buf = cache.get(key + (encoding,))
+    if buf is not None:
+        return buf
+
+    raw = cache.get(key + (None,))
+    if raw is None:
+        points = make_points()
+        if max_z is not None:
+            points = points[points[:, 2] < max_z]
+        points = voxel_downsample(points, lod_voxel_size[lod])
+        raw = encode_points(points)
+        cache.put(key + (None,), raw)
+
+    if encoding == "br":
+        buf = brotli.compress(raw, quality=4)
+    elif encoding == "gzip":
+        buf = gzip.compress(raw, compresslevel=4)
+    else:
+        return raw
+    cache.put(key + (encoding,), buf)
+    return buf
+
+
+def get_points_buffer(file_name, lod=0, max_z=None, encoding=None):
+    """
+    Returns the encoded (and optionally compressed) points of a frame, cached per file, lod and filter.
+    :param encoding: None, "gzip" or "br".
+    """
+    key = (file_name, os.path.getmtime(file_name))
+    return _get_buffer(key, lambda: load_points(file_name), lod, max_z, encoding)
+
+
+def get_sweeps_buffer(sweeps, lod=0, max_z=None, encoding=None, min_distance=1.0):
+    """Same as get_points_buffer for the aggregate of sweeps, see aggregate_sweeps."""
+    key = ("sweeps", min_distance) + tuple((file_name, os.path.getmtime(file_name)) for file_name, _, _ in sweeps)
+    return _get_buffer(key, lambda: aggregate_sweeps(sweeps, min_distance), lod, max_z, encoding)
+
+
+def pick_encoding(accept_encoding):
+    accepted = [e.split(";")[0].strip() for e in (accept_encoding or "").split(",")]
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
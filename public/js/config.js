@@ -23,6 +23,10 @@ class Config{
 
     enableFilterPoints = false;
     filterPointsZ = 2.0;
+    // level of detail for points served by /load_points, -1 loads the raw point cloud files
+    serverPointsLod = -1;
+    // with serverPointsLod >= 0, aggregate this many sweeps (the frame and the ones before it)
+    serverSweeps = 1;
 
     batchModeInstNumber = 20;
     batchModeSubviewSize = {width: 130, height: 450};
@@ -104,6 +108,8 @@ class Config{
         ["enableAuxLidar", this.toBool],
         ["enableFilterPoints", this.toBool],
         ["filterPointsZ", parseFloat],
+        ["serverPointsLod", parseInt],
+        ["serverSweeps", parseInt],
         ["color_points", null],
         ["batchModeInstNumber", parseInt],
         ["batchModeSubviewSize", JSON.parse],
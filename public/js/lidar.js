@@ -55,18 +55,51 @@ function Lidar(sceneMeta, world, frameInfo){
         return pcd;
     };
 
+    // points from the /load_points endpoint, downsampled and z-filtered on the server.
+    // layout: magic, count, xyz offset, xyz scale, intensity scale, uint16 xyz, uint8 intensity
+    this.load_server_points = function(on_load, on_error){
+        let cfg = this.data.cfg;
+        let frame = this.frameInfo.scene.substring(0,4) == 'nusc' ? this.frameInfo.frame_index : this.frameInfo.frame;
+        let url = `/load_points?scene=${this.frameInfo.scene}&frame=${frame}&lod=${cfg.serverPointsLod}`;
+        if (cfg.serverSweeps > 1)
+            url = `/load_sweeps?scene=${this.frameInfo.scene}&frame=${frame}&nsweeps=${cfg.serverSweeps}&lod=${cfg.serverPointsLod}`;
+        if (cfg.enableFilterPoints)
+            url += `&max_z=${cfg.filterPointsZ}`;
+
+        fetch(url).then(res=>{
+            if (!res.ok)
+                throw new Error(`load points failed, status : ${res.status}`);
+            return res.arrayBuffer();
+        }).then(buf=>{
+            let header = new DataView(buf, 0, 36);
+            let count = header.getUint32(4, true);
+            let offset = [0,1,2].map(i=>header.getFloat32(8 + i*4, true));
+            let scale = [0,1,2].map(i=>header.getFloat32(20 + i*4, true));
+            let intensity_scale = header.getFloat32(32, true);
+            let xyz = new Uint16Array(buf, 36, count*3);
+            let intens = new Uint8Array(buf, 36 + count*6, count);
+
+            let position = new Float32Array(count*3);
+            for (let i = 0; i < count*3; i++)
+                position[i] = offset[i%3] + xyz[i]*scale[i%3];
+            let intensity = new Float32Array(count);
+            for (let i = 0; i < count; i++)
+                intensity[i] = intens[i]*intensity_scale;
+
+            on_load({position: position, intensity: intensity, color: [], normal: [], filtered: true});
+        }).catch(on_error);
+    };
+
     this.preload=function(on_preload_finished){
         this.on_preload_finished = on_preload_finished;
 
         var loader = new PCDLoader();
 
         var _self = this;
-        loader.load(this.frameInfo.get_pcd_path(),
-            //ok
-            function ( pcd ) {
+        var on_load = function ( pcd ) {
                 _self.points_parse_time = new Date().getTime();
                 // console.log(_self.points_load_time, _self.frameInfo.scene, _self.frameInfo.frame, "parse pionts ", _self.points_parse_time - _self.create_time, "ms");
-                if (_self.data.cfg.enableFilterPoints)// do some filtering work here
+                if (_self.data.cfg.enableFilterPoints && !pcd.filtered)// do some filtering work here
                 {
                     pcd = _self.remove_high_ponts(pcd, _self.data.cfg.filterPointsZ);
                 }
@@ -140,7 +173,19 @@ function Lidar(sceneMeta, world, frameInfo){
                 // console.log(_self.points_load_time, _self.frameInfo.scene, _self.frameInfo.frame, "loaded pionts ", _self.points_load_time - _self.create_time, "ms");
 
                 _self._afterPreload();
-            },
+            };
+
+        if (this.data.cfg.serverPointsLod >= 0){
+            this.load_server_points(on_load, function(e){
+                console.log("load pcd failed.", e);
+                _self._afterPreload();
+            });
+            return;
+        }
+
+        loader.load(this.frameInfo.get_pcd_path(),
+            //ok
+            on_load,
 
             // on progress,
             function(){
@@ -1,43 +1,28 @@
 
 
 function reloadWorldList(worldList, done,obj_id){
-    var xhr = new XMLHttpRequest();
-        // we defined the xhr
-    xhr.onreadystatechange = function () {
-        if (this.readyState != 4) return;
-    
-        if (this.status == 200) {
-            let anns = JSON.parse(this.responseText);
-            // load annotations
-            anns.forEach(a=>{
-                let world =worldList.find(w=>{
-                        if(w.frameInfo.scene.substring(0,4)=="nusc")
-                            return (w.frameInfo.scene == a.scene &&
-                                w.frameInfo.frame_index == Number(a.frame));
-                        else
-                            return (w.frameInfo.scene == a.scene &&
-                                w.frameInfo.frame == a.frame);
-                    });
-                if (world) {
-                    if(world.data.cfg.mode=="test" && Number(a.frame)%world.data.cfg.testNFrame !==0 )
-                        world.annotation.reapplyAnnotation([]);
-                    else{
-                        if(obj_id)
-                            world.annotation.reapplyAnnotation(a.annotation.anns.filter(a=>a.obj_id==obj_id),null,true,obj_id);
-                        else
-                            world.annotation.reapplyAnnotation(a.annotation.anns);
-                    }
-                    window.editor.infoBox.show("Notice", "Reload Success")
-                }
+    // load annotations of one frame, called as soon as its line arrives in the stream
+    let applyAnnotation = function(a){
+        let world =worldList.find(w=>{
+                if(w.frameInfo.scene.substring(0,4)=="nusc")
+                    return (w.frameInfo.scene == a.scene &&
+                        w.frameInfo.frame_index == Number(a.frame));
+                else
+                    return (w.frameInfo.scene == a.scene &&
+                        w.frameInfo.frame == a.frame);
             });
-            if(window.editor.tracker)
-                window.editor.tracker.reload(worldList,obj_id)
-            if (done)
-                done();
+        if (world) {
+            if(world.data.cfg.mode=="test" && Number(a.frame)%world.data.cfg.testNFrame !==0 )
+                world.annotation.reapplyAnnotation([]);
+            else{
+                if(obj_id)
+                    world.annotation.reapplyAnnotation(a.annotation.anns.filter(a=>a.obj_id==obj_id),null,true,obj_id);
+                else
+                    world.annotation.reapplyAnnotation(a.annotation.anns);
+            }
+            window.editor.infoBox.show("Notice", "Reload Success")
         }
     };
-    
-    xhr.open('POST', "/loadworldlist?mode="+window.editor.data.cfg.mode, true);
 
     let para = worldList.map(w=>{
         if(w.frameInfo.scene.substring(0,4)=="nusc")
@@ -49,7 +34,59 @@ function reloadWorldList(worldList, done,obj_id){
                 frame: w.frameInfo.frame,
             };
     });
-    xhr.send(JSON.stringify(para));
+
+    // frames come back as newline-delimited json, in the order the server finishes reading them
+    fetch("/loadworldlist_stream?mode="+window.editor.data.cfg.mode, {method: "POST", body: JSON.stringify(para)})
+    .then(async res=>{
+        if (!res.ok){
+            window.editor.infoBox.show("Error", `reload failed, status : ${res.status}`);
+            return;
+        }
+
+        // a frame the server failed to read comes as {scene, frame, error}
+        let received = 0;
+        let failed = [];
+        let applyLine = function(l){
+            let a = JSON.parse(l);
+            received += 1;
+            if (a.error)
+                failed.push(`${a.scene} ${a.frame}: ${a.error}`);
+            else
+                applyAnnotation(a);
+        };
+
+        let reader = res.body.getReader();
+        let decoder = new TextDecoder();
+        let buffer = "";
+        try{
+            while (true){
+                let {value, done: finished} = await reader.read();
+                if (value)
+                    buffer += decoder.decode(value, {stream: true});
+
+                let lines = buffer.split("\n");
+                buffer = lines.pop();
+                lines.filter(l=>l.length>0).forEach(applyLine);
+
+                if (finished)
+                    break;
+            }
+        }
+        catch(e){
+            failed.push(`stream interrupted: ${e}`);
+        }
+        if (received < para.length && failed.length == 0)
+            failed.push(`${para.length - received} frames missing`);
+        if (failed.length > 0){
+            window.editor.infoBox.show("Error", "reload failed for " + failed.join(", "));
+            return;
+        }
+
+        if(window.editor.tracker)
+            window.editor.tracker.reload(worldList,obj_id)
+        if (done)
+            done();
+    });
 }
 
 
@@ -120,6 +157,7 @@ function doSaveWorldList(worldList, done,save_nusc = false,async = true)
                 if(save_nusc && window.editor.tracker)
                     window.editor.tracker.update_after_save(w.frameInfo.scene,w.frameInfo.frame,w.annotation.toBoxAnnotations())
             })
+            // the server answers once the frames are on disk
             if(save_nusc)
                 window.editor.infoBox.show("Save","Save final result success in this frame")
             else
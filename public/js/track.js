@@ -231,7 +231,7 @@ function tracker(cfg){
             }
         }
 
-        xhr.open('POST', `/iter_centertrack?change=${this.change}&batch_mode=${batch_mode}`, true);
+        xhr.open('POST', `/iter_centertrack?change=${this.change}&batch_mode=${batch_mode}&scene=${scene}`, true);
         let para = []
         for (let track_frame = start_frame; track_frame <= frame_index; track_frame++) {
             let tracktoken = window.editor.data.meta[scene]["frames"][track_frame];
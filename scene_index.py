@@ -0,0 +1,320 @@
+import os
+import json
+import fcntl
+import pickle
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from blob_store import BlobStore, write_blob_store
+
+# On-disk scene index built from the SUSTech_data_infos*_real.pkl produced by
+# tools/my_nuscenes_converter.py. Layout:
+#   <index_dir>/manifest.json          scene names, frame counts, source pkl
+#   <index_dir>/<scene>/<column>.npy   per-frame numeric columns, memory-mapped
+#   <index_dir>/<scene>/anns/*.npy     ground truth boxes of all frames as one table, see BoxTable
+#   <index_dir>/<scene>/sweeps/*.npy   lidar sweeps before each frame as one table, see sweep_columns
+#   <index_dir>/meta.blob              everything else (frames, paths, calib, ...) keyed by scene
+#   <index_dir>/tokens/*.npy           frame token index, see FrameTokenIndex
+# Every file is opened read-only and memory-mapped, so all uwsgi workers share one
+# copy of the scene metadata through the page cache.
+
+pose_columns = ["lidar2ego", "ego2lidar", "global2ego", "ego2global"]
+columns = pose_columns + ["timestamp"]
+# rows of frame i are offsets[i]:offsets[i + 1], psr is position xyz, scale xyz, rotation xyz
+box_columns = ["offsets", "psr", "velocity", "obj_id", "obj_type"]
+# rows of frame i are offsets[i]:offsets[i + 1], newest first, key_from_sweep maps sweep lidar to frame lidar
+sweep_columns = ["offsets", "lidar_path", "key_from_sweep", "time_lag"]
+max_hot_scenes = 16
+# bumped when the layout changes, older indexes are rebuilt
+index_version = 4
+
+
+def box_table_from_anns(anns):
+    """Per-frame lists of SUSTech boxes (the nested info format) -> box table."""
+    boxes = [box for frame in anns for box in frame]
+    offsets = np.zeros(len(anns) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(frame) for frame in anns])
+    psr = [[box["psr"][k][axis] for k in ["position", "scale", "rotation"] for axis in "xyz"] for box in boxes]
+    return {
+        "offsets": offsets,
+        "psr": np.array(psr, dtype=np.float64).reshape(-1, 9),
+        "velocity": np.array([box["velocity"] for box in boxes], dtype=np.float64).reshape(-1, 2),
+        "obj_id": np.array([box["obj_id"] for box in boxes], dtype=np.int64),
+        "obj_type": np.array([box["obj_type"] for box in boxes], dtype=np.str_),
+    }
+
+
+class BoxTable(Sequence):
+    """frame index -> ground truth boxes of the frame, in the SUSTech label shape, over a box table."""
+
+    def __init__(self, table, timestamps):
+        self.table = table
+        self.timestamps = timestamps
+
+    def __len__(self):
+        return len(self.table["offsets"]) - 1
+
+    def __getitem__(self, frame_index):
+        if not 0 <= frame_index < len(self):
+            raise IndexError(frame_index)
+        start, end = self.table["offsets"][frame_index:frame_index + 2]
+        timestamp = float(self.timestamps[frame_index])
+        return [{"psr": {"position": {"x": p[0], "y": p[1], "z": p[2]},
+                         "scale": {"x": p[3], "y": p[4], "z": p[5]},
+                         "rotation": {"x": p[6], "y": p[7], "z": p[8]}},
+                 "obj_type": obj_type,
+                 "obj_id": obj_id,
+                 "velocity": velocity,
+                 "timestamp": timestamp}
+                for p, velocity, obj_id, obj_type in zip(self.table["psr"][start:end].tolist(),
+                                                         self.table["velocity"][start:end].tolist(),
+                                                         self.table["obj_id"][start:end].tolist(),
+                                                         self.table["obj_type"][start:end].tolist())]
+
+    def to_json(self):
+        return [self[i] for i in range(len(self))]
+
+
+class FrameTokenIndex(object):
+    """frame token <-> (scene, frame_index) over all scenes.
+
+    Tokens are kept as fixed-width bytes arrays, once in scene order and once sorted
+    (with the positions they came from), so a lookup is a binary search and the arrays
+    can be memory-mapped by every worker.
+    """
+
+    keys = ["offsets", "tokens", "sorted_tokens", "order"]
+
+    def __init__(self, scenes, offsets, tokens, sorted_tokens, order):
+        self.scenes = list(scenes)
+        self.offsets = offsets  # frames of scene i are tokens[offsets[i]:offsets[i + 1]]
+        self.tokens = tokens
+        self.sorted_tokens = sorted_tokens
+        self.order = order  # sorted_tokens[k] == tokens[order[k]]
+        self._scene_ids = {scene_name: i for i, scene_name in enumerate(self.scenes)}
+
+    @classmethod
+    def from_info(cls, nusc_info):
+        scenes = list(nusc_info.keys())
+        frames = [nusc_info[scene_name]["frames"] for scene_name in scenes]
+        offsets = np.zeros(len(scenes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(f) for f in frames])
+        tokens = np.array([token.encode("utf-8") for f in frames for token in f], dtype=np.bytes_)
+        order = np.argsort(tokens, kind="stable")
+        return cls(scenes, offsets, tokens, tokens[order], order)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for key in self.keys:
+            np.save(os.path.join(path, key + ".npy"), getattr(self, key))
+        with open(os.path.join(path, "scenes.json"), "w") as f:
+            json.dump(self.scenes, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "scenes.json"), "r") as f:
+            scenes = json.load(f)
+        return cls(scenes, *[np.load(os.path.join(path, key + ".npy"), mmap_mode="r")
+                             for key in cls.keys])
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return self.locate(token) is not None
+
+    def num_frames(self, scene_name):
+        i = self._scene_ids[scene_name]
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def frame_token(self, scene_name, frame_index):
+        i = self._scene_ids[scene_name]
+        frame_index = int(frame_index)
+        if not 0 <= frame_index < self.offsets[i + 1] - self.offsets[i]:
+            raise IndexError(frame_index)
+        return self.tokens[self.offsets[i] + frame_index].decode("utf-8")
+
+    def frames(self, scene_name):
+        i = self._scene_ids[scene_name]
+        return [t.decode("utf-8") for t in self.tokens[self.offsets[i]:self.offsets[i + 1]]]
+
+    def locate_many(self, tokens):
+        """
+        :param tokens: list of frame tokens.
+        :return: (scene ids, frame indices), both -1 where a token is unknown. Scene ids index self.scenes.
+        """
+        query = np.array([t.encode("utf-8") for t in tokens], dtype=np.bytes_)
+        if len(self.tokens) == 0:
+            return np.full(len(query), -1), np.full(len(query), -1)
+        pos = np.minimum(np.searchsorted(self.sorted_tokens, query), len(self.tokens) - 1)
+        found = self.sorted_tokens[pos] == query
+        flat = np.where(found, self.order[pos], 0)
+        scene_ids = np.searchsorted(self.offsets, flat, side="right") - 1
+        frame_indices = flat - self.offsets[scene_ids]
+        return np.where(found, scene_ids, -1), np.where(found, frame_indices, -1)
+
+    def locate(self, token):
+        """:return: (scene_name, frame_index), or None for an unknown token."""
+        scene_ids, frame_indices = self.locate_many([token])
+        if scene_ids[0] < 0:
+            return None
+        return self.scenes[scene_ids[0]], int(frame_indices[0])
+
+
+def build_index(info_path, index_dir):
+    with open(info_path, "rb") as f:
+        nusc_info = pickle.load(f)
+
+    os.makedirs(index_dir, exist_ok=True)
+    manifest = {
+        "source": os.path.abspath(info_path),
+        "source_mtime": os.path.getmtime(info_path),
+        "version": index_version,
+        "scenes": {},
+    }
+    for scene_name, scene in nusc_info.items():
+        scene_dir = os.path.join(index_dir, scene_name)
+        os.makedirs(scene_dir, exist_ok=True)
+        for key in pose_columns:
+            np.save(os.path.join(scene_dir, key + ".npy"), np.array(scene[key], dtype=np.float64).reshape(-1, 16))
+        np.save(os.path.join(scene_dir, "timestamp.npy"), np.array(scene["timestamp"], dtype=np.float64))
+        # infos written before the box table have nested per-frame boxes
+        table = scene["anns"] if isinstance(scene["anns"], dict) else box_table_from_anns(scene["anns"])
+        os.makedirs(os.path.join(scene_dir, "anns"), exist_ok=True)
+        for key in box_columns:
+            np.save(os.path.join(scene_dir, "anns", key + ".npy"), table[key])
+        # infos written before the sweep table have no sweeps
+        sweeps = scene.get("sweeps") or {
+            "offsets": np.zeros(len(scene["frames"]) + 1, dtype=np.int64),
+            "lidar_path": np.zeros(0, dtype=np.str_),
+            "key_from_sweep": np.zeros((0, 4, 4)),
+            "time_lag": np.zeros(0),
+        }
+        os.makedirs(os.path.join(scene_dir, "sweeps"), exist_ok=True)
+        for key in sweep_columns:
+            np.save(os.path.join(scene_dir, "sweeps", key + ".npy"), sweeps[key])
+        manifest["scenes"][scene_name] = {"num_frames": len(scene["frames"])}
+
+    write_blob_store(os.path.join(index_dir, "meta.blob"),
+                     ((scene_name, {k: v for k, v in scene.items() if k not in columns + ["anns", "sweeps"]})
+                      for scene_name, scene in nusc_info.items()))
+    FrameTokenIndex.from_info(nusc_info).save(os.path.join(index_dir, "tokens"))
+
+    # manifest goes last, a half-built index is never picked up
+    tmp_path = os.path.join(index_dir, "manifest.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(index_dir, "manifest.json"))
+    return manifest
+
+
+def is_stale(info_path, index_dir):
+    manifest_path = os.path.join(index_dir, "manifest.json")
+    if not os.path.isfile(manifest_path):
+        return True
+    if not os.path.isfile(info_path):
+        return False
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != index_version:
+        return True
+    return manifest["source_mtime"] < os.path.getmtime(info_path)
+
+
+def open_index(info_path, index_dir, max_hot=max_hot_scenes):
+    """Opens the index, building it first if needed.
+
+    The first process to get here (the uwsgi master, or one worker with lazy-apps)
+    builds the index under an exclusive lock; every other process waits on the lock
+    and then only attaches to the finished files.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(index_dir)), exist_ok=True)
+    with open(os.path.abspath(index_dir) + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if is_stale(info_path, index_dir):
+                print("building scene index", index_dir, "from", info_path)
+                build_index(info_path, index_dir)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return SceneIndex(index_dir, max_hot)
+
+
+class SceneIndex(Mapping):
+    """Read-only scene_name -> scene dict view over an index built by build_index.
+
+    Scenes are loaded on first access and kept in a bounded LRU. Pose and
+    timestamp columns are numpy memmaps of shape (num_frames, 16) / (num_frames,),
+    scene["anns"] is a BoxTable and scene["sweeps"] the sweep table.
+    Frame tokens are looked up through self.tokens without loading any scene.
+    """
+
+    def __init__(self, index_dir, max_hot=max_hot_scenes):
+        self.index_dir = index_dir
+        self.max_hot = max_hot
+        with open(os.path.join(index_dir, "manifest.json"), "r") as f:
+            self.manifest = json.load(f)
+        self.meta = BlobStore(os.path.join(index_dir, "meta.blob"))
+        self.tokens = FrameTokenIndex.load(os.path.join(index_dir, "tokens"))
+        self._hot = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, scene_name):
+        with self._lock:
+            if scene_name in self._hot:
+                self._hot.move_to_end(scene_name)
+                return self._hot[scene_name]
+        if scene_name not in self.manifest["scenes"]:
+            raise KeyError(scene_name)
+
+        scene = self._load_scene(scene_name)
+        with self._lock:
+            self._hot[scene_name] = scene
+            self._hot.move_to_end(scene_name)
+            while len(self._hot) > self.max_hot:
+                self._hot.popitem(last=False)
+        return scene
+
+    def __iter__(self):
+        return iter(self.manifest["scenes"])
+
+    def __len__(self):
+        return len(self.manifest["scenes"])
+
+    def __contains__(self, scene_name):
+        return scene_name in self.manifest["scenes"]
+
+    def num_frames(self, scene_name):
+        return self.manifest["scenes"][scene_name]["num_frames"]
+
+    def _load_scene(self, scene_name):
+        scene_dir = os.path.join(self.index_dir, scene_name)
+        scene = self.meta[scene_name]
+        for key in columns:
+            scene[key] = np.load(os.path.join(scene_dir, key + ".npy"), mmap_mode="r")
+        scene["anns"] = BoxTable({key: np.load(os.path.join(scene_dir, "anns", key + ".npy"), mmap_mode="r")
+                                  for key in box_columns}, scene["timestamp"])
+        scene["sweeps"] = {key: np.load(os.path.join(scene_dir, "sweeps", key + ".npy"), mmap_mode="r")
+                           for key in sweep_columns}
+        return scene
+
+
+def scene_to_json(scene):
+    """Returns the scene in the shape the web UI expects (plain lists instead of memmaps and box tables)."""
+    res = dict(scene)
+    # sweeps are only read by the server, see scene_reader2.get_sweeps
+    res.pop("sweeps", None)
+    res["anns"] = scene["anns"].to_json()
+    for key in pose_columns:
+        res[key] = np.asarray(scene[key]).tolist()
+    res["timestamp"] = np.asarray(scene["timestamp"]).tolist()
+    return res
+
+
+if __name__ == "__main__":
+    import sys
+    # python scene_index.py <info pkl> <index dir>, builds the index ahead of server start
+    open_index(sys.argv[1], sys.argv[2])
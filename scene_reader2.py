@@ -3,8 +3,10 @@ import os
 import json
 from pyquaternion import Quaternion
 import numpy as np
-import pickle
 import operator
+import scene_index
+from track_store import TrackStore
+from annotation_writer import writer
 
 
 class_names = ['car', 'truck', 'construction_vehicle', 'bus', 'trailer', 'barrier', 'motorcycle', 'bicycle', 'pedestrian', 'traffic_cone']
@@ -123,11 +125,13 @@ cls_attr_dist = {
 
 dataroot = "/home/yaozh/data/nuscenes/nuscenes/v1.0-train-val"
 trackfile = "/home/yaozh/WebstormProjects/pcl_annotate_tool/data/train/SUSTech_data_track_infostrain.json"
-with open(dataroot+"/SUSTech_data_infostrain_real.pkl", "rb") as f:
-    nusc_info = pickle.load(f)
+info_path = dataroot + "/SUSTech_data_infostrain_real.pkl"
+index_dir = dataroot + "/SUSTech_scene_index_train"
+# scenes are loaded from the memory-mapped index on demand, see scene_index.py
+nusc_info = scene_index.open_index(info_path, index_dir)
 
-with open(trackfile, "r") as f:
-    track_res = json.load(f)
+# per-frame tracking results, read from an indexed store instead of json.load of the whole run
+track_res = TrackStore(trackfile, watch=True)
 
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
@@ -163,7 +167,7 @@ def get_next_keyframe(s,frame_index):
 
 def get_one_scene(s):
     if s[:4] == "nusc":
-        return nusc_info[s]
+        return scene_index.scene_to_json(nusc_info[s])
     else:
         scene = {
             "scene": s,
@@ -307,44 +311,67 @@ def get_one_scene(s):
 def nusc_get_all_objs(scene):
     return nusc_info[scene]["obj_stats"]
 
-has_read = False
 def read_annotations(scene, frame, mode="normal"):
     if scene[:4] == "nusc":
-        global has_read,track_res,trackfile
         if mode == "pre_track":
-            if os.path.isfile(trackfile):
-                return {"anns":track_res[nusc_info[scene]["frames"][int(frame)]],"has_file":True,"from":"track"}
+            if track_res.available():
+                return {"anns":track_res.get(nusc_info.tokens.frame_token(scene, frame), []),"has_file":True,"from":"track"}
             else:
                 return {"anns":[],"has_file":False,"from":"gt"}
         else:
-            filename = os.path.join(os.getcwd(),"data/nusc/" + scene + "/label/",frame+".json")
-            if (os.path.isfile(filename)):
-                with open(filename, "r") as f:
-                    ann = json.load(f)
+            ann = writer.read_json(os.path.join(os.getcwd(),"data/nusc/" + scene + "/label/",frame+".json"))
+            if ann is not None:
                 return {"anns":ann,"has_file":True,"from":"label"}
             else:
-                filename = os.path.join(os.getcwd(),"tmp/nusc/" + scene + "/label/",frame+".json")
-                if (os.path.isfile(filename)):
-                    with open(filename, "r") as f:
-                        ann = json.load(f)
+                ann = writer.read_json(os.path.join(os.getcwd(),"tmp/nusc/" + scene + "/label/",frame+".json"))
+                if ann is not None:
                     return {"anns":ann,"has_file":True,"from":"tmp"}
                 elif mode != "real":
                     return {"anns":nusc_info[scene]["anns"][int(frame)],"has_file":False,"from":"gt"}
                 else:
-                    if os.path.isfile(trackfile):
-                        return {"anns":track_res[nusc_info[scene]["frames"][int(frame)]],"has_file":True,"from":"track"}
+                    if track_res.available():
+                        return {"anns":track_res.get(nusc_info.tokens.frame_token(scene, frame), []),"has_file":True,"from":"track"}
                     else:
                         return {"anns":[],"has_file":False,"from":"gt"}
     else:
-        filename = os.path.join(root_dir, scene, "label", frame + ".json")
-        if (os.path.isfile(filename)):
-            with open(filename, "r") as f:
-                ann = json.load(f)
-                return ann
+        ann = writer.read_json(os.path.join(root_dir, scene, "label", frame + ".json"))
+        if ann is not None:
+            return ann
         else:
             return []
 
 
+def get_lidar_path(scene, frame):
+    if scene[:4] == "nusc":
+        # lidar_path is relative to the nuscenes root served as /data_nusc
+        return os.path.join(os.path.dirname(dataroot), nusc_info[scene]["lidar_path"][int(frame)])
+    else:
+        lidar_dir = os.path.join(root_dir, scene, "lidar")
+        for f in os.listdir(lidar_dir):
+            if os.path.splitext(f)[0] == frame:
+                return os.path.join(lidar_dir, f)
+        return None
+
+
+def get_sweeps(scene, frame, nsweeps):
+    """
+    Returns [(lidar path, <4x4> key lidar from sweep lidar, time lag in s)] for the frame and up to
+    nsweeps - 1 lidar sweeps before it (non-key frames included), as taken by pointcloud_service.aggregate_sweeps.
+    """
+    key_frame = (get_lidar_path(scene, frame), np.eye(4), 0.0)
+    if scene[:4] != "nusc":
+        # no sweeps for these scenes, only the key frame
+        return [key_frame]
+
+    # the sweeps, their transforms and time lags are stored in the info by the converter
+    sweeps = nusc_info[scene]["sweeps"]
+    start, end = sweeps["offsets"][int(frame):int(frame) + 2].tolist()
+    end = min(end, start + nsweeps - 1)
+    return [key_frame] + [(os.path.join(os.path.dirname(dataroot), str(sweeps["lidar_path"][i])),
+                           np.asarray(sweeps["key_from_sweep"][i]), float(sweeps["time_lag"][i]))
+                          for i in range(start, end)]
+
+
 def read_ego_pose(scene, frame):
     if scene[:4] == "nusc":
         return nusc_info[scene]["ego_pose"][int(frame)]
@@ -361,14 +388,22 @@ def read_ego_pose(scene, frame):
 
 
 def _lidar_nusc_box_to_global(boxes, scene_name,frame_index):
+    """boxes: BoxArray in the lidar frame, transformed in place."""
     lidar2ego = np.array(nusc_info[scene_name]["lidar2ego"][frame_index]).reshape(4,4).T
     ego2global = np.array(nusc_info[scene_name]["ego2global"][frame_index]).reshape(4,4).T
+    boxes.transform(lidar2ego)
+    boxes.transform(ego2global)
+    token = nusc_info.tokens.frame_token(scene_name, frame_index)
+    moving = (np.hypot(boxes.velocity[:, 0], boxes.velocity[:, 1]) > 0.2).tolist()
+    center = boxes.center.tolist()
+    wlh = boxes.wlh.tolist()
+    rotation = boxes.orientation.tolist()
+    velocity = boxes.velocity[:, :2].tolist()
+    score = boxes.score.tolist()
     annos=[]
-    for box in boxes:
-        box.transform(lidar2ego)
-        box.transform(ego2global)
-        name = class_names[box.label]
-        if np.sqrt(box.velocity[0] ** 2 + box.velocity[1] ** 2) > 0.2:
+    for i, label in enumerate(boxes.label.tolist()):
+        name = class_names[label]
+        if moving[i]:
             if name in [
                 "car",
                 "construction_vehicle",
@@ -389,18 +424,18 @@ def _lidar_nusc_box_to_global(boxes, scene_name,frame_index):
             else:
                 attr = None
         nusc_anno = {
-            "sample_token": nusc_info[scene_name]["frames"][frame_index],
-            "obj_id": box.instance_token,
-            "translation": box.center.tolist(),
-            "size": box.wlh.tolist(),
-            "rotation": box.orientation.elements.tolist(),
-            "velocity": box.velocity[:2].tolist(),
+            "sample_token": token,
+            "obj_id": boxes.instance_token[i],
+            "translation": center[i],
+            "size": wlh[i],
+            "rotation": rotation[i],
+            "velocity": velocity[i],
             "detection_name": name,
-            "detection_score": box.score,
+            "detection_score": score[i],
             "attribute_name": attr if attr is not None else max(cls_attr_dist[name].items(), key=operator.itemgetter(1))[0],
         }
         annos.append(nusc_anno)
-    return annos,nusc_info[scene_name]["frames"][frame_index]
+    return annos,token
 
 
 # if __name__ == "__main__":
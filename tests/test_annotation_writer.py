@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import annotation_writer
+from annotation_writer import AnnotationWriter
+
+
+class TestAnnotationWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.writer = AnnotationWriter()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def test_write(self):
+        """ Writes compact json into new directories, runs the callbacks and leaves no temp files. """
+        written = []
+        failed = self.writer.write([(self.path("a", "label", "0.json"), [{"obj_id": "1"}], lambda: written.append(0)),
+                                    (self.path("b", "label", "1.json"), [], None)])
+        self.assertEqual(failed, [])
+        self.assertEqual(written, [0])
+        with open(self.path("a", "label", "0.json")) as f:
+            self.assertEqual(f.read(), '[{"obj_id":"1"}]')
+        self.assertEqual(self.writer.read_json(self.path("b", "label", "1.json")), [])
+        self.assertEqual(os.listdir(self.path("a", "label")), ["0.json"])
+
+    def test_coalesce(self):
+        """ The last save of a frame in a batch wins, the callbacks of every save run once it is written. """
+        written = []
+        failed = self.writer.write([(self.path("0.json"), [1], lambda: written.append(1)),
+                                    (self.path("1.json"), [2], None),
+                                    (self.path("0.json"), [3], lambda: written.append(3))])
+        self.assertEqual(failed, [])
+        self.assertEqual(self.writer.read_json(self.path("0.json")), [3])
+        self.assertEqual(self.writer.read_json(self.path("1.json")), [2])
+        self.assertEqual(written, [1, 3])
+
+    def test_failing_write(self):
+        """ A failing file is reported and keeps its old content, the rest of the batch is written. """
+        self.writer.write([(self.path("0.json"), ["old"], None)])
+        os.makedirs(self.path("dir.json", "x"))
+        written = []
+        failed = self.writer.write([(self.path("0.json"), [object()], lambda: written.append(0)),
+                                    (self.path("dir.json"), [1], lambda: written.append(1)),
+                                    (self.path("2.json"), [2], lambda: written.append(2))])
+        self.assertEqual(sorted(path for path, _ in failed), [self.path("0.json"), self.path("dir.json")])
+        self.assertEqual(written, [2])
+        self.assertEqual(self.writer.read_json(self.path("0.json")), ["old"])
+        self.assertEqual(self.writer.read_json(self.path("2.json")), [2])
+        # no temp files are left behind
+        self.assertEqual(sorted(os.listdir(self.dir)), ["0.json", "2.json", "dir.json"])
+
+    def test_batched_fsync(self):
+        """ Every temp file of a batch is synced before the first rename, each directory is synced once. """
+        calls = []
+        fsync, replace = os.fsync, os.replace
+        with mock.patch.object(annotation_writer.os, "fsync", side_effect=lambda fd: (calls.append("fsync"), fsync(fd))), \
+                mock.patch.object(annotation_writer.os, "replace",
+                                  side_effect=lambda a, b: (calls.append("replace"), replace(a, b))):
+            failed = self.writer.write([(self.path(d, "{}.json".format(i)), [i], None)
+                                        for d in ["a", "b"] for i in range(10)])
+        self.assertEqual(failed, [])
+        self.assertEqual(calls, ["fsync"] * 20 + ["replace"] * 20 + ["fsync"] * 2)
+        self.assertEqual(self.writer.read_json(self.path("b", "9.json")), [9])
+
+    def test_failing_fsync(self):
+        """ A file whose temp file can't be synced keeps its old content. """
+        self.writer.write([(self.path("0.json"), ["old"], None)])
+        with mock.patch.object(annotation_writer, "_fsync_file", side_effect=OSError("disk full")):
+            failed = self.writer.write([(self.path("0.json"), ["new"], None)])
+        self.assertEqual([path for path, _ in failed], [self.path("0.json")])
+        self.assertEqual(self.writer.read_json(self.path("0.json")), ["old"])
+        self.assertEqual(os.listdir(self.dir), ["0.json"])
+
+    def test_read_missing(self):
+        self.assertIsNone(self.writer.read_json(self.path("missing.json")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from blob_store import BlobStore, write_blob_store, iter_json_items
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "store.blob")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        items = {"b": [{"obj_id": 1}], "a": [], "c": {"x": 1.5}}
+        write_blob_store(self.path, items.items())
+        store = BlobStore(self.path)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store["b"], [{"obj_id": 1}])
+        self.assertEqual(store.get("missing", []), [])
+        self.assertNotIn("missing", store)
+        self.assertEqual(list(store.items()), sorted(items.items()))
+
+    def test_rewrite_from_items(self):
+        """ A store can be rewritten from its own items while it is open, e.g. to merge new keys in. """
+        write_blob_store(self.path, [("a", 1), ("b", 2)])
+        old = BlobStore(self.path)
+        write_blob_store(self.path, [("b", 3), ("c", 4)] + [(k, v) for k, v in old.items() if k not in ["b", "c"]])
+        self.assertEqual(list(BlobStore(self.path).items()), [("a", 1), ("b", 3), ("c", 4)])
+
+    def test_iter_json_items(self):
+        json_path = os.path.join(self.dir, "res.json")
+        with open(json_path, "w") as f:
+            json.dump({"meta": {"use_lidar": True}, "results": {"t1": [1, 2], "t2": []}}, f)
+        self.assertEqual(list(iter_json_items(json_path, "results", chunk_size=4)), [("t1", [1, 2]), ("t2", [])])
+
+
+if __name__ == '__main__':
+    unittest.main()
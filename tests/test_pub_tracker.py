@@ -0,0 +1,65 @@
+import unittest
+
+from algos.pub_tracker import PubTracker
+
+
+def det(x, y, name="car", obj_id=None, score=0.9):
+    box = {"translation": [x, y, 0.0], "velocity": [0.0, 0.0], "detection_name": name, "detection_score": score}
+    if obj_id is not None:
+        box["obj_id"] = obj_id
+    return box
+
+
+class TestPubTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = PubTracker(num_scene=2)
+        self.tracker.set_scene(0)
+
+    def ids(self, tracks):
+        return [track["tracking_id"] for track in tracks if track["active"]]
+
+    def test_new_ids(self):
+        """ Boxes without obj_id get new ids, matched boxes keep the id of their track. """
+        first = self.ids(self.tracker.step_centertrack([det(0, 0), det(50, 0)], 0.5))
+        self.assertEqual(first, [1, 2])
+        second = self.tracker.step_centertrack([det(50.5, 0), det(0.5, 0), det(100, 0)], 0.5)
+        self.assertEqual(self.ids(second), [2, 1, 3])
+        self.assertEqual([track["matched"] for track in second], [True, True, False])
+
+    def test_given_ids_kept(self):
+        """ obj_id of an unmatched box is used as is, negative and non-numeric ids included. """
+        tracks = self.tracker.step_centertrack([det(0, 0, obj_id=-3), det(50, 0, obj_id="12"), det(100, 0)], 0.5)
+        self.assertEqual(self.ids(tracks), [-3, "12", 1])
+        tracks = self.tracker.step_centertrack([det(0, 0), det(50, 0), det(100, 0)], 0.5)
+        self.assertEqual(self.ids(tracks), [-3, "12", 1])
+
+    def test_unmatched_tracks_age_out(self):
+        """ Unmatched tracks are kept inactive for max_age frames, boxes of other classes never match. """
+        self.tracker.step_centertrack([det(0, 0)], 0.5)
+        for _ in range(self.tracker.max_age - 1):
+            tracks = self.tracker.step_centertrack([det(0, 0, name="pedestrian")], 0.5)
+            self.assertIn(1, [track["tracking_id"] for track in tracks if not track["active"]])
+        tracks = self.tracker.step_centertrack([det(0, 0, name="pedestrian")], 0.5)
+        self.assertNotIn(1, [track["tracking_id"] for track in tracks])
+
+    def test_filtered_frame_ages_tracks(self):
+        """ A frame holding only filtered boxes keeps the tracks (inactive) until max_age, an empty one resets. """
+        self.tracker.step_centertrack([det(0, 0)], 0.5)
+        filtered = [det(0, 0, name="barrier"), det(0, 0, score=0.1)]
+        for _ in range(self.tracker.max_age - 1):
+            tracks = self.tracker.step_centertrack(filtered, 0.5)
+            self.assertEqual([(1, 0)], [(track["tracking_id"], track["active"]) for track in tracks])
+        tracks = self.tracker.step_centertrack([det(0.5, 0)], 0.5)
+        self.assertEqual(self.ids(tracks), [1])
+
+        for _ in range(self.tracker.max_age):
+            tracks = self.tracker.step_centertrack(filtered, 0.5)
+        self.assertEqual(tracks, [])
+        self.tracker.step_centertrack([det(0, 0)], 0.5)
+        self.assertEqual(self.tracker.step_centertrack([], 0.5), [])
+        self.assertEqual(self.ids(self.tracker.step_centertrack([det(0, 0)], 0.5)), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import algos.track
+from track_session import TrackSession, TrackSessionManager
+
+
+def frame(frame_index, xs, obj_type="car"):
+    dets = [{"globalpsr": {"position": {"x": x, "y": 0.0}}, "velocity": [0.0, 0.0], "obj_type": obj_type,
+             "timestamp": 0.5 * frame_index} for x in xs]
+    return {"frame_index": frame_index, "dets": dets}
+
+
+def summary(tracks):
+    """ frame_index -> the tracked boxes as comparable tuples, ct is an array. """
+    return {frame_index: [(t["obj_id"], t.get("det_index"), t["active"], t["age"], tuple(t["ct"].tolist()))
+                          for t in out] for frame_index, out in tracks.items()}
+
+
+def scene(num_frames=4):
+    return [frame(i, [0.0 + 0.1 * i, 20.0 + 0.1 * i]) for i in range(num_frames)]
+
+
+class TestTrackSession(unittest.TestCase):
+
+    def run_counted(self, session, frames):
+        """ Runs the frames, returns the outputs and the frames step_centertrack was called for. """
+        with mock.patch("algos.track.step_centertrack", wraps=algos.track.step_centertrack) as step:
+            res = session.run(frames)
+        return res, [call.args[2] for call in step.call_args_list]
+
+    def test_reuse(self):
+        """ A repeated request reuses every frame. """
+        session = TrackSession()
+        first, stepped = self.run_counted(session, scene())
+        self.assertEqual(stepped, [0, 1, 2, 3])
+        second, stepped = self.run_counted(session, scene())
+        self.assertEqual(stepped, [])
+        self.assertEqual(summary(dict(enumerate(first))), summary(dict(enumerate(second))))
+        # ids are kept over the frames
+        self.assertEqual([[t["obj_id"] for t in out] for out in first], [[-1, -2]] * 4)
+
+    def test_invalidate(self):
+        """ Changing a frame re-runs it and every frame after it, the frames before it are reused. """
+        session = TrackSession()
+        self.run_counted(session, scene())
+        frames = scene()
+        frames[2] = frame(2, [0.2, 40.0])
+        res, stepped = self.run_counted(session, frames)
+        self.assertEqual(stepped, [2, 3])
+        self.assertEqual([t["obj_id"] for t in res[2] if t["active"]], [-1, -3])
+
+        # a request over the last frames only continues from the stored frame before them
+        _, stepped = self.run_counted(session, frames[3:])
+        self.assertEqual(stepped, [])
+        frames[3] = frame(3, [0.3])
+        _, stepped = self.run_counted(session, frames[3:])
+        self.assertEqual(stepped, [3])
+
+    def test_cached(self):
+        """ A single frame is only served from the session with the dets it was tracked with. """
+        session = TrackSession()
+        res = session.run(scene())
+        self.assertIs(session.cached(2, scene()[2]["dets"]), res[2])
+        self.assertIsNone(session.cached(2, frame(2, [5.0])["dets"]))
+        self.assertIsNone(session.cached(7, frame(7, [5.0])["dets"]))
+
+    def test_reset(self):
+        """ Placeholder ids go on over requests, reset tracks from scratch as a fresh session would. """
+        session = TrackSession()
+        first, _ = self.run_counted(session, scene())
+        frames = scene()
+        frames[3] = frame(3, [0.3, 20.3, 60.0])
+        res, _ = self.run_counted(session, frames)
+        self.assertEqual([t["obj_id"] for t in res[3] if t["active"]], [-1, -2, -3])
+
+        session.reset()
+        self.assertEqual(session.unknown_num, 0)
+        res, stepped = self.run_counted(session, scene())
+        self.assertEqual(stepped, [0, 1, 2, 3])
+        self.assertEqual(summary(dict(enumerate(res))), summary(dict(enumerate(first))))
+
+
+class TestTrackSessionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sessions_are_separate(self):
+        manager = TrackSessionManager()
+        a = manager.get("user", "nusc1")
+        self.assertIs(manager.get("user", "nusc1"), a)
+        self.assertIsNot(manager.get("user", "nusc2"), a)
+        self.assertIsNot(manager.get("other", "nusc1"), a)
+
+    def test_spill_shared(self):
+        """ A session spilled by one worker is picked up by another, changed frames only are rewritten. """
+        worker_a = TrackSessionManager(self.dir)
+        worker_b = TrackSessionManager(self.dir)
+
+        session = worker_a.get("user", "nusc1")
+        res = session.run(scene())
+        worker_a.put("user", "nusc1", session)
+        session_dir = worker_a._spill_path(("user", "nusc1"))
+        mtimes = {name: os.stat(os.path.join(session_dir, name)).st_mtime_ns for name in os.listdir(session_dir)}
+        self.assertEqual(sorted(mtimes), ["0.pkl", "1.pkl", "2.pkl", "3.pkl", "state.pkl"])
+
+        other = worker_b.get("user", "nusc1")
+        self.assertEqual(summary(other.tracks), summary(session.tracks))
+        self.assertEqual(other.unknown_num, session.unknown_num)
+        self.assertIs(other.cached(3, scene()[3]["dets"]), other.tracks[3])
+
+        # worker b changes the last frames, worker a sees it and frames 0 and 1 are not rewritten
+        frames = scene()[:3]
+        frames[2] = frame(2, [0.2, 40.0])
+        other.run(frames)
+        worker_b.put("user", "nusc1", other)
+        for name in ["0.pkl", "1.pkl"]:
+            self.assertEqual(os.stat(os.path.join(session_dir, name)).st_mtime_ns, mtimes[name])
+        self.assertFalse(os.path.exists(os.path.join(session_dir, "3.pkl")))
+
+        session = worker_a.get("user", "nusc1")
+        self.assertEqual(sorted(session.tracks), [0, 1, 2])
+        self.assertEqual(summary(session.tracks)[2], summary(other.tracks)[2])
+        self.assertEqual(summary(session.tracks)[0], summary({0: res[0]})[0])
+
+    def test_spill_reset(self):
+        """ A reset spills as an empty session with the placeholder ids starting over. """
+        worker_a = TrackSessionManager(self.dir)
+        worker_b = TrackSessionManager(self.dir)
+        session = worker_a.get("user", "nusc1")
+        session.run(scene())
+        worker_a.put("user", "nusc1", session)
+        self.assertEqual(sorted(worker_b.get("user", "nusc1").tracks), [0, 1, 2, 3])
+
+        session.reset()
+        worker_a.put("user", "nusc1", session)
+        other = worker_b.get("user", "nusc1")
+        self.assertEqual((other.tracks, other.unknown_num), ({}, 0))
+        self.assertEqual(os.listdir(worker_a._spill_path(("user", "nusc1"))), ["state.pkl"])
+
+    def test_eviction(self):
+        """ Sessions over the cap are dropped from memory and reloaded from the spill dir. """
+        manager = TrackSessionManager(self.dir, max_sessions=1)
+        session = manager.get("user", "nusc1")
+        session.run(scene())
+        manager.put("user", "nusc1", session)
+        manager.put("user", "nusc2", manager.get("user", "nusc2"))
+        reloaded = manager.get("user", "nusc1")
+        self.assertIsNot(reloaded, session)
+        self.assertEqual(summary(reloaded.tracks), summary(session.tracks))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,10 +5,11 @@ import json
 import math
 import os
 import os.path as osp
+import shutil
 import sys
 import time
 from datetime import datetime
-from typing import Tuple, List, Iterable
+from typing import Tuple, List, Iterable, Optional
 
 import cv2
 import matplotlib.pyplot as plt
@@ -25,6 +26,8 @@ from tools.my_nuscenes.utils.data_classes import LidarPointCloud, RadarPointClou
 from tools.my_nuscenes.utils.geometry_utils import view_points, box_in_image, BoxVisibility, transform_matrix
 from tools.my_nuscenes.utils.map_mask import MapMask
 from tools.my_nuscenes.utils.color_map import get_colormap
+from tools.my_nuscenes.utils.table_cache import load_table, read_column, write_column, table_hash, bytes_column, \
+    cache_version, TokenIndex, TokenStrings, Table
 
 PYTHON_VERSION = sys.version_info[0]
 
@@ -41,17 +44,23 @@ class NuScenes:
                  version: str = 'v1.0-mini',
                  dataroot: str = '/data/sets/nuscenes',
                  verbose: bool = True,
-                 map_resolution: float = 0.1):
+                 map_resolution: float = 0.1,
+                 table_cache: str = None):
         """
         Loads database and creates reverse indexes and shortcuts.
         :param version: Version to load (e.g. "v1.0", ...).
         :param dataroot: Path to the tables and data.
         :param verbose: Whether to print status messages during load.
         :param map_resolution: Resolution of maps (meters).
+        :param table_cache: Folder for a binary cache of the tables, built from the json tables on first use.
+            With a cache, the table columns are memory-mapped and records are only built when they are accessed.
         """
         self.version = version
         self.dataroot = dataroot
         self.verbose = verbose
+        self.table_cache = table_cache
+        # (table, field) -> {value: [token]}, None until first used, see add_index.
+        self._secondary_indexes = {('sample', 'scene_token'): None, ('sample_annotation', 'instance_token'): None}
         self.table_names = ['category', 'attribute', 'visibility', 'instance', 'sensor', 'calibrated_sensor',
                             'ego_pose', 'log', 'scene', 'sample', 'sample_data', 'sample_annotation', 'map']
 
@@ -129,6 +138,9 @@ class NuScenes:
 
     def __load_table__(self, table_name) -> dict:
         """ Loads a table. """
+        if self.table_cache is not None:
+            return load_table(osp.join(self.table_root, '{}.json'.format(table_name)),
+                              osp.join(self.table_cache, self.version, table_name))
         with open(osp.join(self.table_root, '{}.json'.format(table_name))) as f:
             table = json.load(f)
         return table
@@ -153,6 +165,12 @@ class NuScenes:
         if verbose:
             print("Reverse indexing ...")
 
+        if self.table_cache is not None:
+            self.__load_reverse_index__()
+            if verbose:
+                print("Done loading reverse indices in {:.1f} seconds.\n======".format(time.time() - start_time))
+            return
+
         # Store the mapping from token to table index for each table.
         self._token2ind = dict()
         for table in self.table_names:
@@ -200,6 +218,139 @@ class NuScenes:
         if verbose:
             print("Done reverse indexing in {:.1f} seconds.\n======".format(time.time() - start_time))
 
+    def __load_reverse_index__(self) -> None:
+        """
+        __make_reverse_index__ for a cached database. The token indices and decorations are stored next to the
+        table cache, keyed by the sha1 of the table files, and only rebuilt when one of the tables changed.
+        """
+        index_dir = osp.join(self.table_cache, self.version, 'reverse_index')
+        tables = {table: getattr(self, table) for table in self.table_names}
+        sources = {table: table_hash(osp.join(self.table_cache, self.version, table)) for table in tables}
+        meta = None
+        if osp.isfile(osp.join(index_dir, 'index.json')):
+            with open(osp.join(index_dir, 'index.json')) as f:
+                meta = json.load(f)
+        if meta is None or meta['version'] != cache_version or meta['sources'] != sources:
+            meta = self.__build_reverse_index__(index_dir, sources)
+
+        self._token2ind = {table: TokenIndex.load(osp.join(index_dir, table)) for table in tables}
+        strings = {table: TokenStrings(bytes_column(tables[table], 'token'), self._token2ind[table]) for table in tables}
+        for table, fields in meta['refs'].items():
+            for name, kind, target in fields:
+                column = read_column(osp.join(index_dir, table + '.' + name), kind, strings[target])
+                tables[table].set_column(name, column)
+        for table, fields in meta['fields'].items():
+            for name, kind, target in fields:
+                column = read_column(osp.join(index_dir, table + '.' + name), kind,
+                                     strings[target] if target is not None else None)
+                tables[table].add_field(name, column)
+
+    def __build_reverse_index__(self, index_dir: str, sources: dict) -> dict:
+        """
+        Writes what __make_reverse_index__ computes to index_dir, as arrays computed from the table columns.
+        :param index_dir: Folder of the reverse index.
+        :param sources: Table name -> sha1 of its json file.
+        :return: Contents of the index.json written.
+        """
+        if osp.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        os.makedirs(index_dir)
+
+        token2ind = dict()
+        for table in self.table_names:
+            token2ind[table] = TokenIndex.from_tokens(bytes_column(getattr(self, table), 'token'))
+            token2ind[table].save(osp.join(index_dir, table))
+
+        # Token fields are stored as rows of the table the tokens belong to, see TokenStrings.
+        refs = dict()
+        for table in self.table_names:
+            records = getattr(self, table)
+            for name, _ in records.fields:
+                target = self.__token_table__(table, name)
+                if target is None:
+                    continue
+                if name == 'token':
+                    refs.setdefault(table, []).append((name, 'row', table))
+                    continue
+                path = osp.join(index_dir, table + '.' + name)
+                column = records.column(name)
+                try:
+                    if isinstance(column, np.ndarray) and column.dtype.kind == 'S':
+                        np.save(path + '.npy', token2ind[target].rows(column, empty=True).astype(np.int32))
+                        kind = 'scalar'
+                    elif isinstance(column, tuple) and column[1].dtype.kind == 'S':
+                        np.save(path + '.offsets.npy', column[0])
+                        np.save(path + '.values.npy', token2ind[target].rows(column[1]).astype(np.int32))
+                        kind = 'list'
+                    else:
+                        continue
+                except KeyError:
+                    # Tokens missing from the table, the field stays a str column.
+                    continue
+                refs.setdefault(table, []).append((name, kind, target))
+
+        fields = dict()
+
+        def add_field(table: str, name: str, values, target: str = None) -> None:
+            """ Adds a decoration, values are rows of target if given. """
+            kind = write_column(osp.join(index_dir, table + '.' + name), values)
+            fields.setdefault(table, []).append((name, kind, target))
+
+        # Decorate sample_annotation with the category name.
+        inst = token2ind['instance'].rows(bytes_column(self.sample_annotation, 'instance_token'))
+        cat = token2ind['category'].rows(bytes_column(self.instance, 'category_token')[inst])
+        add_field('sample_annotation', 'category_name', bytes_column(self.category, 'name')[cat])
+
+        # Decorate sample_data with sensor information.
+        cs = token2ind['calibrated_sensor'].rows(bytes_column(self.sample_data, 'calibrated_sensor_token'))
+        sensor = token2ind['sensor'].rows(bytes_column(self.calibrated_sensor, 'sensor_token')[cs])
+        channels = bytes_column(self.sensor, 'channel')[sensor]
+        add_field('sample_data', 'sensor_modality', bytes_column(self.sensor, 'modality')[sensor])
+        add_field('sample_data', 'channel', channels)
+
+        # Reverse-index samples with sample_data and annotations.
+        data = [dict() for _ in range(len(self.sample))]
+        key_frame = np.flatnonzero(np.asarray(self.sample_data.column('is_key_frame'), dtype=bool))
+        rows = token2ind['sample'].rows(bytes_column(self.sample_data, 'sample_token')[key_frame])
+        for row, channel, sd_row in zip(rows.tolist(), np.char.decode(channels[key_frame], 'utf-8').tolist(),
+                                        key_frame.tolist()):
+            data[row][channel] = sd_row
+        add_field('sample', 'data', data, 'sample_data')
+
+        anns = [[] for _ in range(len(self.sample))]
+        rows = token2ind['sample'].rows(bytes_column(self.sample_annotation, 'sample_token'))
+        for ann_row, row in enumerate(rows.tolist()):
+            anns[row].append(ann_row)
+        add_field('sample', 'anns', anns, 'sample_annotation')
+
+        # Add reverse indices from log records to map records.
+        if 'log_tokens' not in self.map[0].keys():
+            raise Exception('Error: log_tokens not in map table. This code is not compatible with the teaser dataset.')
+        log_to_map = dict()
+        for map_row, map_record in enumerate(self.map):
+            for log_token in map_record['log_tokens']:
+                log_to_map[log_token] = map_row
+        add_field('log', 'map_token', [log_to_map[log_record['token']] for log_record in self.log], 'map')
+
+        # index.json goes last, a half-written index is never read
+        meta = {'version': cache_version, 'sources': sources, 'refs': refs, 'fields': fields}
+        with open(osp.join(index_dir, 'index.json'), 'w') as f:
+            json.dump(meta, f)
+        return meta
+
+    def __token_table__(self, table_name: str, field: str) -> Optional[str]:
+        """ Returns the table the tokens in a field of table_name belong to, None if it is no token field. """
+        if field in ['token', 'prev', 'next']:
+            return table_name
+        if field in ['first_sample_token', 'last_sample_token']:
+            return 'sample'
+        if field in ['first_annotation_token', 'last_annotation_token']:
+            return 'sample_annotation'
+        for suffix in ['_token', '_tokens']:
+            if field.endswith(suffix) and field[:-len(suffix)] in self.table_names:
+                return field[:-len(suffix)]
+        return None
+
     def get(self, table_name: str, token: str) -> dict:
         """
         Returns a record from table in constant runtime.
@@ -220,15 +371,40 @@ class NuScenes:
         """
         return self._token2ind[table_name][token]
 
+    def add_index(self, table_name: str, field: str) -> None:
+        """
+        Declares a secondary index on a field, which makes field2token on it a dict lookup.
+        The index is built on the first query, from the records as they are then. Values must be hashable.
+        :param table_name: Table name.
+        :param field: Field name. See README.md for details.
+        """
+        assert table_name in self.table_names, "Table {} not found".format(table_name)
+        self._secondary_indexes.setdefault((table_name, field), None)
+
     def field2token(self, table_name: str, field: str, query) -> List[str]:
         """
         This function queries all records for a certain field value, and returns the tokens for the matching records.
-        Warning: this runs in linear time.
+        Warning: this runs in linear time, unless there is an index on the field (see add_index).
         :param table_name: Table name.
         :param field: Field name. See README.md for details.
         :param query: Query to match against. Needs to type match the content of the query field.
         :return: List of tokens for the matching records.
         """
+        key = (table_name, field)
+        if key in self._secondary_indexes:
+            index = self._secondary_indexes[key]
+            if index is None:
+                index = dict()
+                table = getattr(self, table_name)
+                if isinstance(table, Table):
+                    values, tokens = table.values(field), table.values('token')
+                else:
+                    values, tokens = [member[field] for member in table], [member['token'] for member in table]
+                for value, token in zip(values, tokens):
+                    index.setdefault(value, []).append(token)
+                self._secondary_indexes[key] = index
+            return list(index.get(query, []))
+
         matches = []
         for member in getattr(self, table_name):
             if member[field] == query:
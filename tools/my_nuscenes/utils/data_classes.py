@@ -3,7 +3,6 @@
 
 import copy
 import os.path as osp
-import struct
 from abc import ABC, abstractmethod
 from functools import reduce
 from typing import Tuple, List, Dict
@@ -13,6 +12,7 @@ import numpy as np
 from matplotlib.axes import Axes
 from pyquaternion import Quaternion
 
+from .data_io import read_pcd
 from .geometry_utils import view_points, transform_matrix
 
 
@@ -72,11 +72,6 @@ class PointCloud(ABC):
         :param min_distance: Distance below which points are discarded.
         :return: (all_pc, all_times). The aggregated point cloud and timestamps.
         """
-        # Init.
-        points = np.zeros((cls.nbr_dims(), 0), dtype=np.float32 if cls == LidarPointCloud else np.float64)
-        all_pc = cls(points)
-        all_times = np.zeros((1, 0))
-
         # Get reference pose and timestamp.
         ref_sd_token = sample_rec['data'][ref_chan]
         ref_sd_rec = nusc.get('sample_data', ref_sd_token)
@@ -91,7 +86,8 @@ class PointCloud(ABC):
         car_from_global = transform_matrix(ref_pose_rec['translation'], Quaternion(ref_pose_rec['rotation']),
                                            inverse=True)
 
-        # Aggregate current and previous sweeps.
+        # Load current and previous sweeps.
+        sweeps = []
         sample_data_token = sample_rec['data'][chan]
         current_sd_rec = nusc.get('sample_data', sample_data_token)
         for _ in range(nsweeps):
@@ -113,13 +109,9 @@ class PointCloud(ABC):
             trans_matrix = reduce(np.dot, [ref_from_car, car_from_global, global_from_car, car_from_current])
             current_pc.transform(trans_matrix)
 
-            # Add time vector which can be used as a temporal feature.
+            # Time lag which can be used as a temporal feature.
             time_lag = ref_time - 1e-6 * current_sd_rec['timestamp']  # Positive difference.
-            times = time_lag * np.ones((1, current_pc.nbr_points()))
-            all_times = np.hstack((all_times, times))
-
-            # Merge with key pc.
-            all_pc.points = np.hstack((all_pc.points, current_pc.points))
+            sweeps.append((current_pc.points, time_lag))
 
             # Abort if there are no previous sweeps.
             if current_sd_rec['prev'] == '':
@@ -127,6 +119,18 @@ class PointCloud(ABC):
             else:
                 current_sd_rec = nusc.get('sample_data', current_sd_rec['prev'])
 
+        # Merge with key pc into buffers allocated once.
+        nbr_points = sum(points.shape[1] for points, _ in sweeps)
+        points = np.empty((cls.nbr_dims(), nbr_points), dtype=np.float32 if cls == LidarPointCloud else np.float64)
+        all_times = np.empty((1, nbr_points))
+        start = 0
+        for sweep_points, time_lag in sweeps:
+            end = start + sweep_points.shape[1]
+            points[:, start:end] = sweep_points
+            all_times[:, start:end] = time_lag
+            start = end
+        all_pc = cls(points)
+
         return all_pc, all_times
 
     def nbr_points(self) -> int:
@@ -320,6 +324,8 @@ class RadarPointCloud(PointCloud):
         POINTS 125
         DATA binary
 
+        DATA can be ascii, binary or binary_compressed, see data_io.read_pcd().
+
         Below some of the fields are explained in more detail:
 
         x is front, y is left
@@ -380,75 +386,23 @@ class RadarPointCloud(PointCloud):
 
         assert file_name.endswith('.pcd'), 'Unsupported filetype {}'.format(file_name)
 
-        meta = []
-        with open(file_name, 'rb') as f:
-            for line in f:
-                line = line.strip().decode('utf-8')
-                meta.append(line)
-                if line.startswith('DATA'):
-                    break
-
-            data_binary = f.read()
-
-        # Get the header rows and check if they appear as expected.
-        assert meta[0].startswith('#'), 'First line must be comment'
-        assert meta[1].startswith('VERSION'), 'Second line must be VERSION'
-        sizes = meta[3].split(' ')[1:]
-        types = meta[4].split(' ')[1:]
-        counts = meta[5].split(' ')[1:]
-        width = int(meta[6].split(' ')[1])
-        height = int(meta[7].split(' ')[1])
-        data = meta[10].split(' ')[1]
-        feature_count = len(types)
-        assert width > 0
-        assert len([c for c in counts if c != c]) == 0, 'Error: COUNT not supported!'
-        assert height == 1, 'Error: height != 0 not supported!'
-        assert data == 'binary'
-
-        # Lookup table for how to decode the binaries.
-        unpacking_lut = {'F': {2: 'e', 4: 'f', 8: 'd'},
-                         'I': {1: 'b', 2: 'h', 4: 'i', 8: 'q'},
-                         'U': {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}}
-        types_str = ''.join([unpacking_lut[t][int(s)] for t, s in zip(types, sizes)])
-
-        # Decode each point.
-        offset = 0
-        point_count = width
-        points = []
-        for i in range(point_count):
-            point = []
-            for p in range(feature_count):
-                start_p = offset
-                end_p = start_p + int(sizes[p])
-                assert end_p < len(data_binary)
-                point_p = struct.unpack(types_str[p], data_binary[start_p:end_p])[0]
-                point.append(point_p)
-                offset = end_p
-            points.append(point)
+        pcd = read_pcd(file_name)
+        points = np.stack([pcd[name].astype(np.float64) for name in pcd.dtype.names])
+        assert points.shape[0] == cls.nbr_dims(), 'Error: Expected {} radar fields in {}, got {}.'.format(
+            cls.nbr_dims(), file_name, points.shape[0])
 
         # A NaN in the first point indicates an empty pointcloud.
-        point = np.array(points[0])
-        if np.any(np.isnan(point)):
-            return cls(np.zeros((feature_count, 0)))
-
-        # Convert to numpy matrix.
-        points = np.array(points).transpose()
+        if points.shape[1] == 0 or np.any(np.isnan(points[:, 0])):
+            return cls(np.zeros((cls.nbr_dims(), 0)))
 
         # If no parameters are provided, use default settings.
         invalid_states = cls.invalid_states if invalid_states is None else invalid_states
         dynprop_states = cls.dynprop_states if dynprop_states is None else dynprop_states
         ambig_states = cls.ambig_states if ambig_states is None else ambig_states
 
-        # Filter points with an invalid state.
-        valid = [p in invalid_states for p in points[-4, :]]
-        points = points[:, valid]
-
-        # Filter by dynProp.
-        valid = [p in dynprop_states for p in points[3, :]]
-        points = points[:, valid]
-
-        # Filter by ambig_state.
-        valid = [p in ambig_states for p in points[11, :]]
+        # Filter points with an invalid state, by dynProp and by ambig_state.
+        valid = np.isin(points[-4, :], list(invalid_states)) & np.isin(points[3, :], list(dynprop_states)) & \
+            np.isin(points[11, :], list(ambig_states))
         points = points[:, valid]
 
         return cls(points)
@@ -670,3 +624,117 @@ class Box:
         :return: A copy.
         """
         return copy.deepcopy(self)
+
+
+class BoxArray:
+    """ N boxes as arrays, for transforming many boxes at once. Box objects are only built by to_boxes(). """
+
+    def __init__(self,
+                 center: np.ndarray,
+                 size: np.ndarray,
+                 orientation: np.ndarray,
+                 label: np.ndarray = None,
+                 score: np.ndarray = None,
+                 velocity: np.ndarray = None,
+                 instance_token: List = None,
+                 name: List[str] = None,
+                 token: str = None):
+        """
+        :param center: <np.float: n, 3>. Centers given as x, y, z.
+        :param size: <np.float: n, 3>. Sizes in width, length, height.
+        :param orientation: <np.float: n, 4>. Orientations as quaternions w, x, y, z.
+        :param label: <np.int: n>. Integer labels, optional.
+        :param score: <np.float: n>. Classification scores, optional.
+        :param velocity: <np.float: n, 3>. Velocities in x, y, z direction, optional.
+        :param instance_token: Per box instance token (or object id), optional.
+        :param name: Per box name, optional.
+        :param token: Token shared by all boxes, optional.
+        """
+        self.center = np.asarray(center, dtype=np.float64).reshape(-1, 3)
+        n = len(self.center)
+        self.wlh = np.asarray(size, dtype=np.float64).reshape(n, 3)
+        self.orientation = np.asarray(orientation, dtype=np.float64).reshape(n, 4)
+        self.label = np.full(n, -1, dtype=np.int64) if label is None else np.asarray(label, dtype=np.int64)
+        self.score = np.full(n, np.nan) if score is None else np.asarray(score, dtype=np.float64)
+        self.velocity = np.full((n, 3), np.nan) if velocity is None else \
+            np.asarray(velocity, dtype=np.float64).reshape(n, 3)
+        self.instance_token = [None] * n if instance_token is None else list(instance_token)
+        self.name = [None] * n if name is None else list(name)
+        self.token = token
+
+    @classmethod
+    def from_boxes(cls, boxes: List[Box]) -> 'BoxArray':
+        return cls([b.center for b in boxes], [b.wlh for b in boxes], [b.orientation.elements for b in boxes],
+                   label=[-1 if np.isnan(b.label) else b.label for b in boxes], score=[b.score for b in boxes],
+                   velocity=[b.velocity for b in boxes], instance_token=[b.instance_token for b in boxes],
+                   name=[b.name for b in boxes], token=boxes[0].token if boxes else None)
+
+    def __len__(self):
+        return len(self.center)
+
+    def __getitem__(self, index) -> 'BoxArray':
+        """ Boxes selected by a mask, slice or index array. """
+        keep = np.arange(len(self))[index]
+        return BoxArray(self.center[keep], self.wlh[keep], self.orientation[keep], self.label[keep],
+                        self.score[keep], self.velocity[keep], [self.instance_token[i] for i in keep],
+                        [self.name[i] for i in keep], self.token)
+
+    def transform(self, trans_mat: np.ndarray) -> None:
+        """
+        Applies a 4x4 transformation to all boxes, same as Box.transform.
+        :param trans_mat: <np.float: 4, 4>. Transformation matrix.
+        """
+        rot_mat = trans_mat[0:3, 0:3]
+        self._rotate(rot_mat, Quaternion(matrix=rot_mat))
+        self.center += trans_mat[0:3, 3]
+
+    def translate(self, x: np.ndarray) -> None:
+        """
+        Applies a translation to all boxes, same as Box.translate.
+        :param x: <np.float: 3>. Translation in x, y, z direction.
+        """
+        self.center = self.center + x
+
+    def rotate(self, quaternion: Quaternion) -> None:
+        """
+        Rotates all boxes, same as Box.rotate.
+        :param quaternion: Rotation to apply.
+        """
+        self._rotate(quaternion.rotation_matrix, quaternion)
+
+    def _rotate(self, rot_mat: np.ndarray, quaternion: Quaternion) -> None:
+        self.center = self.center @ rot_mat.T
+        self.velocity = self.velocity @ rot_mat.T
+        # rotation quaternion times each box quaternion (Hamilton product)
+        w, x, y, z = quaternion.elements
+        q_matrix = np.array([[w, -x, -y, -z],
+                             [x, w, -z, y],
+                             [y, z, w, -x],
+                             [z, -y, x, w]])
+        self.orientation = self.orientation @ q_matrix.T
+
+    def yaw_pitch_roll(self) -> np.ndarray:
+        """
+        Same as Quaternion.yaw_pitch_roll for every box.
+        :return: <np.float: n, 3>. Yaw, pitch and roll in radians.
+        """
+        norm = np.linalg.norm(self.orientation, axis=1, keepdims=True)
+        q0, q1, q2, q3 = (self.orientation / np.where(norm > 0, norm, 1)).T
+        yaw = np.arctan2(2 * (q0 * q3 - q1 * q2), 1 - 2 * (q2 ** 2 + q3 ** 2))
+        pitch = np.arcsin(np.clip(2 * (q0 * q2 + q3 * q1), -1, 1))
+        roll = np.arctan2(2 * (q0 * q1 - q2 * q3), 1 - 2 * (q1 ** 2 + q2 ** 2))
+        return np.stack([yaw, pitch, roll], axis=1)
+
+    @property
+    def yaw(self) -> np.ndarray:
+        return self.yaw_pitch_roll()[:, 0]
+
+    def to_boxes(self) -> List[Box]:
+        return [Box(self.center[i], self.wlh[i], Quaternion(self.orientation[i]),
+                    label=self.label[i] if self.label[i] >= 0 else np.nan, score=self.score[i],
+                    velocity=self.velocity[i], instance_token=self.instance_token[i], name=self.name[i],
+                    token=self.token) for i in range(len(self))]
+
+    def copy(self) -> 'BoxArray':
+        return BoxArray(self.center.copy(), self.wlh.copy(), self.orientation.copy(), self.label.copy(),
+                        self.score.copy(), self.velocity.copy(), self.instance_token, self.name, self.token)
@@ -1,5 +1,11 @@
 import numpy as np
 import os
+from typing import Dict, List, Tuple
+
+try:
+    import lzf
+except ImportError:
+    lzf = None
 
 
 def load_bin_file(bin_path: str, type: str = 'lidarseg') -> np.ndarray:
@@ -29,3 +35,123 @@ def panoptic_to_lidarseg(panoptic_labels: np.ndarray) -> np.ndarray:
     :return: lidarseg semantic labels, <np.array, HxW, np.uint8>.
     """
     return (panoptic_labels // 1000).astype(np.uint8)
+
+
+def lzf_decompress(data: bytes, size: int) -> bytes:
+    """
+    Decompresses a LZF block, with the python-lzf package if it is installed.
+    :param data: The compressed bytes.
+    :param size: Size of the decompressed data.
+    :return: The decompressed bytes.
+    """
+    if lzf is not None:
+        return lzf.decompress(data, size)
+
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            # Literal run of ctrl + 1 bytes.
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+            continue
+        length = ctrl >> 5
+        if length == 7:
+            length += data[i]
+            i += 1
+        length += 2
+        period = ((ctrl & 0x1f) << 8) + data[i] + 1
+        i += 1
+        ref = len(out) - period
+        assert ref >= 0, 'Error: Invalid LZF back reference.'
+        if length <= period:
+            out += out[ref:ref + length]
+        else:
+            # The reference overlaps the bytes it produces, repeat the last period bytes.
+            out += (out[ref:] * (length // period + 1))[:length]
+    assert len(out) == size, 'Error: LZF data decompressed to {} bytes, expected {}.'.format(len(out), size)
+    return bytes(out)
+
+
+def _pcd_fields(header: Dict[str, List[str]]) -> List[Tuple[str, str, int]]:
+    """
+    Returns the fields of a pcd file as (name, format, count), padding fields ('_', as written by pcl for
+    aligned point types) included.
+    :param header: Header of the pcd file, key -> values.
+    :return: The fields in file order.
+    """
+    fields = header['FIELDS']
+    sizes = header['SIZE']
+    types = header.get('TYPE', ['F'] * len(fields))
+    counts = header.get('COUNT', ['1'] * len(fields))
+    kinds = {'F': 'f', 'I': 'i', 'U': 'u'}
+    return [(name, '<{}{}'.format(kinds[t.upper()], int(size)), int(count))
+            for name, size, t, count in zip(fields, sizes, types, counts)]
+
+
+def read_pcd(file_name: str) -> np.ndarray:
+    """
+    Reads a Point Cloud Data file into a numpy structured array, one field per FIELDS entry.
+    Supports ascii, binary and binary_compressed data.
+    :param file_name: Path of the pcd file.
+    :return: <np.void: n>. The points, binary data is read without copying.
+    """
+    header = dict()
+    with open(file_name, 'rb') as f:
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError('Error: No DATA line in {}.'.format(file_name))
+            line = line.strip().decode('utf-8')
+            if not line or line.startswith('#'):
+                continue
+            key, _, value = line.partition(' ')
+            header[key.upper()] = value.split()
+            if key.upper() == 'DATA':
+                break
+        body = f.read()
+
+    if 'POINTS' in header:
+        num_points = int(header['POINTS'][0])
+    else:
+        num_points = int(header['WIDTH'][0]) * int(header.get('HEIGHT', ['1'])[0])
+
+    # Padding fields are left out of the dtype and skipped via the offsets.
+    fields = _pcd_fields(header)
+    names, formats, offsets = [], [], []
+    itemsize = 0
+    for name, fmt, count in fields:
+        if name != '_' and count > 0:
+            names.append(name)
+            formats.append((fmt, (count,)) if count > 1 else fmt)
+            offsets.append(itemsize)
+        itemsize += np.dtype(fmt).itemsize * count
+    dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize})
+
+    data = header['DATA'][0].lower()
+    if data == 'binary':
+        return np.frombuffer(body, dtype=dtype, count=num_points)
+
+    points = np.zeros(num_points, dtype=dtype)
+    if data == 'ascii':
+        values = np.array(body.split(), dtype=np.float64).reshape(num_points, -1)
+        column = 0
+        for name, fmt, count in fields:
+            if name != '_' and count > 0:
+                points[name] = values[:, column] if count == 1 else values[:, column:column + count]
+            column += count
+    elif data == 'binary_compressed':
+        # Compressed and uncompressed size, then the LZF compressed data with the fields one after the other.
+        compressed_size, size = np.frombuffer(body, dtype='<u4', count=2).tolist()
+        body = lzf_decompress(body[8:8 + compressed_size], size) if size else b''
+        start = 0
+        for name, fmt, count in fields:
+            end = start + num_points * np.dtype(fmt).itemsize * count
+            if name != '_' and count > 0:
+                points[name] = np.frombuffer(body[start:end], dtype=fmt).reshape(points[name].shape)
+            start = end
+    else:
+        raise ValueError('Error: Unsupported pcd DATA {} in {}.'.format(data, file_name))
+    return points
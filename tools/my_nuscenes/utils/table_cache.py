@@ -0,0 +1,458 @@
+# Binary cache of the nuScenes json tables.
+# Every table is stored column by column under <cache_dir>/<version>/<table>/:
+#   table.json                          source file signature and sha1, record count and (field, kind) list
+#   <field>.npy                         'scalar' fields (str as utf-8 bytes, int, float, bool)
+#   <field>.offsets.npy / .values.npy   'list' fields, flat lists of scalars
+#   <field>.keys.npy                    'dict' fields, with offsets and values as for 'list'
+#   <field>.pkl                         'object' fields, anything else (nested lists, mixed types)
+#   records.pkl                         whole table, if the records don't share one set of keys
+# Columns are memory-mapped and records are only turned into dicts when they are accessed.
+# Token fields can be read as rows of the table the tokens belong to, see TokenStrings.
+
+import hashlib
+import json
+import os
+import os.path as osp
+import pickle
+import shutil
+from collections.abc import Sequence
+from typing import Any, Iterable, List, Tuple
+
+import numpy as np
+
+cache_version = 3
+
+
+def _scalar_array(values: list):
+    """ Returns values as a numpy array if they all are str, int, float or bool of one type, else None. """
+    kinds = set(type(v) for v in values)
+    if len(kinds) != 1:
+        return None if kinds else np.zeros(0)
+    kind = kinds.pop()
+    if kind is str:
+        return np.array([v.encode('utf-8') for v in values], dtype=np.bytes_)
+    if kind is int:
+        if min(values) < np.iinfo(np.int64).min or max(values) > np.iinfo(np.int64).max:
+            return None
+        return np.array(values, dtype=np.int64)
+    if kind is float:
+        return np.array(values, dtype=np.float64)
+    if kind is bool:
+        return np.array(values, dtype=bool)
+    return None
+
+
+def _to_list(array: np.ndarray, strings: 'TokenStrings' = None) -> list:
+    if strings is not None:
+        return strings.get_many(array.tolist())
+    if array.dtype.kind == 'S':
+        return [v.decode('utf-8') for v in array.tolist()]
+    return array.tolist()
+
+
+class _ScalarColumn:
+    def __init__(self, array: np.ndarray, strings: 'TokenStrings' = None):
+        self.array = array
+        self.strings = strings
+
+    def get(self, ind: int) -> Any:
+        value = self.array[ind]
+        if self.strings is not None:
+            return self.strings.get(int(value))
+        return value.decode('utf-8') if isinstance(value, bytes) else value.item()
+
+    def tolist(self, start: int = 0, end: int = None) -> list:
+        return _to_list(self.array[start:end], self.strings)
+
+
+class _RowColumn:
+    """ The token field of a table, record i has the token of row i. """
+
+    def __init__(self, strings: 'TokenStrings'):
+        self.strings = strings
+
+    def get(self, ind: int) -> str:
+        return self.strings.get(ind)
+
+    def tolist(self, start: int = 0, end: int = None) -> list:
+        return self.strings.get_many(range(*slice(start, end).indices(len(self.strings.tokens))))
+
+
+class _ListColumn:
+    def __init__(self, offsets: np.ndarray, values: np.ndarray, strings: 'TokenStrings' = None):
+        self.offsets = offsets
+        self.values = values
+        self.strings = strings
+
+    def get(self, ind: int) -> list:
+        return _to_list(self.values[self.offsets[ind]:self.offsets[ind + 1]], self.strings)
+
+    def tolist(self, start: int = 0, end: int = None) -> list:
+        offsets = self.offsets[start:None if end is None else end + 1].tolist()
+        values = _to_list(self.values[offsets[0]:offsets[-1]], self.strings)
+        return [values[a - offsets[0]:b - offsets[0]] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+class _DictColumn:
+    def __init__(self, offsets: np.ndarray, keys: np.ndarray, values: np.ndarray, strings: 'TokenStrings' = None):
+        self.offsets = offsets
+        self.keys = keys
+        self.values = values
+        self.strings = strings
+
+    def get(self, ind: int) -> dict:
+        start, end = self.offsets[ind], self.offsets[ind + 1]
+        return dict(zip(_to_list(self.keys[start:end]), _to_list(self.values[start:end], self.strings)))
+
+    def tolist(self, start: int = 0, end: int = None) -> list:
+        offsets = self.offsets[start:None if end is None else end + 1].tolist()
+        items = list(zip(_to_list(self.keys[offsets[0]:offsets[-1]]),
+                         _to_list(self.values[offsets[0]:offsets[-1]], self.strings)))
+        return [dict(items[a - offsets[0]:b - offsets[0]]) for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+class _ObjectColumn:
+    def __init__(self, path: str):
+        self.path = path
+        self._values = None
+
+    def get(self, ind: int) -> Any:
+        return self.tolist()[ind]
+
+    def tolist(self, start: int = 0, end: int = None) -> list:
+        if self._values is None:
+            with open(self.path, 'rb') as f:
+                self._values = pickle.load(f)
+        return self._values[start:end]
+
+
+class Table(Sequence):
+    """
+    One table of the cache, used in place of the list of records json.load returns.
+    A record is built from the columns on first access and kept, so changes made to it stick. Records are built
+    block_size at a time, lookups of nearby records (sweeps, annotations of a sample) mostly hit built ones.
+    """
+
+    block_size = 64
+
+    def __init__(self, size: int, fields: List[Tuple[str, Any]]):
+        """
+        :param size: Number of records.
+        :param fields: (field name, column) in record key order.
+        """
+        self.fields = fields
+        self._records = [None] * size
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return [self[i] for i in range(*ind.indices(len(self)))]
+        if ind < 0:
+            ind += len(self)
+        record = self._records[ind]
+        if record is None:
+            start = ind - ind % self.block_size
+            self.materialize(start, start + self.block_size)
+            record = self._records[ind]
+        return record
+
+    def __iter__(self):
+        self.materialize()
+        return iter(self._records)
+
+    def materialize(self, start: int = 0, end: int = None) -> None:
+        """ Builds the records from start to end not accessed yet, a column at a time. """
+        start, end, _ = slice(start, end).indices(len(self._records))
+        missing = [i for i in range(start, end) if self._records[i] is None]
+        if not missing:
+            return
+        names = [name for name, _ in self.fields]
+        values = [column.tolist(start, end) for _, column in self.fields]
+        for i in missing:
+            self._records[i] = dict(zip(names, [v[i - start] for v in values]))
+
+    def column(self, name: str) -> Any:
+        """
+        Raw column of a field: a numpy array for 'scalar' fields, (offsets, values) for 'list' fields.
+        Tokens stored as rows are returned as utf-8 bytes.
+        """
+        column = dict(self.fields)[name]
+        if isinstance(column, _RowColumn):
+            return column.strings.tokens
+        if isinstance(column, _ScalarColumn):
+            return column.array if column.strings is None else column.strings.tokens_of(column.array)
+        if isinstance(column, _ListColumn):
+            if column.strings is None:
+                return column.offsets, column.values
+            return column.offsets, column.strings.tokens_of(column.values)
+        return column.tolist()
+
+    def values(self, name: str) -> list:
+        """ The field of every record, taken from the records already built (which may have been changed). """
+        values = dict(self.fields)[name].tolist()
+        return [value if record is None else record[name] for value, record in zip(values, self._records)]
+
+    def set_column(self, name: str, column: Any) -> None:
+        """ Reads an existing field from another column with the same values, e.g. tokens stored as rows. """
+        self.fields = [(field, column if field == name else c) for field, c in self.fields]
+
+    def add_field(self, name: str, column: Any) -> None:
+        """ Adds a field (a column read by read_column) to every record, built or not. """
+        self.fields.append((name, column))
+        for i, record in enumerate(self._records):
+            if record is not None:
+                record[name] = column.get(i)
+
+
+class _RecordsTable(Table):
+    """ A table whose records don't share one set of keys, cached as a whole. """
+
+    def __init__(self, records: list):
+        super().__init__(len(records), [])
+        self._records = records
+
+    def column(self, name: str) -> Any:
+        values = [record[name] for record in self._records]
+        array = _scalar_array(values)
+        return array if array is not None else values
+
+    def values(self, name: str) -> list:
+        return [record[name] for record in self._records]
+
+    def add_field(self, name: str, column: Any) -> None:
+        for record, value in zip(self._records, column.tolist()):
+            record[name] = value
+
+
+def bytes_column(table: Table, name: str) -> np.ndarray:
+    """ A str field of every record as an array of utf-8 bytes. """
+    column = table.column(name)
+    if isinstance(column, np.ndarray):
+        return column
+    return np.array([v.encode('utf-8') for v in column], dtype=np.bytes_)
+
+
+def _load(path: str) -> np.ndarray:
+    """ Memory-maps a npy file, as a plain array view (indexing a np.memmap is a lot slower). """
+    return np.load(path, mmap_mode='r').view(np.ndarray)
+
+
+def write_column(path: str, values) -> str:
+    """
+    Writes one field of a table.
+    :param path: Path of the column files without extension.
+    :param values: List of the field values, or a numpy array of scalars.
+    :return: The column kind, needed by read_column.
+    """
+    array = values if isinstance(values, np.ndarray) else _scalar_array(values)
+    if array is not None:
+        np.save(path + '.npy', array)
+        return 'scalar'
+    if all(type(v) is list for v in values):
+        flat = _scalar_array([item for v in values for item in v])
+        if flat is not None:
+            np.save(path + '.offsets.npy', _offsets(values))
+            np.save(path + '.values.npy', flat)
+            return 'list'
+    if all(type(v) is dict for v in values):
+        keys = _scalar_array([key for v in values for key in v.keys()])
+        flat = _scalar_array([item for v in values for item in v.values()])
+        if keys is not None and flat is not None:
+            np.save(path + '.offsets.npy', _offsets(values))
+            np.save(path + '.keys.npy', keys)
+            np.save(path + '.values.npy', flat)
+            return 'dict'
+    with open(path + '.pkl', 'wb') as f:
+        pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return 'object'
+
+
+def _offsets(values: list) -> np.ndarray:
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(v) for v in values])
+    return offsets
+
+
+def read_column(path: str, kind: str, strings: 'TokenStrings' = None) -> Any:
+    """
+    Opens a column written by write_column.
+    :param strings: For columns of rows (int values), the tokens of the table they are rows of.
+    """
+    if kind == 'scalar':
+        return _ScalarColumn(_load(path + '.npy'), strings)
+    if kind == 'list':
+        return _ListColumn(_load(path + '.offsets.npy'),
+                           _load(path + '.values.npy'), strings)
+    if kind == 'dict':
+        return _DictColumn(_load(path + '.offsets.npy'),
+                           _load(path + '.keys.npy'),
+                           _load(path + '.values.npy'), strings)
+    if kind == 'row':
+        return _RowColumn(strings)
+    return _ObjectColumn(path + '.pkl')
+
+
+def write_table(records: list, table_dir: str, source: dict) -> None:
+    """ Writes records (as loaded from the json table) to table_dir. """
+    if osp.isdir(table_dir):
+        shutil.rmtree(table_dir)
+    os.makedirs(table_dir)
+    keys = list(records[0].keys()) if records else []
+    fields = []
+    if any(list(record.keys()) != keys for record in records):
+        with open(osp.join(table_dir, 'records.pkl'), 'wb') as f:
+            pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+        fields = None
+    else:
+        for name in keys:
+            fields.append((name, write_column(osp.join(table_dir, name), [record[name] for record in records])))
+
+    # table.json goes last, a half-written table is never read
+    with open(osp.join(table_dir, 'table.json'), 'w') as f:
+        json.dump({'version': cache_version, 'source': source, 'size': len(records), 'fields': fields}, f)
+
+
+def read_table(table_dir: str) -> Table:
+    """ Opens a table written by write_table, the columns are memory-mapped. """
+    with open(osp.join(table_dir, 'table.json')) as f:
+        meta = json.load(f)
+    if meta['fields'] is None:
+        with open(osp.join(table_dir, 'records.pkl'), 'rb') as f:
+            return _RecordsTable(pickle.load(f))
+    return Table(meta['size'], [(name, read_column(osp.join(table_dir, name), kind)) for name, kind in meta['fields']])
+
+
+def table_hash(table_dir: str) -> str:
+    """ sha1 of the json file the cached table was built from. """
+    with open(osp.join(table_dir, 'table.json')) as f:
+        return json.load(f)['source']['sha1']
+
+
+def is_stale(table_dir: str, json_path: str) -> bool:
+    meta_path = osp.join(table_dir, 'table.json')
+    if not osp.isfile(meta_path):
+        return True
+    with open(meta_path) as f:
+        meta = json.load(f)
+    stat = os.stat(json_path)
+    return meta.get('version') != cache_version or \
+        (meta['source']['size'], meta['source']['mtime']) != (stat.st_size, stat.st_mtime)
+
+
+def load_table(json_path: str, table_dir: str) -> Table:
+    """ Returns the cached table of json_path, (re)building the cache if the json changed since. """
+    if is_stale(table_dir, json_path):
+        stat = os.stat(json_path)
+        with open(json_path, 'rb') as f:
+            data = f.read()
+        source = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': hashlib.sha1(data).hexdigest()}
+        write_table(json.loads(data), table_dir, source)
+    return read_table(table_dir)
+
+
+class TokenIndex(dict):
+    """
+    token -> row of a table, a binary search over the sorted tokens.
+    The dict holds the rows found so far, so looking up a token again is a plain dict lookup.
+    """
+
+    def __init__(self, sorted_tokens: np.ndarray, order: np.ndarray):
+        """
+        :param sorted_tokens: Tokens of the table as utf-8 bytes, sorted.
+        :param order: Rows of the sorted tokens, sorted_tokens[k] is the token of row order[k].
+        """
+        super().__init__()
+        self.sorted_tokens = sorted_tokens
+        self.order = order
+
+    @classmethod
+    def from_tokens(cls, tokens: np.ndarray) -> 'TokenIndex':
+        order = np.argsort(tokens, kind='stable')
+        return cls(tokens[order], order)
+
+    def save(self, path: str) -> None:
+        np.save(path + '.sorted_tokens.npy', self.sorted_tokens)
+        np.save(path + '.order.npy', self.order)
+
+    @classmethod
+    def load(cls, path: str) -> 'TokenIndex':
+        return cls(_load(path + '.sorted_tokens.npy'), _load(path + '.order.npy'))
+
+    def __missing__(self, token: str) -> int:
+        key = token.encode('utf-8')
+        pos = np.searchsorted(self.sorted_tokens, key)
+        if pos == len(self.sorted_tokens) or self.sorted_tokens[pos] != key:
+            raise KeyError(token)
+        ind = int(self.order[pos])
+        self[token] = ind
+        return ind
+
+    def __contains__(self, token) -> bool:
+        try:
+            self[token]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self.sorted_tokens)
+
+    def __iter__(self):
+        return iter(_to_list(self.sorted_tokens))
+
+    def rows(self, tokens: np.ndarray, empty: bool = False) -> np.ndarray:
+        """
+        Rows of tokens (utf-8 bytes array), all of which must be in the table.
+        :param empty: Whether empty tokens (no prev/next) are allowed, their row is -1.
+        """
+        if len(tokens) == 0 or len(self.sorted_tokens) == 0:
+            pos = np.zeros(len(tokens), dtype=np.int64)
+            found = np.zeros(len(tokens), dtype=bool)
+        else:
+            pos = np.minimum(np.searchsorted(self.sorted_tokens, tokens), len(self.sorted_tokens) - 1)
+            found = self.sorted_tokens[pos] == tokens
+        missing = ~found & (tokens != b'') if empty else ~found
+        if missing.any():
+            raise KeyError(tokens[missing][0].decode('utf-8'))
+        return np.where(found, np.asarray(self.order)[pos] if found.any() else -1, -1)
+
+
+class TokenStrings:
+    """
+    Tokens of a table as str, each made once and shared by every record it appears in, for columns that
+    store tokens as rows. Making one also tells the table's TokenIndex its row, so get() with a token
+    read from a record is a dict lookup.
+    """
+
+    def __init__(self, tokens: np.ndarray, index: TokenIndex):
+        """
+        :param tokens: Tokens of the table as utf-8 bytes, in row order.
+        :param index: TokenIndex of the table.
+        """
+        self.tokens = tokens
+        self.index = index
+        self._strings = None
+
+    def get(self, row: int) -> str:
+        if row < 0:
+            return ''
+        if self._strings is None:
+            self._strings = [None] * len(self.tokens)
+        token = self._strings[row]
+        if token is None:
+            token = self.tokens[row].decode('utf-8')
+            self._strings[row] = token
+            self.index[token] = row
+        return token
+
+    def get_many(self, rows: Iterable[int]) -> list:
+        return [self.get(row) for row in rows]
+
+    def tokens_of(self, rows: np.ndarray) -> np.ndarray:
+        """ utf-8 bytes of the tokens of rows, empty for -1. """
+        rows = np.asarray(rows)
+        if not (rows >= 0).any():
+            return np.full(len(rows), b'', dtype=np.bytes_)
+        return np.where(rows >= 0, self.tokens[np.maximum(rows, 0)], b'')
@@ -0,0 +1,190 @@
+import json
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from tools.my_nuscenes.nuscenes import NuScenes
+from tools.my_nuscenes.utils.table_cache import Table, load_table
+
+
+def make_tables(num_samples: int = 4, num_instances: int = 3) -> dict:
+    """ A small database of one scene, with lidar sweeps and annotations linked by prev/next. """
+    tables = {name: [] for name in ['category', 'attribute', 'visibility', 'instance', 'sensor', 'calibrated_sensor',
+                                    'ego_pose', 'log', 'scene', 'sample', 'sample_data', 'sample_annotation', 'map']}
+    tables['category'] = [{'token': 'cat0', 'name': 'vehicle.car', 'description': ''},
+                          {'token': 'cat1', 'name': 'human.pedestrian.adult', 'description': ''}]
+    tables['attribute'] = [{'token': 'attr0', 'name': 'vehicle.moving', 'description': ''}]
+    tables['visibility'] = [{'token': '4', 'level': 'v80-100', 'description': ''}]
+    tables['sensor'] = [{'token': 'sensor0', 'channel': 'LIDAR_TOP', 'modality': 'lidar'}]
+    tables['calibrated_sensor'] = [{'token': 'cs0', 'sensor_token': 'sensor0', 'translation': [0.9, 0.0, 1.8],
+                                    'rotation': [1.0, 0.0, 0.0, 0.0], 'camera_intrinsic': []}]
+    tables['log'] = [{'token': 'log0', 'logfile': '', 'vehicle': '', 'date_captured': '', 'location': 'boston'}]
+    tables['map'] = [{'token': 'map0', 'log_tokens': ['log0'], 'category': 'semantic_prior',
+                      'filename': 'maps/map0.png'}]
+    tables['instance'] = [{'token': 'inst{}'.format(i), 'category_token': 'cat{}'.format(i % 2),
+                           'nbr_annotations': num_samples, 'first_annotation_token': 'ann{}_0'.format(i),
+                           'last_annotation_token': 'ann{}_{}'.format(i, num_samples - 1)}
+                          for i in range(num_instances)]
+    samples = ['sample{}'.format(k) for k in range(num_samples)]
+    tables['scene'] = [{'token': 'scene0', 'log_token': 'log0', 'nbr_samples': num_samples,
+                        'first_sample_token': samples[0], 'last_sample_token': samples[-1],
+                        'name': 'scene-0001', 'description': ''}]
+
+    sample_data = []
+    for k, sample in enumerate(samples):
+        timestamp = 1533151603547590 + k * 500000
+        tables['sample'].append({'token': sample, 'timestamp': timestamp, 'prev': samples[k - 1] if k else '',
+                                 'next': samples[k + 1] if k + 1 < num_samples else '', 'scene_token': 'scene0'})
+        # A key frame and a sweep per sample.
+        for j in range(2):
+            token = 'sd{}_{}'.format(k, j)
+            tables['ego_pose'].append({'token': 'ep' + token[2:], 'timestamp': timestamp + j * 50000,
+                                       'rotation': [1.0, 0.0, 0.0, 0.0], 'translation': [float(k), 0.5 * j, 0.0]})
+            sample_data.append({'token': token, 'sample_token': sample, 'ego_pose_token': 'ep' + token[2:],
+                                'calibrated_sensor_token': 'cs0', 'timestamp': timestamp + j * 50000,
+                                'fileformat': 'pcd', 'is_key_frame': j == 0, 'height': 0, 'width': 0,
+                                'filename': 'samples/LIDAR_TOP/{}.pcd.bin'.format(token)})
+        for i in range(num_instances):
+            tables['sample_annotation'].append({
+                'token': 'ann{}_{}'.format(i, k), 'sample_token': sample, 'instance_token': 'inst{}'.format(i),
+                'visibility_token': '4', 'attribute_tokens': ['attr0'] if i == 0 else [],
+                'translation': [float(i), float(k), 0.0], 'size': [1.8, 4.5, 1.6], 'rotation': [1.0, 0.0, 0.0, 0.0],
+                'prev': 'ann{}_{}'.format(i, k - 1) if k else '',
+                'next': 'ann{}_{}'.format(i, k + 1) if k + 1 < num_samples else '',
+                'num_lidar_pts': 10 * k, 'num_radar_pts': 0})
+    for ind, record in enumerate(sample_data):
+        record['prev'] = sample_data[ind - 1]['token'] if ind else ''
+        record['next'] = sample_data[ind + 1]['token'] if ind + 1 < len(sample_data) else ''
+    tables['sample_data'] = sample_data
+    return tables
+
+
+def strip_masks(records: list) -> list:
+    return [{key: value for key, value in record.items() if key != 'mask'} for record in records]
+
+
+class TestTableCache(unittest.TestCase):
+
+    version = 'v1.0-mini'
+
+    def setUp(self):
+        self.dataroot = tempfile.mkdtemp()
+        self.cache = osp.join(self.dataroot, 'table_cache')
+        self.tables = make_tables()
+        os.makedirs(osp.join(self.dataroot, self.version))
+        os.makedirs(osp.join(self.dataroot, 'maps'))
+        cv2.imwrite(osp.join(self.dataroot, 'maps', 'map0.png'), np.zeros((4, 4), np.uint8))
+        for name, records in self.tables.items():
+            self.write_table(name, records)
+
+    def tearDown(self):
+        shutil.rmtree(self.dataroot)
+
+    def write_table(self, name: str, records: list) -> None:
+        with open(osp.join(self.dataroot, self.version, name + '.json'), 'w') as f:
+            json.dump(records, f)
+
+    def nusc(self, cached: bool = True) -> NuScenes:
+        return NuScenes(version=self.version, dataroot=self.dataroot, verbose=False,
+                        table_cache=self.cache if cached else None)
+
+    def test_records_equal_json(self):
+        """ Cached records (decorations included) are the ones json.load and the reverse indexing give. """
+        plain = self.nusc(cached=False)
+        self.nusc()  # Builds the cache.
+        for nusc in [self.nusc(), self.nusc()]:
+            for name in plain.table_names:
+                table = getattr(nusc, name)
+                self.assertIsInstance(table, Table)
+                self.assertEqual(strip_masks(getattr(plain, name)), strip_masks(table))
+                # Same key order and value types as json.load.
+                for expected, record in zip(getattr(plain, name), table):
+                    self.assertEqual(list(expected.keys()), list(record.keys()))
+                    self.assertEqual([type(v) for v in expected.values()], [type(v) for v in record.values()])
+
+        table_dir = osp.join(self.cache, self.version, 'sample_annotation')
+        json_path = osp.join(self.dataroot, self.version, 'sample_annotation.json')
+        self.assertEqual(self.tables['sample_annotation'], list(load_table(json_path, table_dir)))
+
+    def test_prev_next_rows(self):
+        """ prev/next are stored as rows of their own table and read back as the tokens, '' included. """
+        nusc = self.nusc()
+        with open(osp.join(self.cache, self.version, 'reverse_index', 'index.json')) as f:
+            refs = json.load(f)['refs']
+        for name in ['sample', 'sample_data', 'sample_annotation']:
+            self.assertIn(['prev', 'scalar', name], refs[name])
+            self.assertIn(['next', 'scalar', name], refs[name])
+            rows = np.load(osp.join(self.cache, self.version, 'reverse_index', name + '.prev.npy'))
+            self.assertEqual(-1, rows[0])
+
+            records = self.tables[name]
+            table = getattr(nusc, name)
+            for field in ['prev', 'next']:
+                self.assertIn('', [record[field] for record in records])
+                self.assertEqual([record[field] for record in records], [record[field] for record in table])
+                self.assertEqual([record[field].encode('utf-8') for record in records],
+                                 table.column(field).tolist())
+
+        # Walking the chain with get() visits the records in order.
+        sd = nusc.get('sample_data', self.tables['sample_data'][-1]['token'])
+        tokens = [sd['token']]
+        while sd['prev'] != '':
+            sd = nusc.get('sample_data', sd['prev'])
+            tokens.append(sd['token'])
+        self.assertEqual([record['token'] for record in reversed(self.tables['sample_data'])], tokens)
+
+    def test_reverse_index_rebuild(self):
+        """ The reverse index is reused if a table only got a new mtime, and rebuilt if its content changed. """
+        self.nusc()
+        index_path = osp.join(self.cache, self.version, 'reverse_index', 'index.json')
+        table_meta_path = osp.join(self.cache, self.version, 'category', 'table.json')
+        json_path = osp.join(self.dataroot, self.version, 'category.json')
+        with open(index_path) as f:
+            sources = json.load(f)['sources']
+        os.utime(index_path, (1000000000, 1000000000))
+
+        # Same content, new mtime: the table is re-read but hashes the same.
+        os.utime(json_path, (1500000000, 1500000000))
+        nusc = self.nusc()
+        with open(table_meta_path) as f:
+            self.assertEqual(1500000000, json.load(f)['source']['mtime'])
+        self.assertEqual(1000000000, os.stat(index_path).st_mtime)
+        self.assertEqual('vehicle.car', nusc.get('sample_annotation', 'ann0_0')['category_name'])
+
+        # New content: the decorations follow it.
+        self.tables['category'][0]['name'] = 'vehicle.emergency.police'
+        self.write_table('category', self.tables['category'])
+        os.utime(json_path, (1600000000, 1600000000))
+        nusc = self.nusc()
+        self.assertNotEqual(1000000000, os.stat(index_path).st_mtime)
+        with open(index_path) as f:
+            new_sources = json.load(f)['sources']
+        self.assertNotEqual(sources['category'], new_sources['category'])
+        self.assertEqual({k: v for k, v in sources.items() if k != 'category'},
+                         {k: v for k, v in new_sources.items() if k != 'category'})
+        self.assertEqual('vehicle.emergency.police', nusc.get('sample_annotation', 'ann0_0')['category_name'])
+        self.assertEqual('human.pedestrian.adult', nusc.get('sample_annotation', 'ann1_0')['category_name'])
+
+    def test_field2token_index(self):
+        """ field2token through an index gives what the linear scan gives. """
+        for nusc in [self.nusc(cached=False), self.nusc()]:
+            nusc.add_index('sample_annotation', 'category_name')
+            nusc.add_index('instance', 'category_token')
+            queries = [('sample', 'scene_token', 'scene0'), ('sample', 'scene_token', 'scene1'),
+                       ('sample_annotation', 'instance_token', 'inst2'),
+                       ('sample_annotation', 'category_name', 'vehicle.car'),
+                       ('instance', 'category_token', 'cat1')]
+            for table_name, field, query in queries:
+                expected = [record['token'] for record in getattr(nusc, table_name) if record[field] == query]
+                self.assertEqual(expected, nusc.field2token(table_name, field, query))
+            # Unindexed fields are scanned.
+            self.assertEqual(['sample3'], nusc.field2token('sample', 'next', ''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,16 @@ import os
 from os import path as osp
 from pyquaternion import Quaternion
 import pickle
-from functools import reduce
+from functools import reduce, lru_cache
 from typing import List
 from tqdm import tqdm
 import copy
-from tools.my_nuscenes.utils.data_classes import Box
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tools.my_nuscenes.utils.data_classes import Box, BoxArray
 from tools.my_nuscenes.utils.geometry_utils import transform_matrix
+from scene_index import FrameTokenIndex
 from pyquaternion import Quaternion
 import json
 
@@ -79,7 +83,9 @@ def quaternion_yaw(q: Quaternion) -> float:
 
 
 def create_nuscenes_infos(root_path,
-                          version='v1.0-trainval'):
+                          version='v1.0-trainval',
+                          workers=os.cpu_count(),
+                          table_cache=None):
     """Create info file of nuscene dataset.
 
     Given the raw data, generate its related info file in pkl format.
@@ -88,33 +94,18 @@ def create_nuscenes_infos(root_path,
         root_path (str): Path of the data root.
         version (str): Version of the data.
             Default: 'v1.0-trainval'
+        workers (int): Processes the scenes are spread over.
+        table_cache (str): Writable folder for the binary table cache of
+            NuScenes, see NuScenes(table_cache). Default: None, no cache.
     """
     from tools.my_nuscenes.nuscenes import NuScenes
-    nusc = NuScenes(version=version, dataroot=root_path, verbose=True)
+    nusc = NuScenes(version=version, dataroot=root_path, verbose=True, table_cache=table_cache)
     from tools.my_nuscenes.utils import splits
 
     if version == "v1.0-mini":
-        info_path = osp.join(root_path, 'SUSTech_data_infos.pkl')
-        if not osp.exists(info_path):
-            train_scenes = nusc.scene
-            train_nusc_infos = _fill_trainval_infos(nusc, train_scenes)
-            metadata = dict(version=version)
-            data = dict(infos=train_nusc_infos, metadata=metadata)
-            with open(info_path, 'wb') as f:
-                pickle.dump(data, f)
-        else:
-            with open(info_path, 'rb') as f:
-                train_nusc_infos = pickle.load(f)["infos"]
-        #
-        info_path = osp.join(root_path, 'SUSTech_data_infos_real.pkl')
-        if not osp.exists(info_path):
-            train_nusc_infos1 = _fill_trainval_infos_SUSTECH(nusc, train_nusc_infos)
-            with open(info_path, 'wb') as f:
-                pickle.dump(train_nusc_infos1, f)
-        else:
-            with open(info_path, 'rb') as f:
-                train_nusc_infos1 = pickle.load(f)
-
+        train_nusc_infos1 = _create_split_infos(nusc, nusc.scene, osp.join(root_path, 'SUSTech_data_infos.pkl'),
+                                                osp.join(root_path, 'SUSTech_data_infos_real.pkl'),
+                                                osp.join(root_path, 'SUSTech_data_infos_shards'), workers)
         #     det_infos = convert_detection_file(train_nusc_infos1,"/home/yaozh/WebstormProjects/my_pcl_annotate/infos_trainval_10sweeps_withvelo_filter_True.json")
         #     info_path = osp.joinoutput_val(root_path, 'SUSTech_data_det_infos.json')
         #     with open(info_path, 'w') as f:
@@ -134,24 +125,9 @@ def create_nuscenes_infos(root_path,
             else:
                 scenes = list(filter(lambda x: x["name"] in splits.val, nusc_scenes))
             print('sceneNums: {}'.format(len(scenes)))
-            if not osp.exists(info_path):
-                train_nusc_infos = _fill_trainval_infos(nusc, scenes)
-                metadata = dict(version=version)
-                data = dict(infos=train_nusc_infos, metadata=metadata)
-                with open(info_path, 'wb') as f:
-                    pickle.dump(data, f)
-            else:
-                with open(info_path, 'rb') as f:
-                    train_nusc_infos = pickle.load(f)["infos"]
-
-            info_path = osp.join(root_path, 'SUSTech_data_infos' + dataset + '_real.pkl')
-            if not osp.exists(info_path):
-                train_nusc_infos1 = _fill_trainval_infos_SUSTECH(nusc, train_nusc_infos)
-                with open(info_path, 'wb') as f:
-                    pickle.dump(train_nusc_infos1, f)
-            else:
-                with open(info_path, 'rb') as f:
-                    train_nusc_infos1 = pickle.load(f)
+            train_nusc_infos1 = _create_split_infos(nusc, scenes, info_path,
+                                                    osp.join(root_path, 'SUSTech_data_infos' + dataset + '_real.pkl'),
+                                                    osp.join(root_path, 'SUSTech_data_infos_shards_' + dataset), workers)
 
             output_dir = "/home/yaozh/WebstormProjects/pcl_annotate_tool/outputs/output_" + dataset
             if dataset != "train":
@@ -169,173 +145,267 @@ def create_nuscenes_infos(root_path,
         os.system("poweroff")
 
 
-def convert_tracking_file(sustech_info, track_path):
+def _create_split_infos(nusc, scenes, info_path, real_path, shard_dir, workers):
+    """Returns the SUSTech infos of the scenes, from real_path if it exists, else built (and saved) from the
+    nuScenes infos in info_path or, if that does not exist either, from scene shards (see _fill_infos_sharded)."""
+    if osp.exists(real_path):
+        with open(real_path, 'rb') as f:
+            return pickle.load(f)
+    if osp.exists(info_path):
+        with open(info_path, 'rb') as f:
+            train_nusc_infos = pickle.load(f)["infos"]
+        train_nusc_infos1 = _fill_trainval_infos_SUSTECH(nusc, train_nusc_infos)
+    else:
+        train_nusc_infos, train_nusc_infos1 = _fill_infos_sharded(nusc, scenes, shard_dir, workers)
+        with open(info_path, 'wb') as f:
+            pickle.dump(dict(infos=train_nusc_infos, metadata=dict(version=nusc.version)), f)
+    with open(real_path, 'wb') as f:
+        pickle.dump(train_nusc_infos1, f)
+    if osp.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    return train_nusc_infos1
+
+
+# the NuScenes instance of _fill_infos_sharded, inherited by the forked workers instead of pickled
+_shard_nusc = None
+
+
+def _build_shard(scene, shard_path):
+    info = _fill_scene_infos(_shard_nusc, scene)
+    shard = {"info": info, "sustech": _scene_info_SUSTECH(_shard_nusc.version, info, None)}
+    tmp_path = "{}.tmp{}".format(shard_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(shard, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, shard_path)
+
+
+def _fill_infos_sharded(nusc, scenes, shard_dir, workers=os.cpu_count()):
+    """
+    _fill_trainval_infos + _fill_trainval_infos_SUSTECH over a process pool, one shard file per scene.
+    Scenes whose shard exists are skipped, so a failed or interrupted run continues where it stopped.
+    :return: (nuScenes infos, SUSTech infos) of all scenes, in order.
+    """
+    global _shard_nusc
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_paths = [osp.join(shard_dir, scene["token"] + ".pkl") for scene in scenes]
+    todo = [(scene, shard_path) for scene, shard_path in zip(scenes, shard_paths) if not osp.exists(shard_path)]
+    print('{} of {} scenes done in {}'.format(len(scenes) - len(todo), len(scenes), shard_dir))
+    if todo:
+        failed = []
+        _shard_nusc = nusc
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+                futures = {pool.submit(_build_shard, scene, shard_path): scene["name"] for scene, shard_path in todo}
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print('scene {} failed: {}'.format(futures[future], e))
+                        failed.append(futures[future])
+        finally:
+            _shard_nusc = None
+        if failed:
+            raise RuntimeError('{} scenes failed, run again to retry them: {}'.format(len(failed), failed))
+
+    infos, sustech_infos = [], {}
+    for i, shard_path in enumerate(shard_paths):
+        with open(shard_path, 'rb') as f:
+            shard = pickle.load(f)
+        infos.append(shard["info"])
+        shard["sustech"]["scene"] = "nusc" + str(i + 1)
+        sustech_infos["nusc" + str(i + 1)] = shard["sustech"]
+    return infos, sustech_infos
+
+
+def convert_tracking_file(sustech_info, track_path, workers=os.cpu_count()):
     with open(track_path, 'r') as f:
         det_res = json.load(f)["results"]
-        res = {}
-        for frame_token, det in tqdm(det_res.items()):
-            scene_name = None
-            for scene_name in sustech_info.keys():
-                if frame_token in sustech_info[scene_name]["frames"]:
-                    break
-            frame_index = sustech_info[scene_name]["frames"].index(frame_token)
-            boxes = nusc_det_to_nusc_box(det)
-            globalboxes = copy.deepcopy(boxes)
-            lidar_boxes = _global_nusc_box_to_lidar(sustech_info, boxes, scene_name, frame_index)
-            anns = []
-            for i, box in enumerate(lidar_boxes):
-                if box.score < 0.2:
-                    continue
-                loc = box.center
-                ori = box.orientation.yaw_pitch_roll
-                size = box.wlh
-                global_loc = globalboxes[i].center
-                global_ori = globalboxes[i].orientation.yaw_pitch_roll
-                anns.append({"psr": {"position": {"x": loc[0], "y": loc[1], "z": loc[2]},
-                                     "scale": {"x": size[1], "y": size[0], "z": size[2]},
-                                     "rotation": {"x": ori[2], "y": ori[1], "z": ori[0]}},
-                             "score": box.score,
-                             "obj_type": box.name,
-                             'velocity': globalboxes[i].velocity[:2].tolist(),
-                             "globalpsr": {"position": {"x": global_loc[0], "y": global_loc[1], "z": global_loc[2]},
-                                           "rotation": {"x": global_ori[2], "y": global_ori[1], "z": global_ori[0]}
-                                           },
-                             "obj_id": box.instance_token,
-                             "timestamp": sustech_info[scene_name]["timestamp"][frame_index]})
-            res.update({frame_token: anns})
-        return res
-
-
-def convert_detection_file(sustech_info, detPath):
+    return _convert_results(sustech_info, det_res, True, workers)
+
+
+def _convert_scene(scene_info, scene_name, frames, with_obj_id):
+    """Worker of _convert_results, frames: [(frame_token, frame_index, det)] of one scene."""
+    info = {scene_name: scene_info}
+    return [(frame_token, tracking_frame_to_SUSTECH(info, det, scene_name, frame_index, with_obj_id=with_obj_id))
+            for frame_token, frame_index, det in frames]
+
+
+def _convert_results(sustech_info, det_res, with_obj_id, workers):
+    """nuScenes results (frame_token -> boxes) -> SUSTech boxes per frame token, scenes in parallel."""
+    token_index = FrameTokenIndex.from_info(sustech_info)
+    tokens = list(det_res.keys())
+    scene_ids, frame_indices = token_index.locate_many(tokens)
+    if (scene_ids < 0).any():
+        raise ValueError("frame tokens not in the info: {}".format([t for t, i in zip(tokens, scene_ids) if i < 0][:5]))
+
+    by_scene = {}
+    for frame_token, scene_id, frame_index in zip(tokens, scene_ids.tolist(), frame_indices.tolist()):
+        by_scene.setdefault(scene_id, []).append((frame_token, frame_index, det_res[frame_token]))
+    converted = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for scene_id, frames in by_scene.items():
+            scene_name = token_index.scenes[scene_id]
+            # only what tracking_frame_to_SUSTECH reads is sent to the workers
+            scene_info = {k: sustech_info[scene_name][k] for k in ["ego2lidar", "global2ego", "timestamp"]}
+            futures.append(pool.submit(_convert_scene, scene_info, scene_name, frames, with_obj_id))
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            converted.update(future.result())
+    return {frame_token: converted[frame_token] for frame_token in tokens}
+
+
+def tracking_frame_to_SUSTECH(sustech_info, det, scene_name, frame_index, score_thresh=0.2, with_obj_id=True):
+    """nuScenes tracking boxes of one frame (global) -> SUSTech boxes (lidar) with globalpsr."""
+    globalboxes = nusc_det_to_box_array(det)
+    globalboxes = globalboxes[globalboxes.score >= score_thresh]
+    lidar_boxes = _global_nusc_box_to_lidar(sustech_info, globalboxes.copy(), scene_name, frame_index)
+    loc = lidar_boxes.center.tolist()
+    ori = lidar_boxes.yaw_pitch_roll().tolist()
+    size = lidar_boxes.wlh.tolist()
+    global_loc = globalboxes.center.tolist()
+    global_ori = globalboxes.yaw_pitch_roll().tolist()
+    velocity = globalboxes.velocity[:, :2].tolist()
+    score = globalboxes.score.tolist()
+    timestamp = np.asarray(sustech_info[scene_name]["timestamp"])[frame_index].item()
+    anns = []
+    for i in range(len(globalboxes)):
+        ann = {"psr": {"position": {"x": loc[i][0], "y": loc[i][1], "z": loc[i][2]},
+                       "scale": {"x": size[i][1], "y": size[i][0], "z": size[i][2]},
+                       "rotation": {"x": ori[i][2], "y": ori[i][1], "z": ori[i][0]}},
+               "score": score[i],
+               "obj_type": globalboxes.name[i],
+               'velocity': velocity[i],
+               "globalpsr": {"position": {"x": global_loc[i][0], "y": global_loc[i][1], "z": global_loc[i][2]},
+                             "rotation": {"x": global_ori[i][2], "y": global_ori[i][1], "z": global_ori[i][0]}
+                             }}
+        if with_obj_id:
+            ann["obj_id"] = globalboxes.instance_token[i]
+        ann["timestamp"] = timestamp
+        anns.append(ann)
+    return anns
+
+
+def convert_detection_file(sustech_info, detPath, workers=os.cpu_count()):
     with open(detPath, 'r') as f:
         det_res = json.load(f)["results"]
-    res = {}
-    for frame_token, det in tqdm(det_res.items()):
-        scene_name = None
-        for scene_name in sustech_info.keys():
-            if frame_token in sustech_info[scene_name]["frames"]:
-                break
-        frame_index = sustech_info[scene_name]["frames"].index(frame_token)
-        boxes = nusc_det_to_nusc_box(det)
-        globalboxes = copy.deepcopy(boxes)
-        lidar_boxes = _global_nusc_box_to_lidar(sustech_info, boxes, scene_name, frame_index)
-        anns = []
-        for i, box in enumerate(lidar_boxes):
-            if box.score < 0.2:
-                continue
-            loc = box.center
-            ori = box.orientation.yaw_pitch_roll
-            size = box.wlh
-            global_loc = globalboxes[i].center
-            global_ori = globalboxes[i].orientation.yaw_pitch_roll
-            anns.append({"psr": {"position": {"x": loc[0], "y": loc[1], "z": loc[2]},
-                                 "scale": {"x": size[1], "y": size[0], "z": size[2]},
-                                 "rotation": {"x": ori[2], "y": ori[1], "z": ori[0]}},
-                         "score": box.score,
-                         "obj_type": box.name,
-                         'velocity': globalboxes[i].velocity[:2].tolist(),
-                         "globalpsr": {"position": {"x": global_loc[0], "y": global_loc[1], "z": global_loc[2]},
-                                       "rotation": {"x": global_ori[2], "y": global_ori[1], "z": global_ori[0]}
-                                       },
-                         "timestamp": sustech_info[scene_name]["timestamp"][frame_index]})
-        res.update({frame_token: anns})
-    return res
+    return _convert_results(sustech_info, det_res, False, workers)
 
 
 def _fill_trainval_infos_SUSTECH(nusc, nusc_info):
     SUSTECH_info = {}
-    version = "v1.0-mini" if nusc.version == "v1.0-mini" else "v1.0-train-val"
-    global2new_global = np.array([[-1, 0, 0, 0], [0, -1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
     for i, scene_info in tqdm(enumerate(nusc_info)):
-        scene = {
-            "scene": "nusc" + str(i + 1),
-            "frames": [],
-            "timestamp": [],
-            'is_key_frame': [],
-            'radar_path': [],
-            'lidar_path': [],
-            'anns': [],
-            'camera_path': {'CAM_FRONT': [], 'CAM_FRONT_RIGHT': [], 'CAM_FRONT_LEFT': [],
-                            'CAM_BACK': [], 'CAM_BACK_LEFT': [], 'CAM_BACK_RIGHT': []},
-            'camera': [
-                'CAM_FRONT',
-                'CAM_FRONT_RIGHT',
-                'CAM_FRONT_LEFT',
-                'CAM_BACK',
-                'CAM_BACK_LEFT',
-                'CAM_BACK_RIGHT',
-            ],
-            'calib': {"camera": {}, "radar": {}},
-            'ego_pose': [],
-            'lidar2ego': [],
-            'ego2lidar': [],
-            'global2ego': [],
-            'ego2global': [],
-            'obj_stats': []
-        }
-        all_objs = {}
-        for info in scene_info["frames"]:
-            l2e_t = np.array(info['lidar2ego_translation'])
-            l2e_r = Quaternion(info['lidar2ego_rotation']).rotation_matrix
-            lidar2ego = np.block([[l2e_r, l2e_t[:, np.newaxis]], [np.zeros((1, 3)), 1]])
-            scene['lidar2ego'].append(lidar2ego.T.flatten().tolist())
-            scene['ego2lidar'].append(np.linalg.inv(lidar2ego).T.flatten().tolist())
-
-            ego_pos = np.array(info["ego2global_translation"])
-            ego_ori = Quaternion(info['ego2global_rotation']).rotation_matrix
-            ego2global = np.block([[ego_ori, ego_pos[:, np.newaxis]], [np.zeros((1, 3)), 1]])
-            scene['ego2global'].append(ego2global.T.flatten().tolist())
-            scene['global2ego'].append(np.linalg.inv(ego2global).T.flatten().tolist())
-
-            #             ego2global_new = global2new_global @ ego2global  # new_global旋转了180度
-            ego_ori = Quaternion(matrix=ego2global).yaw_pitch_roll
-            #             ego2global_new = ego2global_new.flatten().tolist()
-            scene['ego_pose'].append({'x': ego_pos[0], 'y': ego_pos[1], 'z': ego_pos[2]
-                                         , 'pitch': ego_ori[1], 'roll': ego_ori[2], 'azimuth': ego_ori[0]})
-
-            scene["anns"].append([{"psr": {"position": {"x": box[0], "y": box[1], "z": box[2]},
-                                           "scale": {"x": box[4], "y": box[3], "z": box[5]},
-                                           "rotation": {"x": box[8], "y": box[7], "z": box[6]}},
-                                   "obj_type": info["gt_names"][j],
-                                   'obj_id': info["gt_boxes_obj_id"][j],
-                                   'velocity': info["gt_velocity"][j].tolist(),
-                                   'timestamp': info['timestamp']} for j, box in
-                                  enumerate(info['gt_boxes'])])
-            for j, box in enumerate(info['gt_boxes']):
-                k = info["gt_names"][j] + "-" + str(info["gt_boxes_obj_id"][j])
-                if all_objs.get(k):
-                    all_objs[k]['count'] += 1
-                else:
-                    all_objs[k] = {
-                        "category": info["gt_names"][j],
-                        "id": info["gt_boxes_obj_id"][j],
-                        "count": 1
-                    }
-            scene["frames"].append(info["token"])
-            scene["timestamp"].append(info["timestamp"])
-            scene["is_key_frame"].append(info["is_key_frame"])
-            scene["lidar_path"].append(info["lidar_path"][info["lidar_path"].rfind(version):])
-            for key, value in info["radar_path"].items():
-                info["radar_path"][key] = value[value.rfind(version):]
-
-            scene["radar_path"].append(info["radar_path"])
-            scene["calib"]["radar"] = info["radar_para"]
-            if info == scene_info["frames"][0]:
-                calib_camera = {'CAM_FRONT': {}, 'CAM_FRONT_RIGHT': {}, 'CAM_FRONT_LEFT': {},
-                                'CAM_BACK': {}, 'CAM_BACK_LEFT': {}, 'CAM_BACK_RIGHT': {}}
-                for cam in scene["camera"]:
-                    calib_camera[cam]["intrinsic"] = info["cams"][cam]["cam_intrinsic"].flatten().tolist()
-                    calib_camera[cam]["extrinsic"] = info["cams"][cam]["extrinsics"].flatten().tolist()
-                scene["calib"]["camera"] = calib_camera
+        SUSTECH_info["nusc" + str(i + 1)] = _scene_info_SUSTECH(nusc.version, scene_info, "nusc" + str(i + 1))
+    return SUSTECH_info
 
-            for cam in scene["camera"]:
-                scene["camera_path"][cam].append(
-                    info["cams"][cam]['data_path'][info["cams"][cam]['data_path'].rfind(version):])
-        scene["boxtype"] = "psr"
-        scene["obj_stats"] = [x for x in all_objs.values()]
 
-        SUSTECH_info["nusc" + str(i + 1)] = scene
-    return SUSTECH_info
+def _scene_info_SUSTECH(nusc_version, scene_info, scene_name):
+    """One scene of _fill_trainval_infos_SUSTECH, scene_info is not modified."""
+    version = "v1.0-mini" if nusc_version == "v1.0-mini" else "v1.0-train-val"
+    global2new_global = np.array([[-1, 0, 0, 0], [0, -1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+    scene = {
+        "scene": scene_name,
+        "frames": [],
+        "timestamp": [],
+        'is_key_frame': [],
+        'radar_path': [],
+        'lidar_path': [],
+        'camera_path': {'CAM_FRONT': [], 'CAM_FRONT_RIGHT': [], 'CAM_FRONT_LEFT': [],
+                        'CAM_BACK': [], 'CAM_BACK_LEFT': [], 'CAM_BACK_RIGHT': []},
+        'camera': [
+            'CAM_FRONT',
+            'CAM_FRONT_RIGHT',
+            'CAM_FRONT_LEFT',
+            'CAM_BACK',
+            'CAM_BACK_LEFT',
+            'CAM_BACK_RIGHT',
+        ],
+        'calib': {"camera": {}, "radar": {}},
+        'ego_pose': [],
+        'lidar2ego': [],
+        'ego2lidar': [],
+        'global2ego': [],
+        'ego2global': [],
+        'obj_stats': []
+    }
+    all_objs = {}
+    anns = []
+    for info in scene_info["frames"]:
+        l2e_t = np.array(info['lidar2ego_translation'])
+        l2e_r = Quaternion(info['lidar2ego_rotation']).rotation_matrix
+        lidar2ego = np.block([[l2e_r, l2e_t[:, np.newaxis]], [np.zeros((1, 3)), 1]])
+        scene['lidar2ego'].append(lidar2ego.T.flatten())
+        scene['ego2lidar'].append(_inv_rigid(lidar2ego).T.flatten())
+
+        ego_pos = np.array(info["ego2global_translation"])
+        ego_ori = Quaternion(info['ego2global_rotation']).rotation_matrix
+        ego2global = np.block([[ego_ori, ego_pos[:, np.newaxis]], [np.zeros((1, 3)), 1]])
+        scene['ego2global'].append(ego2global.T.flatten())
+        scene['global2ego'].append(_inv_rigid(ego2global).T.flatten())
+
+        #             ego2global_new = global2new_global @ ego2global  # new_global旋转了180度
+        ego_ori = Quaternion(matrix=ego2global).yaw_pitch_roll
+        #             ego2global_new = ego2global_new.flatten().tolist()
+        scene['ego_pose'].append({'x': ego_pos[0], 'y': ego_pos[1], 'z': ego_pos[2]
+                                     , 'pitch': ego_ori[1], 'roll': ego_ori[2], 'azimuth': ego_ori[0]})
+
+        # psr columns: position xyz, scale xyz (w and l swapped), rotation xyz
+        anns.append((info['gt_boxes'][:, [0, 1, 2, 4, 3, 5, 8, 7, 6]], info["gt_velocity"],
+                     info["gt_boxes_obj_id"], info["gt_names"]))
+        for j, box in enumerate(info['gt_boxes']):
+            k = info["gt_names"][j] + "-" + str(info["gt_boxes_obj_id"][j])
+            if all_objs.get(k):
+                all_objs[k]['count'] += 1
+            else:
+                all_objs[k] = {
+                    "category": info["gt_names"][j],
+                    "id": info["gt_boxes_obj_id"][j],
+                    "count": 1
+                }
+        scene["frames"].append(info["token"])
+        scene["timestamp"].append(info["timestamp"])
+        scene["is_key_frame"].append(info["is_key_frame"])
+        scene["lidar_path"].append(info["lidar_path"][info["lidar_path"].rfind(version):])
+        scene["radar_path"].append({key: value[value.rfind(version):] for key, value in info["radar_path"].items()})
+        scene["calib"]["radar"] = info["radar_para"]
+        if info is scene_info["frames"][0]:
+            calib_camera = {'CAM_FRONT': {}, 'CAM_FRONT_RIGHT': {}, 'CAM_FRONT_LEFT': {},
+                            'CAM_BACK': {}, 'CAM_BACK_LEFT': {}, 'CAM_BACK_RIGHT': {}}
+            for cam in scene["camera"]:
+                calib_camera[cam]["intrinsic"] = info["cams"][cam]["cam_intrinsic"].flatten().tolist()
+                calib_camera[cam]["extrinsic"] = info["cams"][cam]["extrinsics"].flatten().tolist()
+            scene["calib"]["camera"] = calib_camera
+
+        for cam in scene["camera"]:
+            scene["camera_path"][cam].append(
+                info["cams"][cam]['data_path'][info["cams"][cam]['data_path'].rfind(version):])
+    scene["boxtype"] = "psr"
+    scene["obj_stats"] = [x for x in all_objs.values()]
+    # numeric data as arrays, poses (num_frames, 16) and the boxes as one table, see scene_index.BoxTable
+    for key in ["lidar2ego", "ego2lidar", "global2ego", "ego2global"]:
+        scene[key] = np.array(scene[key], dtype=np.float64).reshape(-1, 16)
+    scene["timestamp"] = np.array(scene["timestamp"], dtype=np.float64)
+    # lidar sweeps before each frame as one table, rows of frame i are offsets[i]:offsets[i + 1]
+    sweeps = [info.get("lidar_sweeps", []) for info in scene_info["frames"]]
+    sweep_offsets = np.zeros(len(sweeps) + 1, dtype=np.int64)
+    sweep_offsets[1:] = np.cumsum([len(frame_sweeps) for frame_sweeps in sweeps])
+    sweeps = [sweep for frame_sweeps in sweeps for sweep in frame_sweeps]
+    scene["sweeps"] = {
+        "offsets": sweep_offsets,
+        "lidar_path": np.array([sweep["lidar_path"][sweep["lidar_path"].rfind(version):] for sweep in sweeps],
+                               dtype=np.str_),
+        "key_from_sweep": np.array([sweep["key_from_sweep"] for sweep in sweeps], dtype=np.float64).reshape(-1, 4, 4),
+        "time_lag": np.array([sweep["time_lag"] for sweep in sweeps], dtype=np.float64),
+    }
+    offsets = np.zeros(len(anns) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(psr) for psr, _, _, _ in anns])
+    scene["anns"] = {
+        "offsets": offsets,
+        "psr": np.concatenate([psr for psr, _, _, _ in anns] + [np.zeros((0, 9))]).astype(np.float64),
+        "velocity": np.concatenate([v for _, v, _, _ in anns] + [np.zeros((0, 2))]).astype(np.float64),
+        "obj_id": np.array([i for _, _, ids, _ in anns for i in ids], dtype=np.int64),
+        "obj_type": np.array([n for _, _, _, names in anns for n in names], dtype=np.str_),
+    }
+    return scene
 
 
 radar_names = ["RADAR_BACK_LEFT", "RADAR_BACK_RIGHT", "RADAR_FRONT", "RADAR_FRONT_LEFT", "RADAR_FRONT_RIGHT"]
@@ -357,243 +427,300 @@ def _fill_trainval_infos(nusc, train_scenes, nsweeps=10, for_detection=False, fi
             that will be saved to the info file.
     """
     # Notice: the timestamp has been multiplied by 1e-6
-    instance_map = {}
-    for i, scene in enumerate(train_scenes):
-        instances_scene = []
-        sample = nusc.get('sample', scene['first_sample_token'])
-        while True:
-            annotations = [
-                nusc.get('sample_annotation', token)
-                for token in sample['anns'] if
-                nusc.get('sample_annotation', token)['category_name'] in NameMapping
-            ]
-            for entry in annotations:
-                instances_scene.append(entry['instance_token'])
-            next_token = sample["next"]
-            if next_token == '':
-                break
-            sample = nusc.get('sample', next_token)
-        instances_scene = list(set(instances_scene))
-        map_obj_id = np.arange(len(instances_scene)) + 1
-        instance_map.update(dict(zip(instances_scene, map_obj_id.tolist())))
-
-    infos = []
-    for i, scene in tqdm(enumerate(train_scenes)):
-        scene_info = {
-            "scene": scene["token"],
-            "frames": [],
-        }
-        first_frame = nusc.get('sample', scene['first_sample_token'])
-        sample = first_frame
-        while True:
-            lidar_token = sample['data']['LIDAR_TOP']
-            sd_rec = nusc.get('sample_data', sample['data']['LIDAR_TOP'])
-            cs_record = nusc.get('calibrated_sensor',
-                                 sd_rec['calibrated_sensor_token'])
-            pose_record = nusc.get('ego_pose', sd_rec['ego_pose_token'])
-            lidar_path, boxes, _ = nusc.get_sample_data(lidar_token)
-            ref_time = 1e-6 * sd_rec["timestamp"]
-
-            ref_from_car = transform_matrix(
-                cs_record["translation"], Quaternion(cs_record["rotation"]), inverse=True
-            )
-            # Homogeneous transfodamation matrix from global to _current_ ego car frame
-            car_from_global = transform_matrix(
-                pose_record["translation"],
-                Quaternion(pose_record["rotation"]),
-                inverse=True,
-            )
+    return [_fill_scene_infos(nusc, scene, nsweeps, for_detection, filter_zero) for scene in tqdm(train_scenes)]
 
-            l2e_r = cs_record['rotation']
-            l2e_t = cs_record['translation']
-            e2g_r = pose_record['rotation']
-            e2g_t = pose_record['translation']
-            l2e_r_mat = Quaternion(l2e_r).rotation_matrix
-            e2g_r_mat = Quaternion(e2g_r).rotation_matrix
 
-            radar_paths = {}
-            radar_paras = {}
-            for i, radar_name in enumerate(radar_names):
-                radar_token = sample['data'][radar_name]
-                radar_path, _, _ = nusc.get_sample_data(radar_token)
-                radar_paths[radar_name] = radar_path
-                radar_info = obtain_sensor2top(nusc, radar_token, l2e_t, l2e_r_mat, e2g_t, e2g_r_mat, radar_name)
-                radar_para = {"cssStyleSelector": "radar-points", "color": radar_colors[i],
-                              "translation": radar_info["sensor2lidar_translation"].tolist(),
-                              "rotation": Quaternion(matrix=radar_info["sensor2lidar_rotation"]).yaw_pitch_roll,
-                              "point_size": 4, "disable": False}
-                radar_paras[radar_name] = radar_para
+def _fill_scene_infos(nusc, scene, nsweeps=10, for_detection=False, filter_zero=True):
+    """_fill_trainval_infos of one scene, scenes do not depend on each other."""
+    scene_anns = _scene_annotation_arrays(nusc, scene)
+    # object ids are per scene, numbered in order of first appearance
+    instance_map = {}
+    for instance_token, mapped in zip(scene_anns["instance_token"], scene_anns["mapped"]):
+        if mapped:
+            instance_map.setdefault(instance_token, len(instance_map) + 1)
 
-            info = {
-                'is_key_frame': sd_rec['is_key_frame'],
-                'lidar_token': lidar_token,
-                'lidar_path': lidar_path,
-                'radar_path': radar_paths,
-                'radar_para': radar_paras,
-                'token': sample['token'],
-                'cams': dict(),
-                'lidar2ego_translation': cs_record['translation'],
-                'lidar2ego_rotation': cs_record['rotation'],
-                'ego2global_translation': pose_record['translation'],
-                'ego2global_rotation': pose_record['rotation'],
-                'timestamp': sample['timestamp'] * 1e-6,
-                'ref_from_car': ref_from_car,
-                "sweeps": [],
-                "car_from_global": car_from_global,
-                "ref_time": ref_time,
-            }
+    scene_info = {
+        "scene": scene["token"],
+        "frames": [],
+    }
+    first_frame = nusc.get('sample', scene['first_sample_token'])
+    sample = first_frame
+    sample_index = 0
+    while True:
+        lidar_token = sample['data']['LIDAR_TOP']
+        sd_rec = nusc.get('sample_data', sample['data']['LIDAR_TOP'])
+        cs_record = nusc.get('calibrated_sensor',
+                             sd_rec['calibrated_sensor_token'])
+        pose_record = nusc.get('ego_pose', sd_rec['ego_pose_token'])
+        lidar_path = nusc.get_sample_data_path(lidar_token)
+        # annotations of the (key frame) sample in the lidar frame, as get_sample_data(lidar_token) returns them
+        rows = slice(scene_anns["offsets"][sample_index], scene_anns["offsets"][sample_index + 1])
+        boxes = BoxArray(scene_anns["center"][rows], scene_anns["size"][rows], scene_anns["rotation"][rows],
+                         velocity=scene_anns["velocity"][rows])
+        boxes.translate(-np.array(pose_record['translation']))
+        boxes.rotate(Quaternion(pose_record['rotation']).inverse)
+        boxes.translate(-np.array(cs_record['translation']))
+        boxes.rotate(Quaternion(cs_record['rotation']).inverse)
+        ref_time = 1e-6 * sd_rec["timestamp"]
+
+        ref_from_car = transform_matrix(
+            cs_record["translation"], Quaternion(cs_record["rotation"]), inverse=True
+        )
+        # Homogeneous transfodamation matrix from global to _current_ ego car frame
+        car_from_global = transform_matrix(
+            pose_record["translation"],
+            Quaternion(pose_record["rotation"]),
+            inverse=True,
+        )
 
-            if for_detection:
-                sample_data_token = sample["data"]['LIDAR_TOP']
-                curr_sd_rec = nusc.get("sample_data", sample_data_token)
-                sweeps = []
-                while len(sweeps) < nsweeps - 1:
-                    if curr_sd_rec["prev"] == "":
-                        if len(sweeps) == 0:
-                            sweep = {
-                                "lidar_path": lidar_path,
-                                "sample_data_token": curr_sd_rec["token"],
-                                "transform_matrix": None,
-                                "time_lag": curr_sd_rec["timestamp"] * 0,
-                            }
-                            sweeps.append(sweep)
-                        else:
-                            sweeps.append(sweeps[-1])
-                    else:
-                        curr_sd_rec = nusc.get("sample_data", curr_sd_rec["prev"])
-                        # Get past pose
-                        current_pose_rec = nusc.get("ego_pose", curr_sd_rec["ego_pose_token"])
-                        global_from_car = transform_matrix(
-                            current_pose_rec["translation"],
-                            Quaternion(current_pose_rec["rotation"]),
-                            inverse=False,
-                        )
-
-                        # Homogeneous transformation matrix from sensor coordinate frame to ego car frame.
-                        current_cs_rec = nusc.get(
-                            "calibrated_sensor", curr_sd_rec["calibrated_sensor_token"]
-                        )
-                        car_from_current = transform_matrix(
-                            current_cs_rec["translation"],
-                            Quaternion(current_cs_rec["rotation"]),
-                            inverse=False,
-                        )
-
-                        tm = reduce(
-                            np.dot,
-                            [ref_from_car, car_from_global, global_from_car, car_from_current],
-                        )
-
-                        lidar_path = nusc.get_sample_data_path(curr_sd_rec["token"])
-
-                        time_lag = ref_time - 1e-6 * curr_sd_rec["timestamp"]
+        l2e_r = cs_record['rotation']
+        l2e_t = cs_record['translation']
+        e2g_r = pose_record['rotation']
+        e2g_t = pose_record['translation']
+        l2e_r_mat = _rotation_matrix(tuple(l2e_r))
+        e2g_r_mat = _rotation_matrix(tuple(e2g_r))
+        # shared by every sensor of the frame
+        inv_mats = _lidar_from_global(l2e_r_mat, e2g_r_mat)
+
+        radar_paths = {}
+        radar_paras = {}
+        for i, radar_name in enumerate(radar_names):
+            radar_token = sample['data'][radar_name]
+            # only the path, get_sample_data would build all boxes in the radar frame
+            radar_path = nusc.get_sample_data_path(radar_token)
+            radar_paths[radar_name] = radar_path
+            radar_info = obtain_sensor2top(nusc, radar_token, l2e_t, l2e_r_mat, e2g_t, e2g_r_mat, radar_name,
+                                           inv_mats)
+            radar_para = {"cssStyleSelector": "radar-points", "color": radar_colors[i],
+                          "translation": radar_info["sensor2lidar_translation"].tolist(),
+                          "rotation": Quaternion(matrix=radar_info["sensor2lidar_rotation"]).yaw_pitch_roll,
+                          "point_size": 4, "disable": False}
+            radar_paras[radar_name] = radar_para
+
+        info = {
+            'is_key_frame': sd_rec['is_key_frame'],
+            'lidar_token': lidar_token,
+            'lidar_path': lidar_path,
+            'radar_path': radar_paths,
+            'radar_para': radar_paras,
+            'token': sample['token'],
+            'cams': dict(),
+            'lidar2ego_translation': cs_record['translation'],
+            'lidar2ego_rotation': cs_record['rotation'],
+            'ego2global_translation': pose_record['translation'],
+            'ego2global_rotation': pose_record['rotation'],
+            'timestamp': sample['timestamp'] * 1e-6,
+            'ref_from_car': ref_from_car,
+            "sweeps": [],
+            "car_from_global": car_from_global,
+            "ref_time": ref_time,
+        }
 
+        if for_detection:
+            sample_data_token = sample["data"]['LIDAR_TOP']
+            curr_sd_rec = nusc.get("sample_data", sample_data_token)
+            sweeps = []
+            while len(sweeps) < nsweeps - 1:
+                if curr_sd_rec["prev"] == "":
+                    if len(sweeps) == 0:
                         sweep = {
                             "lidar_path": lidar_path,
                             "sample_data_token": curr_sd_rec["token"],
-                            "transform_matrix": tm,
-                            "global_from_car": global_from_car,
-                            "car_from_current": car_from_current,
-                            "time_lag": time_lag,
+                            "transform_matrix": None,
+                            "time_lag": curr_sd_rec["timestamp"] * 0,
                         }
                         sweeps.append(sweep)
-                info["sweeps"] = sweeps
-                assert (len(info["sweeps"]) == nsweeps - 1)
-
-                annotations = [
-                    nusc.get("sample_annotation", token) for token in sample["anns"]
-                ]
-
-                mask = np.array([(anno['num_lidar_pts'] + anno['num_radar_pts']) > 0 for anno in annotations],
-                                dtype=bool).reshape(-1)
-
-                locs = np.array([b.center for b in boxes]).reshape(-1, 3)
-                dims = np.array([b.wlh for b in boxes]).reshape(-1, 3)
-                velocity = np.array([b.velocity for b in boxes]).reshape(-1, 3)
-                rots = np.array([quaternion_yaw(b.orientation) for b in boxes]).reshape(
-                    -1, 1
-                )
-                names = np.array([b.name for b in boxes])
-                tokens = np.array([b.token for b in boxes])
-                gt_boxes = np.concatenate(
-                    [locs, dims, velocity[:, :2], -rots - np.pi / 2], axis=1
-                )
-
-                assert len(annotations) == len(gt_boxes) == len(velocity)
-                if not filter_zero:
-                    info["gt_boxes"] = gt_boxes
-                    info["gt_boxes_velocity"] = velocity
-                    info["gt_names"] = np.array([general_to_detection[name] for name in names])
-                    info["gt_boxes_token"] = tokens
+                    else:
+                        sweeps.append(sweeps[-1])
                 else:
-                    info["gt_boxes"] = gt_boxes[mask, :]
-                    info["gt_boxes_velocity"] = velocity[mask, :]
-                    info["gt_names"] = np.array([general_to_detection[name] for name in names])[mask]
-                    info["gt_boxes_token"] = tokens[mask]
+                    curr_sd_rec = nusc.get("sample_data", curr_sd_rec["prev"])
+                    # Get past pose
+                    current_pose_rec = nusc.get("ego_pose", curr_sd_rec["ego_pose_token"])
+                    global_from_car = transform_matrix(
+                        current_pose_rec["translation"],
+                        Quaternion(current_pose_rec["rotation"]),
+                        inverse=False,
+                    )
+
+                    # Homogeneous transformation matrix from sensor coordinate frame to ego car frame.
+                    current_cs_rec = nusc.get(
+                        "calibrated_sensor", curr_sd_rec["calibrated_sensor_token"]
+                    )
+                    car_from_current = transform_matrix(
+                        current_cs_rec["translation"],
+                        Quaternion(current_cs_rec["rotation"]),
+                        inverse=False,
+                    )
+
+                    tm = reduce(
+                        np.dot,
+                        [ref_from_car, car_from_global, global_from_car, car_from_current],
+                    )
+
+                    lidar_path = nusc.get_sample_data_path(curr_sd_rec["token"])
+
+                    time_lag = ref_time - 1e-6 * curr_sd_rec["timestamp"]
+
+                    sweep = {
+                        "lidar_path": lidar_path,
+                        "sample_data_token": curr_sd_rec["token"],
+                        "transform_matrix": tm,
+                        "global_from_car": global_from_car,
+                        "car_from_current": car_from_current,
+                        "time_lag": time_lag,
+                    }
+                    sweeps.append(sweep)
+            info["sweeps"] = sweeps
+            assert (len(info["sweeps"]) == nsweeps - 1)
+
+            mask = (scene_anns["num_lidar_pts"][rows] + scene_anns["num_radar_pts"][rows]) > 0
+
+            locs = boxes.center
+            dims = boxes.wlh
+            velocity = boxes.velocity
+            rots = _quaternion_yaws(boxes.orientation).reshape(-1, 1)
+            names = np.array(scene_anns["category_name"][rows].tolist())
+            tokens = np.array(scene_anns["token"][rows].tolist())
+            gt_boxes = np.concatenate(
+                [locs, dims, velocity[:, :2], -rots - np.pi / 2], axis=1
+            )
 
+            if not filter_zero:
+                info["gt_boxes"] = gt_boxes
+                info["gt_boxes_velocity"] = velocity
+                info["gt_names"] = np.array([general_to_detection[name] for name in names])
+                info["gt_boxes_token"] = tokens
             else:
+                info["gt_boxes"] = gt_boxes[mask, :]
+                info["gt_boxes_velocity"] = velocity[mask, :]
+                info["gt_names"] = np.array([general_to_detection[name] for name in names])[mask]
+                info["gt_boxes_token"] = tokens[mask]
 
-                # obtain 6 image's information per frame
-                camera_types = [
-                    'CAM_FRONT',
-                    'CAM_FRONT_RIGHT',
-                    'CAM_FRONT_LEFT',
-                    'CAM_BACK',
-                    'CAM_BACK_LEFT',
-                    'CAM_BACK_RIGHT',
-                ]
-                for cam in camera_types:
-                    cam_token = sample['data'][cam]
-                    cam_info = obtain_sensor2top(nusc, cam_token, l2e_t, l2e_r_mat,
-                                                 e2g_t, e2g_r_mat, cam)
-                    info['cams'].update({cam: cam_info})
-                boxes = [box for box in boxes if box.name in list(NameMapping.keys())]
-
-                # obtain annotation
-                annotations = [
-                    nusc.get('sample_annotation', token)
-                    for token in sample['anns'] if
-                    nusc.get('sample_annotation', token)['category_name'] in NameMapping
-                ]
-
-                locs = np.array([b.center for b in boxes]).reshape(-1, 3)
-                dims = np.array([b.wlh for b in boxes]).reshape(-1, 3)
-                rots = np.array([b.orientation.yaw_pitch_roll
-                                 for b in boxes]).reshape(-1, 3)
-                velocity = np.array([b.velocity[:2] for b in boxes])
-                valid_flag = np.array(
-                    [(anno['num_lidar_pts'] + anno['num_radar_pts']) > 0
-                     for anno in annotations],
-                    dtype=bool).reshape(-1)
-                velocity[velocity != velocity] = 999  # fill the nan
-                velocity = velocity.reshape(-1, 2)
-                names = [b.name for b in boxes]
-                for j in range(len(names)):
-                    if names[j] in NameMapping:
-                        names[j] = NameMapping[names[j]]
-                names = np.array(names)
-                # we need to convert rot to SECOND format.
-                # rots[:, 0] = -rots[:, 0] - np.pi / 2
-                gt_boxes = np.concatenate([locs, dims, rots], axis=1)
-                ids = np.array([instance_map[box.instance_token] for box in boxes])
-                if filter_zero:
-                    gt_boxes = gt_boxes[valid_flag, :]
-                    names = names[valid_flag]
-                    velocity = velocity[valid_flag, :]
-                    ids = ids[valid_flag]
-
-                info['gt_boxes'] = gt_boxes
-                info['gt_names'] = names
-                info['gt_velocity'] = velocity
-                info["gt_boxes_obj_id"] = ids.tolist()
-
-            scene_info["frames"].append(info)
-            next_token = sample["next"]
-            if next_token == '':
-                break
-            sample = nusc.get('sample', next_token)
-        infos.append(scene_info)
-    return infos
+        else:
+
+            # obtain 6 image's information per frame
+            camera_types = [
+                'CAM_FRONT',
+                'CAM_FRONT_RIGHT',
+                'CAM_FRONT_LEFT',
+                'CAM_BACK',
+                'CAM_BACK_LEFT',
+                'CAM_BACK_RIGHT',
+            ]
+            for cam in camera_types:
+                cam_token = sample['data'][cam]
+                cam_info = obtain_sensor2top(nusc, cam_token, l2e_t, l2e_r_mat,
+                                             e2g_t, e2g_r_mat, cam, inv_mats)
+                info['cams'].update({cam: cam_info})
+            info["lidar_sweeps"] = _lidar_sweeps(nusc, sd_rec, ref_from_car, car_from_global, ref_time, nsweeps)
+            keep = scene_anns["mapped"][rows]
+            boxes = boxes[keep]
+
+            locs = boxes.center
+            dims = boxes.wlh
+            rots = boxes.yaw_pitch_roll()
+            velocity = boxes.velocity[:, :2].copy()
+            valid_flag = ((scene_anns["num_lidar_pts"][rows] + scene_anns["num_radar_pts"][rows]) > 0)[keep]
+            velocity[velocity != velocity] = 999  # fill the nan
+            names = np.array([NameMapping[name] for name in scene_anns["category_name"][rows][keep]])
+            # we need to convert rot to SECOND format.
+            # rots[:, 0] = -rots[:, 0] - np.pi / 2
+            gt_boxes = np.concatenate([locs, dims, rots], axis=1)
+            ids = np.array([instance_map[instance_token] for instance_token in scene_anns["instance_token"][rows][keep]])
+            if filter_zero:
+                gt_boxes = gt_boxes[valid_flag, :]
+                names = names[valid_flag]
+                velocity = velocity[valid_flag, :]
+                ids = ids[valid_flag]
+
+            info['gt_boxes'] = gt_boxes
+            info['gt_names'] = names
+            info['gt_velocity'] = velocity
+            info["gt_boxes_obj_id"] = ids.tolist()
+
+        scene_info["frames"].append(info)
+        next_token = sample["next"]
+        if next_token == '':
+            break
+        sample = nusc.get('sample', next_token)
+        sample_index += 1
+    return scene_info
+
+
+def _lidar_sweeps(nusc, sd_rec, ref_from_car, car_from_global, ref_time, nsweeps=10):
+    """
+    The lidar sweeps before the key frame sd_rec, newest first, following the sample_data prev chain.
+    :return: [{"lidar_path", "key_from_sweep": <4x4> key frame lidar from sweep lidar, "time_lag": in s}],
+        at most nsweeps - 1.
+    """
+    sweeps = []
+    while len(sweeps) < nsweeps - 1 and sd_rec["prev"] != "":
+        sd_rec = nusc.get("sample_data", sd_rec["prev"])
+        pose_rec = nusc.get("ego_pose", sd_rec["ego_pose_token"])
+        cs_rec = nusc.get("calibrated_sensor", sd_rec["calibrated_sensor_token"])
+        global_from_car = transform_matrix(pose_rec["translation"], Quaternion(pose_rec["rotation"]), inverse=False)
+        car_from_current = transform_matrix(cs_rec["translation"], Quaternion(cs_rec["rotation"]), inverse=False)
+        sweeps.append({
+            "lidar_path": nusc.get_sample_data_path(sd_rec["token"]),
+            "key_from_sweep": reduce(np.dot, [ref_from_car, car_from_global, global_from_car, car_from_current]),
+            "time_lag": ref_time - 1e-6 * sd_rec["timestamp"],
+        })
+    return sweeps
+
+
+def _scene_annotation_arrays(nusc, scene):
+    """
+    All sample annotations of a scene as arrays, read from the tables once. Rows are in sample order and
+    in the order of sample['anns'], the rows of the k-th sample are offsets[k]:offsets[k + 1].
+    center, size, rotation (w x y z) and velocity are global, velocity as NuScenes.box_velocity estimates it.
+    mapped flags the categories in NameMapping.
+    """
+    records, offsets, timestamps = [], [0], []
+    sample_token = scene['first_sample_token']
+    while sample_token != '':
+        sample = nusc.get('sample', sample_token)
+        anns = [nusc.get('sample_annotation', token) for token in sample['anns']]
+        records += anns
+        offsets.append(len(records))
+        timestamps += [1e-6 * sample['timestamp']] * len(anns)
+        sample_token = sample['next']
+
+    n = len(records)
+    rows = {record['token']: i for i, record in enumerate(records)}
+    res = {
+        "offsets": np.array(offsets, dtype=np.int64),
+        "token": np.array([record['token'] for record in records], dtype=object),
+        "category_name": np.array([record['category_name'] for record in records], dtype=object),
+        "instance_token": np.array([record['instance_token'] for record in records], dtype=object),
+        "center": np.array([record['translation'] for record in records], dtype=np.float64).reshape(n, 3),
+        "size": np.array([record['size'] for record in records], dtype=np.float64).reshape(n, 3),
+        "rotation": np.array([record['rotation'] for record in records], dtype=np.float64).reshape(n, 4),
+        "num_lidar_pts": np.array([record['num_lidar_pts'] for record in records], dtype=np.int64),
+        "num_radar_pts": np.array([record['num_radar_pts'] for record in records], dtype=np.int64),
+    }
+    res["mapped"] = np.array([name in NameMapping for name in res["category_name"]], dtype=bool)
+
+    # NuScenes.box_velocity: centered difference to the neighbouring annotations of the instance
+    row = np.arange(n)
+    prev_row = np.array([rows.get(record['prev'], -1) for record in records], dtype=np.int64)
+    next_row = np.array([rows.get(record['next'], -1) for record in records], dtype=np.int64)
+    has_prev, has_next = prev_row >= 0, next_row >= 0
+    first = np.where(has_prev, prev_row, row)
+    last = np.where(has_next, next_row, row)
+    timestamps = np.array(timestamps, dtype=np.float64)
+    time_diff = timestamps[last] - timestamps[first]
+    max_time_diff = np.where(has_prev & has_next, 3.0, 1.5)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        velocity = (res["center"][last] - res["center"][first]) / time_diff[:, None]
+    velocity[~(has_prev | has_next) | (time_diff > max_time_diff)] = np.nan
+    res["velocity"] = velocity
+    return res
+
+
+def _quaternion_yaws(orientation):
+    """quaternion_yaw of <np.float: n, 4> quaternions."""
+    w, x, y, z = (orientation / np.linalg.norm(orientation, axis=1, keepdims=True)).T
+    return np.arctan2(2 * (x * y + w * z), 1 - 2 * (y ** 2 + z ** 2))
 
 
 def obtain_sensor2top(nusc,
@@ -602,7 +729,8 @@ def obtain_sensor2top(nusc,
                       l2e_r_mat,
                       e2g_t,
                       e2g_r_mat,
-                      sensor_type='lidar'):
+                      sensor_type='lidar',
+                      inv_mats=None):
     """Obtain the info with RT matric from general sensor to Top LiDAR.
 
     Args:
@@ -616,10 +744,13 @@ def obtain_sensor2top(nusc,
         e2g_r_mat (np.ndarray): Rotation matrix from ego to global
             in shape (3, 3).
         sensor_type (str): Sensor to calibrate. Default: 'lidar'.
+        inv_mats (tuple): _lidar_from_global(l2e_r_mat, e2g_r_mat), computed
+            here if not given.
 
     Returns:
         sweep (dict): Sweep information after transformation.
     """
+    global2lidar_r, ego2lidar_r = inv_mats if inv_mats is not None else _lidar_from_global(l2e_r_mat, e2g_r_mat)
     sd_rec = nusc.get('sample_data', sensor_token)
     cs_record = nusc.get('calibrated_sensor',
                          sd_rec['calibrated_sensor_token'])
@@ -646,14 +777,11 @@ def obtain_sensor2top(nusc,
 
     # obtain the RT from sensor to Top LiDAR
     # sweep->ego->global->ego'->lidar
-    l2e_r_s_mat = Quaternion(l2e_r_s).rotation_matrix
-    e2g_r_s_mat = Quaternion(e2g_r_s).rotation_matrix
-    R = (l2e_r_s_mat.T @ e2g_r_s_mat.T) @ (
-            np.linalg.inv(e2g_r_mat).T @ np.linalg.inv(l2e_r_mat).T)
-    T = (l2e_t_s @ e2g_r_s_mat.T + e2g_t_s) @ (
-            np.linalg.inv(e2g_r_mat).T @ np.linalg.inv(l2e_r_mat).T)
-    T -= e2g_t @ (np.linalg.inv(e2g_r_mat).T @ np.linalg.inv(l2e_r_mat).T
-                  ) + l2e_t @ np.linalg.inv(l2e_r_mat).T
+    l2e_r_s_mat = _rotation_matrix(tuple(l2e_r_s))
+    e2g_r_s_mat = _rotation_matrix(tuple(e2g_r_s))
+    R = (l2e_r_s_mat.T @ e2g_r_s_mat.T) @ global2lidar_r
+    T = (l2e_t_s @ e2g_r_s_mat.T + e2g_t_s) @ global2lidar_r
+    T -= e2g_t @ global2lidar_r + l2e_t @ ego2lidar_r
 
     if sd_rec['sensor_modality'] == 'camera':
         extrinsic = np.block([[R, -R @ T[:, np.newaxis]], [np.zeros((1, 3)), 1]])
@@ -670,6 +798,27 @@ def obtain_sensor2top(nusc,
     return sweep
 
 
+@lru_cache(maxsize=65536)
+def _rotation_matrix(rotation):
+    """Quaternion(rotation).rotation_matrix, cached, calibrations and poses repeat across sensors and frames.
+    The result is shared, do not modify it."""
+    return Quaternion(rotation).rotation_matrix
+
+
+def _lidar_from_global(l2e_r_mat, e2g_r_mat):
+    """The inverse rotations obtain_sensor2top needs, once per frame instead of per sensor."""
+    ego2lidar_r = np.linalg.inv(l2e_r_mat).T
+    return np.linalg.inv(e2g_r_mat).T @ ego2lidar_r, ego2lidar_r
+
+
+def _inv_rigid(trans_mat):
+    """Inverse of a 4x4 rotation + translation."""
+    res = np.eye(4)
+    res[:3, :3] = trans_mat[:3, :3].T
+    res[:3, 3] = -trans_mat[:3, :3].T @ trans_mat[:3, 3]
+    return res
+
+
 def nusc_box_to_SUSTECH(boxes):
     anns = []
     for box in boxes:
@@ -684,44 +833,47 @@ def nusc_box_to_SUSTECH(boxes):
     return anns
 
 
+def SUSTECH_det_to_box_array(anns):
+    pos = [[ann["psr"]["position"][axis] for axis in ["x", "y", "z"]] for ann in anns]
+    size = [[ann["psr"]["scale"][axis] for axis in ["y", "x", "z"]] for ann in anns]
+    # rotation about z only, w x y z = cos(yaw / 2) 0 0 sin(yaw / 2)
+    half_yaw = np.array([ann["psr"]["rotation"]["z"] for ann in anns], dtype=np.float64) / 2
+    quat = np.zeros((len(anns), 4))
+    quat[:, 0] = np.cos(half_yaw)
+    quat[:, 3] = np.sin(half_yaw)
+    return BoxArray(pos, size, quat,
+                    label=[class_names.index(ann["obj_type"]) for ann in anns],
+                    score=np.ones(len(anns)),
+                    velocity=[[*ann["velocity"], 0.0] for ann in anns],
+                    instance_token=[ann["obj_id"] for ann in anns])
+
+
 def SUSTECH_det_to_nusc_box(anns):
-    box_list = []
-    for ann in anns:
-        pos = [ann["psr"]["position"][axis] for axis in ["x", "y", "z"]]
-        size = [ann["psr"]["scale"][axis] for axis in ["y", "x", "z"]]
-        quat = Quaternion(axis=[0, 0, 1], radians=ann["psr"]["rotation"]["z"])
-        velocity = [*ann["velocity"], 0.0]
-        box = Box(
-            pos,
-            size,
-            quat,
-            label=class_names.index(ann["obj_type"]),
-            score=1.0,
-            velocity=velocity,
-            instance_token=ann["obj_id"]
-        )
-        box_list.append(box)
-    return box_list
+    return SUSTECH_det_to_box_array(anns).to_boxes()
+
+
+def nusc_det_to_box_array(detection):
+    return BoxArray([record['translation'] for record in detection], [record['size'] for record in detection],
+                    [record['rotation'] for record in detection],
+                    name=[record['detection_name'] for record in detection],
+                    score=[record['detection_score'] for record in detection],
+                    velocity=[[*record['velocity'], 0] for record in detection],
+                    instance_token=[int(record["obj_id"]) if "obj_id" in record.keys() else int(
+                        record["tracking_id"]) if "tracking_id" in record.keys() else None for record in detection],
+                    token='predicted')
 
 
 def nusc_det_to_nusc_box(detection):
-    return [Box(record['translation'], record['size'], Quaternion(record['rotation']),
-                name=record['detection_name'], score=record['detection_score'],
-                velocity=[*record['velocity'], 0],
-                instance_token=int(record["obj_id"]) if "obj_id" in record.keys() else int(
-                    record["tracking_id"]) if "tracking_id" in record.keys() else None,
-                token='predicted') for record in detection]
+    return nusc_det_to_box_array(detection).to_boxes()
 
 
 def _global_nusc_box_to_lidar(nusc_info, boxes, scene_name, frame_index):
+    """Transforms a BoxArray from global to the lidar frame, in place."""
     ego2lidar = np.array(nusc_info[scene_name]["ego2lidar"][frame_index]).reshape(4, 4).T
     global2ego = np.array(nusc_info[scene_name]["global2ego"][frame_index]).reshape(4, 4).T
-    boxlist = []
-    for box in boxes:
-        box.transform(global2ego)
-        box.transform(ego2lidar)
-        boxlist.append(box)
-    return boxlist
+    boxes.transform(global2ego)
+    boxes.transform(ego2lidar)
+    return boxes
 
 
 def obtain_sensor2top_PETR(nusc,
@@ -973,11 +1125,12 @@ def convert_SUSTECH_toPETR(root_path,
                            datadir,
                            dataset="train",
                            version='v1.0-trainval',
-                           max_sweeps=10):
+                           max_sweeps=10,
+                           table_cache=None):
     num_prev = 5  ###nummber of previous key frames
     num_sweep = 5  ###nummber of sweep frames between two key frame
     from tools.my_nuscenes.nuscenes import NuScenes
-    nusc = NuScenes(version=version, dataroot=root_path, verbose=True)
+    nusc = NuScenes(version=version, dataroot=root_path, verbose=True, table_cache=table_cache)
     sensors = ['CAM_FRONT', 'CAM_FRONT_RIGHT', 'CAM_BACK_RIGHT', 'CAM_BACK', 'CAM_BACK_LEFT', 'CAM_FRONT_LEFT']
 
     info_path = osp.join(root_path, 'From_SUSTECH_infos_' + dataset + '.pkl')
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import algos.track
+
+# Tracking state of /iter_centertrack, one TrackSession per (user session, scene) instead of
+# the module globals of algos/track.py. Every tracked frame keeps a digest chained over the
+# inputs of all frames up to it, so a request only re-runs the frames from the first one
+# whose detections (or predecessor) changed. Sessions live in a bounded LRU and, with a
+# spill dir, the frames a request changed are written after it so any uwsgi worker can pick
+# them up. Spill layout, per session:
+#   <spill_dir>/<key hash>/state.pkl         unknown_num and the tracked frames, written last
+#   <spill_dir>/<key hash>/<frame>.pkl       (chain, output) of one frame
+
+max_sessions = 64
+max_boxes = 2000000  # tracked boxes kept in memory over all sessions
+max_spill_age = 24 * 3600
+
+
+def frame_digest(dets):
+    """Hash of the det fields step_centertrack reads."""
+    key = [(d['globalpsr']['position']['x'], d['globalpsr']['position']['y'], d['velocity'][:2],
+            d['obj_type'], d.get('obj_id'), d.get('timestamp')) for d in dets]
+    return hashlib.sha1(json.dumps(key, default=str).encode("utf-8")).hexdigest()
+
+
+def _write_pickle(path, obj):
+    tmp_path = "{}.tmp{}.{}".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class TrackSession(object):
+    def __init__(self):
+        self.tracks = {}  # frame_index -> output of step_centertrack
+        self.chain = {}  # frame_index -> digest of the inputs of this and all previous frames
+        self.unknown_num = 0
+        self.dirty = set()  # frames changed or dropped since the last spill
+        self.mtime = 0  # of the spilled state this session last read or wrote
+        self.frame_mtimes = {}  # frame_index -> mtime of the spilled frame this session last read or wrote
+        self.lock = threading.Lock()
+
+    def num_boxes(self):
+        return sum(len(t) for t in self.tracks.values())
+
+    def invalidate_from(self, frame_index):
+        for frame in [f for f in self.tracks.keys() if f >= frame_index]:
+            del self.tracks[frame]
+            self.chain.pop(frame, None)
+            self.dirty.add(frame)
+
+    def clear(self):
+        self.dirty.update(self.tracks.keys())
+        self.tracks = {}
+        self.chain = {}
+
+    def reset(self):
+        """Forgets everything tracked, the next request tracks from scratch with fresh placeholder ids."""
+        self.clear()
+        self.unknown_num = 0
+
+    def frame_chain(self, frame_index, dets):
+        """The chain digest frame_index has with these dets, if the frames before it stay as tracked."""
+        prev_chain = self.chain.get(frame_index - 1, "")
+        return hashlib.sha1((prev_chain + frame_digest(dets)).encode("utf-8")).hexdigest()
+
+    def cached(self, frame_index, dets):
+        """Returns the stored output of the frame if it was tracked with these dets, else None."""
+        if frame_index in self.tracks and self.chain.get(frame_index) == self.frame_chain(frame_index, dets):
+            return self.tracks[frame_index]
+        return None
+
+    def run(self, frames):
+        """
+        Tracks the frames of one request, reusing every frame whose input chain is unchanged.
+        :param frames: [{"frame_index", "dets"}] in order, as posted by the client.
+        :return: step_centertrack output per frame.
+        """
+        res = []
+        # step_centertrack continues from the stored previous frame if there is one
+        last_time_stamp = frames[0]["dets"][0]["timestamp"]
+        for frame in frames:
+            frame_index = frame["frame_index"]
+            timestamp = frame["dets"][0]["timestamp"]
+            time_lag = timestamp - last_time_stamp
+            last_time_stamp = timestamp
+
+            chain = self.frame_chain(frame_index, frame["dets"])
+            if self.chain.get(frame_index) == chain:
+                outputs = self.tracks[frame_index]
+            else:
+                # this frame changed, everything tracked after it is stale too
+                self.invalidate_from(frame_index)
+                outputs = algos.track.step_centertrack(frame["dets"], time_lag, frame_index, self)
+                self.chain[frame_index] = chain
+                self.dirty.add(frame_index)
+            res.append(outputs)
+        return res
+
+
+class TrackSessionManager(object):
+    def __init__(self, spill_dir=None, max_sessions=max_sessions, max_boxes=max_boxes):
+        self.spill_dir = spill_dir
+        self.max_sessions = max_sessions
+        self.max_boxes = max_boxes
+        self._sessions = OrderedDict()  # (session id, scene) -> TrackSession
+        self._lock = threading.Lock()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._prune_spill()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest())
+
+    def get(self, session_id, scene):
+        """Returns the session of (session_id, scene), with the newest state any worker saved."""
+        key = (session_id, scene)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = TrackSession()
+                self._sessions[key] = session
+            self._sessions.move_to_end(key)
+
+        if self.spill_dir is not None:
+            with session.lock:
+                self._load(session, self._spill_path(key))
+        return session
+
+    def put(self, session_id, scene, session):
+        """Called after a request changed the session, spills the changed frames and enforces the caps."""
+        key = (session_id, scene)
+        if self.spill_dir is not None:
+            with session.lock:
+                self._spill(session, self._spill_path(key))
+
+        with self._lock:
+            self._sessions[key] = session
+            self._sessions.move_to_end(key)
+            total = sum(s.num_boxes() for s in self._sessions.values())
+            while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions or total > self.max_boxes):
+                _, old = self._sessions.popitem(last=False)
+                total -= old.num_boxes()
+
+    def _load(self, session, path):
+        """Reads the frames another worker (or an earlier run) spilled since this session last synced."""
+        state_path = os.path.join(path, "state.pkl")
+        mtime = os.path.getmtime(state_path) if os.path.isfile(state_path) else 0
+        if not mtime or mtime == session.mtime:
+            return
+        try:
+            with open(state_path, "rb") as f:
+                state = pickle.load(f)
+            frames = set(state["frames"])
+            for frame in [f for f in session.tracks if f not in frames]:
+                del session.tracks[frame]
+                session.chain.pop(frame, None)
+                session.frame_mtimes.pop(frame, None)
+            for frame in frames:
+                frame_path = os.path.join(path, "{}.pkl".format(frame))
+                frame_mtime = os.path.getmtime(frame_path)
+                if session.frame_mtimes.get(frame) != frame_mtime:
+                    with open(frame_path, "rb") as f:
+                        session.chain[frame], session.tracks[frame] = pickle.load(f)
+                    session.frame_mtimes[frame] = frame_mtime
+            session.unknown_num = state["unknown_num"]
+            session.dirty = set()
+            session.mtime = mtime
+        except Exception as e:
+            print("loading track session failed:", e)
+
+    def _spill(self, session, path):
+        os.makedirs(path, exist_ok=True)
+        for frame in session.dirty:
+            frame_path = os.path.join(path, "{}.pkl".format(frame))
+            if frame in session.tracks:
+                _write_pickle(frame_path, (session.chain[frame], session.tracks[frame]))
+                session.frame_mtimes[frame] = os.path.getmtime(frame_path)
+            else:
+                if os.path.isfile(frame_path):
+                    os.remove(frame_path)
+                session.frame_mtimes.pop(frame, None)
+        session.dirty = set()
+        state_path = os.path.join(path, "state.pkl")
+        _write_pickle(state_path, {"unknown_num": session.unknown_num, "frames": sorted(session.tracks.keys())})
+        session.mtime = os.path.getmtime(state_path)
+
+    def _prune_spill(self):
+        now = time.time()
+        for name in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if now - os.path.getmtime(path) > max_spill_age:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,95 @@
+import os
+import time
+import fcntl
+import threading
+
+from blob_store import BlobStore, write_blob_store, iter_json_items
+
+# Tracking results (frame_token -> list of SUSTech boxes) kept in a memory-mapped
+# blob store next to the json written by convert_tracking_file, so one frame can be
+# read without parsing the whole tracking run.
+
+
+def build_track_store(track_file, store_path, results_key=None):
+    # streamed, a whole detection/tracking run never has to fit in memory
+    write_blob_store(store_path, iter_json_items(track_file, results_key))
+
+
+class TrackStore(object):
+    def __init__(self, track_file, store_path=None, watch=False, check_interval=30, results_key=None):
+        """
+        :param results_key: for files that nest the per-frame boxes, e.g. "results" of a nuScenes
+            detection file.
+        """
+        self.track_file = track_file
+        self.results_key = results_key
+        self.store_path = store_path if store_path is not None else os.path.splitext(track_file)[0] + ".blob"
+        self.watch = watch
+        self.check_interval = check_interval
+        self.store = None
+        self._lock = threading.Lock()
+        self._watcher_pid = None
+        self.rebuild_if_stale()
+
+    def is_stale(self):
+        if not os.path.isfile(self.track_file):
+            return False
+        return not os.path.isfile(self.store_path) or \
+            os.path.getmtime(self.store_path) < os.path.getmtime(self.track_file)
+
+    def rebuild_if_stale(self):
+        if not self.is_stale():
+            return
+        # only one process converts a new tracking run, the others pick up the result
+        with open(self.store_path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self.is_stale():
+                    print("building tracking store", self.store_path, "from", self.track_file)
+                    build_track_store(self.track_file, self.store_path, self.results_key)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _current(self):
+        if self.watch and self._watcher_pid != os.getpid():
+            # threads don't survive the uwsgi fork, start the watcher in the serving process
+            self.start_watcher()
+        if not os.path.isfile(self.store_path):
+            return None
+        mtime = os.path.getmtime(self.store_path)
+        with self._lock:
+            if self.store is None or self.store.mtime != mtime:
+                self.store = BlobStore(self.store_path)
+            return self.store
+
+    def available(self):
+        return self._current() is not None
+
+    def get(self, frame_token, default=None):
+        store = self._current()
+        if store is None:
+            return default
+        return store.get(frame_token, default)
+
+    def start_watcher(self):
+        """Rebuilds the store in the background whenever a new tracking run replaces track_file."""
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+
+        def watch():
+            while True:
+                time.sleep(self.check_interval)
+                try:
+                    self.rebuild_if_stale()
+                except Exception as e:
+                    print("rebuilding tracking store failed:", e)
+
+        threading.Thread(target=watch, daemon=True).start()
+
+
+if __name__ == "__main__":
+    import sys
+    # python track_store.py <tracking json> [store path]
+    TrackStore(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
@@ -5,7 +5,8 @@ import sys
 sys.path.append('/home/yaozh/WebstormProjects/my_pcl_annotate/tools')
 
 def nuscenes_data_prep(root_path,
-                       version):
+                       version,
+                       table_cache=None):
     """Prepare data related to nuScenes dataset.
 
     Related data consists of '.pkl' files recording basic infos,
@@ -18,8 +19,9 @@ def nuscenes_data_prep(root_path,
         dataset_name (str): The dataset class name.
         out_dir (str): Output directory of the groundtruth database info.
         max_sweeps (int): Number of input consecutive frames. Default: 10
+        table_cache (str): Writable folder to cache the nuScenes tables in. Default: None
     """
-    nuscenes_converter.create_nuscenes_infos(root_path, version=version)
+    nuscenes_converter.create_nuscenes_infos(root_path, version=version, table_cache=table_cache)
 
 parser = argparse.ArgumentParser(description='Data converter arg parser')
 parser.add_argument(
@@ -33,11 +35,17 @@ parser.add_argument(
     default='v1.0-mini',
     required=False,
     help='specify the dataset version, no need for kitti')
+parser.add_argument(
+    '--table-cache',
+    type=str,
+    default=None,
+    help='writable folder for a binary cache of the nuScenes tables, speeds up later runs')
 args = parser.parse_args()
 
 if __name__ == '__main__':
     nuscenes_data_prep(
         root_path=args.root_path,
-        version=args.version)
+        version=args.version,
+        table_cache=args.table_cache)
 
 